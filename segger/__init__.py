@@ -24,11 +24,17 @@
 # *
 # **************************************************************************
 
+import os
+import tempfile
+
 import pwem
 
 from chimera import Plugin as chimera_plugin
 
+from .constants import SEGGER_CACHE, SEGGER_CACHE_SIZE, SEGGER_WORKERS, SEGGER_WORKER_IDLE
+
 
+__version__ = '2.3'
 _logo = "icon.png"
 _references = ['GRIGORE2010']
 
@@ -37,21 +43,44 @@ class Plugin(pwem.Plugin):
 
     @classmethod
     def _defineVariables(cls):
-        pass
+        cls._defineVar(SEGGER_CACHE, os.path.join(os.path.expanduser('~'), '.cache', 'scipion-segger'))
+        cls._defineVar(SEGGER_CACHE_SIZE, 4096)  # MB
+        cls._defineVar(SEGGER_WORKERS, 0)  # Persistent Chimera workers per node, 0 disables them
+        cls._defineVar(SEGGER_WORKER_IDLE, 1800)  # Seconds before an idle worker exits
+
+    @classmethod
+    def getCache(cls):
+        """ Watershed cache shared by all the runs of this user """
+        from .cache import WatershedCache
+        return WatershedCache(cls.getVar(SEGGER_CACHE), int(cls.getVar(SEGGER_CACHE_SIZE)) * 1024 * 1024)
 
     @classmethod
     def getEnviron(cls):
          return chimera_plugin.getEnviron()
 
+    @classmethod
+    def getWorkerPool(cls, program):
+        """ Persistent headless Chimera workers of this user on this node """
+        from .worker import ChimeraWorkerPool
+        folder = os.path.join(tempfile.gettempdir(), 'scipion-segger-%d' % os.getuid())
+        return ChimeraWorkerPool(folder, int(cls.getVar(SEGGER_WORKERS)), program, cls.getEnviron(),
+                                 int(cls.getVar(SEGGER_WORKER_IDLE)))
+
     @classmethod
     def runChimeraProgram(cls, program, args="", cwd=None):
-        """ Internal shortcut function to launch chimera program. """
-        chimera_plugin.runChimeraProgram(program, args="", cwd=cwd)
+        """ Internal shortcut function to launch chimera program. Headless scripts
+        are run by a persistent worker when SEGGER_WORKERS is greater than 0 """
+        from .worker import parseScriptArgs
+        script = parseScriptArgs(args) if int(cls.getVar(SEGGER_WORKERS)) > 0 else None
+        if script is None:
+            chimera_plugin.runChimeraProgram(program, args=args, cwd=cwd)
+        else:
+            cls.getWorkerPool(program).run(script[0], script[1], cwd)
 
     @classmethod
     def getProgram(cls, progName="chimera"):
         """ Return the program binary that will be used. """
-        chimera_plugin.getProgram(progName)
+        return chimera_plugin.getProgram(progName)
 
     @classmethod
     def defineBinaries(cls, env):
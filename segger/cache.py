@@ -0,0 +1,113 @@
+# **************************************************************************
+# *
+# * Authors:     David Herreros Calero (dherreros@cnb.csic.es)
+# *
+# * BCU, Centro Nacional de Biotecnologia, CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+import hashlib
+import tempfile
+
+import numpy as np
+
+
+def fileHash(path, blockSize=1 << 20):
+    """ SHA1 of the contents of a file, read in blocks """
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(blockSize), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def isTemporary(fileName):
+    """ Whether a file of the cache is an entry still being written: .npz.tmp
+    files of the native backend or .seg.tmp<pid> files of the Chimera script """
+    return os.path.splitext(fileName)[1].startswith('.tmp')
+
+
+class WatershedCache(object):
+    """ Content-addressed store of initial watershed regions shared by all runs
+    and projects. Entries are keyed by the hash of the input map and the
+    threshold, and the least recently used ones are evicted once the cache
+    grows beyond maxSize bytes. Native segmentations are stored as compressed
+    label arrays (.npz) and Chimera ones in Segger's .seg format. """
+
+    def __init__(self, path, maxSize):
+        self.path = path
+        self.maxSize = maxSize
+        # Concurrent runs may create it at the same time
+        os.makedirs(path, exist_ok=True)
+
+    def getKey(self, mapHash, threshold):
+        return hashlib.sha1(('%s_%r' % (mapHash, float(threshold))).encode()).hexdigest()
+
+    def getFile(self, key, ext):
+        return os.path.join(self.path, key + ext)
+
+    def lookup(self, key, ext):
+        """ Return the file of an entry, marking it as recently used, or None """
+        fn = self.getFile(key, ext)
+        if not os.path.exists(fn):
+            return None
+        os.utime(fn, None)
+        return fn
+
+    def loadRegions(self, key):
+        """ Return the (regions, peaks) stored under key or None """
+        fn = self.lookup(key, '.npz')
+        if fn is None:
+            return None
+        with np.load(fn) as entry:
+            return entry['regions'], entry['peaks']
+
+    def storeRegions(self, key, regions, peaks):
+        # Written to a temporary file and renamed, so concurrent runs never read half entries
+        fd, tmp = tempfile.mkstemp(suffix='.npz.tmp', dir=self.path)
+        with os.fdopen(fd, 'wb') as f:
+            np.savez_compressed(f, regions=regions, peaks=peaks)
+        os.rename(tmp, self.getFile(key, '.npz'))
+        self.evict()
+
+    def evict(self):
+        """ Remove the least recently used entries until the cache fits in maxSize.
+        Entries being written by other runs (.tmp files) are left alone """
+        entries = []
+        for fn in os.listdir(self.path):
+            if isTemporary(fn):
+                continue
+            fullPath = os.path.join(self.path, fn)
+            try:
+                stat = os.stat(fullPath)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, fullPath))
+        total = sum(size for _, size, _ in entries)
+        for _, size, fullPath in sorted(entries):
+            if total <= self.maxSize:
+                break
+            try:
+                os.remove(fullPath)
+            except OSError:
+                pass
+            total -= size
@@ -0,0 +1,62 @@
+# **************************************************************************
+# *
+# * Authors:     David Herreros Calero (dherreros@cnb.csic.es)
+# *
+# * BCU, Centro Nacional de Biotecnologia, CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+# Segmentation backends
+BACKEND_CHIMERA = 0
+BACKEND_NATIVE = 1
+BACKEND_NAMES = ['Chimera', 'Native']
+
+# Grouping modes
+GROUPING_SMOOTHING = 0
+GROUPING_CONNECTIVITY = 1
+
+# Output types
+OUTPUT_MASK = 0
+OUTPUT_PIECES = 1
+OUTPUT_BOTH = 2
+
+# Contents of the pieces
+PIECE_MASK = 0
+PIECE_DENSITY = 1
+PIECE_SOFT_MASK = 2
+
+# Soft edges
+EDGE_COSINE = 0
+EDGE_GAUSSIAN = 1
+
+THRESHOLD_SIGMA = 0
+THRESHOLD_PERCENTILE = 1
+
+EXECUTION_IN_MEMORY = 0
+EXECUTION_CROPPED = 1
+EXECUTION_TILED = 2
+EXECUTION_NAMES = ['in memory', 'cropped pieces', 'tiled']
+
+# Plugin variables
+SEGGER_CACHE = 'SEGGER_CACHE'
+SEGGER_CACHE_SIZE = 'SEGGER_CACHE_SIZE'
+SEGGER_WORKERS = 'SEGGER_WORKERS'
+SEGGER_WORKER_IDLE = 'SEGGER_WORKER_IDLE'
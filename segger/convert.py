@@ -0,0 +1,366 @@
+# **************************************************************************
+# *
+# * Authors:     David Herreros Calero (dherreros@cnb.csic.es)
+# *
+# * BCU, Centro Nacional de Biotecnologia, CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import mrcfile
+import numpy as np
+from scipy import ndimage
+
+from segger.constants import EDGE_COSINE, EDGE_GAUSSIAN
+
+
+MRC_MODES = {np.int8: 0, np.uint16: 6, np.float32: 2}
+
+
+def labelDtype(maxLabel):
+    """ Smallest data type able to store labels up to maxLabel in an MRC file:
+    int8 (mode 0), uint16 (mode 6) or float32 (mode 2) beyond that """
+    if maxLabel <= np.iinfo(np.int8).max:
+        return np.int8
+    if maxLabel <= np.iinfo(np.uint16).max:
+        return np.uint16
+    return np.float32
+
+
+def writeLabels(path, labels, voxelSize=None):
+    """ Write a label map (e.g. a segmentation mask) with the smallest integer type that fits it """
+    labels = np.asarray(labels)
+    with mrcfile.new(path, overwrite=True) as mrc:
+        mrc.set_data(labels.astype(labelDtype(int(labels.max()) if labels.size else 0)))
+        if voxelSize is not None:
+            mrc.voxel_size = voxelSize
+
+
+def writeMap(path, data, voxelSize=None):
+    """ Write a density map as float32 """
+    with mrcfile.new(path, overwrite=True) as mrc:
+        mrc.set_data(np.asarray(data, dtype=np.float32))
+        if voxelSize is not None:
+            mrc.voxel_size = voxelSize
+
+
+def compactLabels(path, sections=None):
+    """ Rewrite a label map stored as float (e.g. by Segger's export_mask) with
+    the smallest integer type that fits it, slab by slab """
+    with openLabels(path) as mrc:
+        data = mrc.data
+        sections = sections or data.shape[0]
+        maxLabel = max(int(np.max(data[z0:z1])) for z0, z1 in iterSlabs(0, data.shape[0], sections))
+        dtype = labelDtype(maxLabel)
+        if data.dtype == dtype:
+            return
+        tmpPath = path + '.tmp'
+        with mrcfile.new_mmap(tmpPath, data.shape, mrc_mode=MRC_MODES[dtype], overwrite=True) as out:
+            for z0, z1 in iterSlabs(0, data.shape[0], sections):
+                out.data[z0:z1] = np.rint(data[z0:z1])
+            out.voxel_size = mrc.voxel_size
+            out.header.origin = mrc.header.origin
+            out.update_header_stats()
+    os.rename(tmpPath, path)
+
+
+def fileSignature(path, *params):
+    """ Signature of a file (size and modification time) and of the parameters
+    of the outputs obtained from it, to detect outdated outputs """
+    stat = os.stat(path)
+    return ' '.join(str(value) for value in (stat.st_size, stat.st_mtime_ns) + params)
+
+
+def isMrcFile(path):
+    return os.path.splitext(path)[1].lower() in ['.mrc', '.map', '.ccp4', '.mrcs', '.st', '.rec']
+
+
+def openLabels(path):
+    """ Open a label map (MRC) memory-mapped and read-only """
+    return mrcfile.mmap(path, mode='r', permissive=True)
+
+
+def slabSections(shape, budget, bytesPerVoxel=16):
+    """ Number of Z sections processed at once so that a slab of the given
+    shape, with its temporaries (bytesPerVoxel), fits in budget bytes """
+    return int(max(1, budget // (shape[1] * shape[2] * bytesPerVoxel)))
+
+
+def iterSlabs(start, stop, sections):
+    for z0 in range(start, stop, sections):
+        yield z0, min(z0 + sections, stop)
+
+
+def regionSlices(mask, margin=0, sections=None):
+    """ Bounding box of every label of the mask, grown by margin voxels and
+    clipped to the box, computed with find_objects over slabs of the given
+    number of Z sections (the whole mask at once if None), so that a
+    memory-mapped mask is never fully loaded.
+    Returns a dictionary {label: (zSlice, ySlice, xSlice)} """
+    shape = mask.shape
+    sections = sections or shape[0]
+    lower, upper = {}, {}
+    for z0, z1 in iterSlabs(0, shape[0], sections):
+        slab = np.asarray(mask[z0:z1]).astype(np.int64)
+        for idx, box in enumerate(ndimage.find_objects(slab)):
+            if box is None:
+                continue
+            start = (box[0].start + z0, box[1].start, box[2].start)
+            stop = (box[0].stop + z0, box[1].stop, box[2].stop)
+            label = idx + 1
+            if label in lower:
+                start = np.minimum(start, lower[label])
+                stop = np.maximum(stop, upper[label])
+            lower[label], upper[label] = start, stop
+    return dict((label, tuple(slice(max(int(s) - margin, 0), min(int(e) + margin, n))
+                              for s, e, n in zip(lower[label], upper[label], shape)))
+                for label in lower)
+
+
+def writePiece(mask, label, box, path, voxelSize, fullBox=False, sections=None, origin=None):
+    """ Write the binary (int8) map of a label of the mask. The file covers the box of
+    the region, or the whole mask if fullBox, and is filled slab by slab, so
+    memory stays bounded by the number of sections per slab. origin is the
+    (x, y, z) position in Angstroms of the first voxel of the file """
+    shape = mask.shape if fullBox else tuple(s.stop - s.start for s in box)
+    offset = (0, 0, 0) if fullBox else tuple(s.start for s in box)
+    sections = sections or shape[0]
+    with mrcfile.new_mmap(path, shape, mrc_mode=MRC_MODES[np.int8], overwrite=True) as mrc:
+        for z0, z1 in iterSlabs(box[0].start, box[0].stop, sections):
+            region = np.asarray(mask[z0:z1, box[1], box[2]]) == label
+            mrc.data[z0 - offset[0]:z1 - offset[0],
+                     box[1].start - offset[1]:box[1].stop - offset[1],
+                     box[2].start - offset[2]:box[2].stop - offset[2]] = region
+        mrc.voxel_size = voxelSize
+        if origin is not None:
+            mrc.header.origin.x, mrc.header.origin.y, mrc.header.origin.z = origin
+        mrc.update_header_stats()
+
+
+def _writeRegion(path, region, shape, offset, voxelSize, origin):
+    with mrcfile.new_mmap(path, shape, mrc_mode=MRC_MODES[np.int8], overwrite=True) as mrc:
+        mrc.data[tuple(slice(o, o + n) for o, n in zip(offset, region.shape))] = region
+        mrc.voxel_size = voxelSize
+        if origin is not None:
+            mrc.header.origin.x, mrc.header.origin.y, mrc.header.origin.z = origin
+        mrc.update_header_stats()
+
+
+def writePieces(mask, boxes, paths, voxelSize, fullBox=False, sections=None, origins=None, threads=4,
+                onWritten=None):
+    """ Write the binary maps of several labels of the mask, as writePiece. The
+    regions are extracted by the calling thread while a pool of threads writes
+    the files, with at most twice as many pieces waiting as threads, so that the
+    extraction overlaps the disk writes. Regions spanning more sections than a
+    slab are written by the calling thread, slab by slab. onWritten(label) is
+    called (from the writer threads) after every piece.
+    Returns the number of pieces written """
+    sections = sections or mask.shape[0]
+    origins = origins or {}
+    threads = max(int(threads), 1)
+    pending = threading.BoundedSemaphore(2 * threads)
+    futures = []
+
+    def write(label, region, shape, offset):
+        try:
+            _writeRegion(paths[label], region, shape, offset, voxelSize, origins.get(label))
+        finally:
+            pending.release()
+        if onWritten is not None:
+            onWritten(label)
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        for label, box in boxes.items():
+            if box[0].stop - box[0].start > sections:
+                writePiece(mask, label, box, paths[label], voxelSize, fullBox=fullBox, sections=sections,
+                           origin=origins.get(label))
+                if onWritten is not None:
+                    onWritten(label)
+                continue
+            pending.acquire()
+            region = (np.asarray(mask[box]) == label).astype(np.int8)
+            shape = mask.shape if fullBox else region.shape
+            offset = tuple(s.start for s in box) if fullBox else (0, 0, 0)
+            futures.append(pool.submit(write, label, region, shape, offset))
+    for future in futures:
+        future.result()
+    return len(boxes)
+
+
+def softLabels(labels, softEdge=0.0, dilation=0.0, edgeShape=EDGE_COSINE):
+    """ Region owning every voxel of a label map and its weight: 1 inside the
+    regions dilated by dilation voxels, decaying to 0 over softEdge more voxels
+    as a raised cosine or a Gaussian (sigma softEdge / 3). Every voxel around
+    the regions belongs to the nearest one, taken from a single distance
+    transform with nearest label indices, so that the soft regions do not
+    overlap. Returns (owner, weight) """
+    labels = np.asarray(labels)
+    if (softEdge <= 0 and dilation <= 0) or not labels.any():
+        return labels, (labels > 0).astype(np.float32)
+    distance, indices = ndimage.distance_transform_edt(labels == 0, return_indices=True)
+    owner = labels[tuple(indices)]
+    weight = (distance <= dilation).astype(np.float32)
+    edge = (distance > dilation) & (distance < dilation + softEdge)
+    distance = (distance[edge] - dilation) / softEdge if softEdge > 0 else distance[edge]
+    if edgeShape == EDGE_GAUSSIAN:
+        weight[edge] = np.exp(-4.5 * distance ** 2)
+    else:
+        weight[edge] = 0.5 * (1.0 + np.cos(np.pi * distance))
+    owner[weight == 0] = 0
+    return owner, weight
+
+
+def writeMaskedPieces(mask, density, boxes, paths, voxelSize, softEdge=0.0, dilation=0.0, edgeShape=EDGE_COSINE,
+                      sections=None, origins=None, maxOpen=256):
+    """ Write the density of every region of the mask, or its soft mask if
+    density is None, dilated and with a soft edge as given in voxels (see
+    softLabels), cropped to its box. boxes, paths and origins are dictionaries
+    by label as in writePiece. Mask and density are read once, slab by slab,
+    for every group of maxOpen regions (the number of pieces filled at the
+    same time) """
+    shape = mask.shape
+    sections = sections or shape[0]
+    halo = int(np.ceil(softEdge + dilation)) + 1 if softEdge > 0 or dilation > 0 else 0
+    labels = sorted(boxes, key=lambda label: boxes[label][0].start)
+    for first in range(0, len(labels), maxOpen):
+        group = labels[first:first + maxOpen]
+        pieces = {}
+        try:
+            for label in group:
+                box = boxes[label]
+                pieces[label] = mrcfile.new_mmap(paths[label], tuple(s.stop - s.start for s in box),
+                                                 mrc_mode=MRC_MODES[np.float32], overwrite=True)
+            start = min(boxes[label][0].start for label in group)
+            stop = max(boxes[label][0].stop for label in group)
+            for z0, z1 in iterSlabs(start, stop, sections):
+                h0, h1 = max(z0 - halo, 0), min(z1 + halo, shape[0])
+                owner, weight = softLabels(mask[h0:h1], softEdge, dilation, edgeShape)
+                owner, weight = owner[z0 - h0:z1 - h0], weight[z0 - h0:z1 - h0]
+                masked = weight if density is None else np.asarray(density[z0:z1], dtype=np.float32) * weight
+                for label in group:
+                    box = boxes[label]
+                    b0, b1 = max(z0, box[0].start), min(z1, box[0].stop)
+                    if b0 >= b1:
+                        continue
+                    inside = (slice(b0 - z0, b1 - z0), box[1], box[2])
+                    pieces[label].data[b0 - box[0].start:b1 - box[0].start] = \
+                        np.where(owner[inside] == label, masked[inside], 0)
+        finally:
+            for label, mrc in pieces.items():
+                mrc.voxel_size = voxelSize
+                if origins and origins.get(label) is not None:
+                    mrc.header.origin.x, mrc.header.origin.y, mrc.header.origin.z = origins[label]
+                mrc.update_header_stats()
+                mrc.close()
+
+
+def _grow(array, size):
+    if len(array) >= size:
+        return array
+    return np.concatenate([array, np.zeros((size - len(array),) + array.shape[1:], dtype=array.dtype)])
+
+
+def _facePairs(a, b):
+    """ Different labels (both foreground) found at the same position of a and b """
+    contact = (a != b) & (a > 0) & (b > 0)
+    a, b = a[contact].astype(np.int64), b[contact].astype(np.int64)
+    return np.minimum(a, b), np.maximum(a, b)
+
+
+def regionStatistics(mask, density, sections=None):
+    """ Statistics of every label of the mask over the density map, accumulated
+    in a single pass of bincounts over slabs of the given number of Z sections
+    (the whole map at once if None). Neighbours are labels sharing a face.
+    Returns a dictionary of arrays indexed by label (0 is the background):
+    voxels, centroid (z, y, x), lower and upper (z, y, x) corners of the bounding
+    box (upper excluded), mean and max density, and the list of neighbours """
+    shape = mask.shape
+    sections = sections or shape[0]
+    voxels = np.zeros(0, dtype=np.int64)
+    coordSum = np.zeros((0, 3))
+    densitySum = np.zeros(0)
+    densityMax = np.zeros(0)
+    lower = np.zeros((0, 3), dtype=np.int64)
+    upper = np.zeros((0, 3), dtype=np.int64)
+    pairs = set()
+    previous = None
+    for z0, z1 in iterSlabs(0, shape[0], sections):
+        slab = np.asarray(mask[z0:z1]).astype(np.int64)
+        values = np.asarray(density[z0:z1], dtype=np.float64)
+        coords = np.nonzero(slab)
+        labels = slab[coords]
+        size = int(labels.max()) + 1 if labels.size else 1
+        voxels, densitySum, densityMax, coordSum, lower, upper = [
+            _grow(array, size) for array in (voxels, densitySum, densityMax, coordSum, lower, upper)]
+        voxels[:size] += np.bincount(labels, minlength=size)
+        densitySum[:size] += np.bincount(labels, weights=values[coords], minlength=size)
+        for axis, offset in enumerate((z0, 0, 0)):
+            coordSum[:size, axis] += np.bincount(labels, weights=coords[axis] + offset, minlength=size)
+        present = np.unique(labels)
+        if present.size:
+            # Labels seen for the first time in this slab have no previous max or box
+            new = voxels[present] == np.bincount(labels, minlength=size)[present]
+            slabMax = np.asarray(ndimage.maximum(values, slab, present))
+            densityMax[present] = np.where(new, slabMax, np.maximum(densityMax[present], slabMax))
+            objects = ndimage.find_objects(slab)
+            for label, isNew in zip(present, new):
+                box = objects[label - 1]
+                start = np.array([box[0].start + z0, box[1].start, box[2].start])
+                stop = np.array([box[0].stop + z0, box[1].stop, box[2].stop])
+                if not isNew:
+                    start = np.minimum(start, lower[label])
+                    stop = np.maximum(stop, upper[label])
+                lower[label], upper[label] = start, stop
+
+        faces = [(slab[1:], slab[:-1]), (slab[:, 1:], slab[:, :-1]), (slab[:, :, 1:], slab[:, :, :-1])]
+        if previous is not None:
+            faces.append((slab[:1], previous))
+        for a, b in faces:
+            first, second = _facePairs(a, b)
+            pairs.update(zip(first.tolist(), second.tolist()))
+        previous = slab[-1:]
+
+    neighbours = [[] for _ in range(len(voxels))]
+    for a, b in sorted(pairs):
+        neighbours[a].append(b)
+        neighbours[b].append(a)
+    counts = np.maximum(voxels, 1)
+    return {'voxels': voxels,
+            'centroid': coordSum / counts[:, None],
+            'lower': lower,
+            'upper': upper,
+            'meanDensity': densitySum / counts,
+            'maxDensity': densityMax,
+            'neighbours': neighbours}
+
+
+def writePseudoAtoms(path, labels, positions):
+    """ Write one pseudo-atom per label at the given (x, y, z) positions in
+    Angstroms as a PDB file. The residue number is the label """
+    with open(path, 'w') as fid:
+        for serial, (label, (x, y, z)) in enumerate(zip(labels, positions)):
+            fid.write("%-6s%5d %-4s %3s %1s%4d    %8.3f%8.3f%8.3f%6.2f%6.2f          %2s\n"
+                      % ('HETATM', (serial + 1) % 100000, ' CA', 'SEG', 'A', int(label) % 10000,
+                         x, y, z, 1.0, 0.0, 'C'))
+        fid.write("END\n")
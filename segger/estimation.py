@@ -0,0 +1,141 @@
+# **************************************************************************
+# *
+# * Authors:     David Herreros Calero (dherreros@cnb.csic.es)
+# *
+# * BCU, Centro Nacional de Biotecnologia, CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import numpy as np
+import mrcfile
+
+from segger.constants import (BACKEND_CHIMERA, BACKEND_NATIVE, GROUPING_SMOOTHING, EXECUTION_IN_MEMORY,
+                              EXECUTION_CROPPED, EXECUTION_TILED)
+
+
+MB = 1024.0 * 1024.0
+# Memory of the processes without any map (Python, NumPy and SciPy or Chimera), MB
+NATIVE_BASE = 150.0
+CHIMERA_BASE = 400.0
+# Peak bytes per voxel of the segmentation by backend and grouping mode (smoothing, connectivity),
+# measured with the native backend on synthetic maps; the Chimera ones are rougher
+NATIVE_BYTES = (37.0, 37.0)
+CHIMERA_BYTES = (28.0, 20.0)
+# Tiled watershed: bytes per voxel of the whole map and of every tile. Only the watershed is
+# tiled, the grouping (smoothing, ascent and label maps) still works on the whole map, measured
+# at 18-24 bytes per voxel on synthetic maps of 128^3 to 256^3 voxels
+TILED_BYTES = 25.0
+TILE_BYTES = 40.0
+# Projection of the coarse regions to the full resolution map (binning > 1), measured on top of
+# reading the whole map
+REFINE_BYTES = 40.0
+# Voxels segmented per second by backend and grouping mode, and slowdown of a tiled watershed
+NATIVE_RATE = (2.0e6, 4.5e6)
+CHIMERA_RATE = (1.0e6, 2.0e6)
+TILED_SPEED = 0.65
+CHIMERA_STARTUP = 15.0
+REFINE_RATE = 10.0e6
+# Voxels per second of the region statistics and meshes, and bytes per second written
+STATS_RATE = 10.0e6
+WRITE_RATE = 200.0 * MB
+# Tile sizes tried, largest first, when looking for a tiling that fits in memory
+TILE_SIZES = (256, 192, 128, 96, 64, 48, 32)
+
+
+def mapShape(path):
+    """ (z, y, x) dimensions of an MRC map, read from its header only """
+    with mrcfile.open(path, header_only=True, permissive=True) as mrc:
+        return int(mrc.header.nz), int(mrc.header.ny), int(mrc.header.nx)
+
+
+def estimateResources(shape, backend=BACKEND_CHIMERA, grouping=GROUPING_SMOOTHING, pieces=False, cropPieces=True,
+                      pieceBytes=1, numRegions=1, tiled=False, tileSize=128, tileHalo=4, threads=1, binning=1,
+                      memoryBudget=1024):
+    """ Approximate peak memory (MB) and runtime (s) of segmenting a map of the
+    given shape and writing its outputs, from per-voxel costs. The outputs are
+    processed in slabs of memoryBudget MB, but an uncropped piece (pieceBytes
+    per voxel) covers the whole map. Returns a dictionary with the memory and
+    time of the segmentation and output stages and their maximum and sum """
+    voxels = float(np.prod(shape))
+    binning = max(binning, 1) if backend == BACKEND_NATIVE else 1
+    tiled = tiled and backend == BACKEND_NATIVE
+    coarseShape = [-(-n // binning) for n in shape]
+    coarse = float(np.prod(coarseShape))
+    if backend == BACKEND_CHIMERA:
+        memory = CHIMERA_BASE + voxels * CHIMERA_BYTES[grouping] / MB
+        time = CHIMERA_STARTUP + voxels / CHIMERA_RATE[grouping]
+    else:
+        if tiled:
+            # The coarse map of a binned run is tiled as well
+            tile = float(np.prod([min(tileSize + 2 * tileHalo, n) for n in coarseShape]))
+            memory = NATIVE_BASE + (coarse * TILED_BYTES + threads * tile * TILE_BYTES) / MB
+            time = coarse / (NATIVE_RATE[grouping] * TILED_SPEED)
+        else:
+            memory = NATIVE_BASE + coarse * NATIVE_BYTES[grouping] / MB
+            time = coarse / NATIVE_RATE[grouping]
+        # The whole map is read, unless the tiles are read from the memory-mapped file
+        if not tiled or binning > 1:
+            memory += voxels * 4 / MB
+        if binning > 1:
+            memory += voxels * REFINE_BYTES / MB
+            time += voxels / REFINE_RATE
+    outputMemory = NATIVE_BASE + min(memoryBudget, voxels * 16 / MB)
+    outputTime = 2 * voxels / STATS_RATE
+    if pieces:
+        if cropPieces:
+            # The boxes of the regions roughly cover the map twice
+            written = 2 * voxels * pieceBytes
+        else:
+            outputMemory += voxels * pieceBytes / MB
+            written = numRegions * voxels * pieceBytes
+        outputTime += written / WRITE_RATE
+    return {'segmentationMemory': memory, 'segmentationTime': time,
+            'outputMemory': outputMemory, 'outputTime': outputTime,
+            'memory': max(memory, outputMemory), 'time': time + outputTime}
+
+
+def executionMode(settings):
+    """ Execution mode of the estimateResources keyword arguments """
+    if settings.get('tiled') and settings.get('backend') == BACKEND_NATIVE:
+        return EXECUTION_TILED
+    if settings.get('pieces') and settings.get('cropPieces', True):
+        return EXECUTION_CROPPED
+    return EXECUTION_IN_MEMORY
+
+
+def chooseExecutionMode(shape, memoryLimit, **settings):
+    """ First execution mode whose estimated peak memory fits in memoryLimit
+    MB: the configured one, then the whole map in memory with cropped pieces,
+    then a tiled native watershed with the largest tiles that fit. Returns the mode,
+    the settings (keyword arguments of estimateResources) changed accordingly,
+    their estimate and whether it fits. When nothing fits, the tiled mode with
+    the smallest tiles is returned """
+    candidates = [(executionMode(settings), dict(settings))]
+    if settings.get('pieces') and not settings.get('cropPieces', True):
+        candidates.append((EXECUTION_CROPPED, dict(settings, tiled=False, cropPieces=True)))
+    for tileSize in TILE_SIZES:
+        candidates.append((EXECUTION_TILED, dict(settings, backend=BACKEND_NATIVE, tiled=True, binning=1,
+                                                 cropPieces=True, tileSize=tileSize)))
+    for mode, candidate in candidates:
+        estimate = estimateResources(shape, **candidate)
+        if estimate['memory'] <= memoryLimit:
+            return mode, candidate, estimate, True
+    return mode, candidate, estimate, False
@@ -0,0 +1,177 @@
+# **************************************************************************
+# *
+# * Authors:     David Herreros Calero (dherreros@cnb.csic.es)
+# *
+# * BCU, Centro Nacional de Biotecnologia, CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+import numpy as np
+from scipy import fft
+
+
+# Chimera's molmap: sigma of the Gaussian of every atom = SIGMA_FACTOR * resolution
+SIGMA_FACTOR = 1.0 / (np.pi * np.sqrt(2.0))
+# Density of proteins, Dalton per cubic Angstrom
+PROTEIN_DENSITY = 0.81
+
+
+def axisRotation(axis, angle):
+    """ Rotation of angle radians about axis (x, y, z) """
+    axis = np.asarray(axis, dtype=np.float64)
+    x, y, z = axis / np.linalg.norm(axis)
+    c, s = np.cos(angle), np.sin(angle)
+    return np.array([[c + x * x * (1 - c), x * y * (1 - c) - z * s, x * z * (1 - c) + y * s],
+                     [y * x * (1 - c) + z * s, c + y * y * (1 - c), y * z * (1 - c) - x * s],
+                     [z * x * (1 - c) - y * s, z * y * (1 - c) + x * s, c + z * z * (1 - c)]])
+
+
+def sampleRotations(angularStep):
+    """ Rotations covering all orientations about every angularStep degrees:
+    the z axis is sent to directions spread on a Fibonacci sphere, combined
+    with in-plane rotations about it """
+    step = np.radians(angularStep)
+    numDirections = max(int(np.ceil(4 * np.pi / step ** 2)), 1)
+    numInPlane = max(int(np.ceil(2 * np.pi / step)), 1)
+    rotations = []
+    golden = np.pi * (3.0 - np.sqrt(5.0))
+    for idx in range(numDirections):
+        z = 1.0 - 2.0 * (idx + 0.5) / numDirections
+        r = np.sqrt(1.0 - z * z)
+        direction = np.array([r * np.cos(golden * idx), r * np.sin(golden * idx), z])
+        axis = np.cross([0.0, 0.0, 1.0], direction)
+        if np.linalg.norm(axis) < 1e-8:
+            tilt = np.eye(3) if z > 0 else axisRotation([1.0, 0.0, 0.0], np.pi)
+        else:
+            tilt = axisRotation(axis, np.arccos(np.clip(z, -1.0, 1.0)))
+        for psi in np.arange(numInPlane) * 2 * np.pi / numInPlane:
+            rotations.append(tilt.dot(axisRotation([0.0, 0.0, 1.0], psi)))
+    return np.array(rotations)
+
+
+def localRotations(angularStep):
+    """ Small rotations of up to angularStep degrees about x, y and z, used to
+    refine a fit """
+    angles = np.radians(angularStep) * np.array([-1.0, 0.0, 1.0])
+    return np.array([axisRotation([1, 0, 0], a).dot(axisRotation([0, 1, 0], b)).dot(axisRotation([0, 0, 1], c))
+                     for a in angles for b in angles for c in angles])
+
+
+def structureVolume(masses):
+    """ Volume (cubic Angstroms) of a protein of the given atomic masses """
+    return float(np.sum(masses)) / PROTEIN_DENSITY
+
+
+class RegionFitter(object):
+    """ Rigid-body fitting of an atomic structure into the density of a region.
+    The rotations are scored in batches: the atoms of every rotation are
+    splatted on a grid covering the region box plus the extent of the
+    structure, and the cross-correlation with the region density for all the
+    translations is obtained with FFTs, the Gaussian blur of the simulated map
+    being applied in Fourier space. The score is the correlation about zero of
+    the simulated map and the region density. """
+
+    def __init__(self, coords, weights, region, voxelSize, resolution, batchSize=8):
+        self.coords = np.asarray(coords, dtype=np.float64)
+        self.center = self.coords.mean(axis=0)
+        self.weights = np.asarray(weights, dtype=np.float32)
+        self.region = np.asarray(region, dtype=np.float32)
+        self.voxelSize = voxelSize
+        self.batchSize = max(batchSize, 1)
+        sigma = SIGMA_FACTOR * resolution / voxelSize
+        radius = np.max(np.linalg.norm(self.coords - self.center, axis=1)) / voxelSize
+        # Translations are only searched within the box, so the template never wraps onto the region
+        pad = int(np.ceil(radius + 3 * sigma)) + 2
+        self.shape = tuple(fft.next_fast_len(n + pad, real=True) for n in self.region.shape)
+        grid = np.zeros(self.shape, dtype=np.float32)
+        grid[tuple(slice(0, n) for n in self.region.shape)] = self.region
+        self.regionFft = fft.rfftn(grid)
+        self.regionNorm = float(np.sqrt(np.sum(self.region.astype(np.float64) ** 2))) or 1.0
+        fz, fy = np.fft.fftfreq(self.shape[0]), np.fft.fftfreq(self.shape[1])
+        fx = np.fft.rfftfreq(self.shape[2])
+        frequencies = fz[:, None, None] ** 2 + fy[None, :, None] ** 2 + fx[None, None, :] ** 2
+        self.blur = np.exp(-2 * np.pi ** 2 * sigma ** 2 * frequencies).astype(np.float32)
+        # Weights of the half spectrum to compute norms with Parseval's theorem
+        self.parseval = np.full(len(fx), 2.0, dtype=np.float32)
+        self.parseval[0] = 1.0
+        if self.shape[2] % 2 == 0:
+            self.parseval[-1] = 1.0
+
+    def _splat(self, rotation):
+        """ Atoms rotated about their center and splatted (trilinear) on the
+        grid, the center at voxel 0 """
+        xyz = (self.coords - self.center).dot(rotation.T) / self.voxelSize
+        zyx = xyz[:, ::-1]
+        base = np.floor(zyx).astype(np.int64)
+        frac = (zyx - base).astype(np.float32)
+        indices, weights = [], []
+        for corner in np.ndindex(2, 2, 2):
+            weight = self.weights.copy()
+            index = np.zeros(len(base), dtype=np.int64)
+            for axis, bit in enumerate(corner):
+                weight *= frac[:, axis] if bit else 1 - frac[:, axis]
+                index = index * self.shape[axis] + (base[:, axis] + bit) % self.shape[axis]
+            indices.append(index)
+            weights.append(weight)
+        grid = np.bincount(np.concatenate(indices), weights=np.concatenate(weights),
+                           minlength=int(np.prod(self.shape))).astype(np.float32)
+        return grid.reshape(self.shape)
+
+    def score(self, rotations):
+        """ Best score and translation (voxel z, y, x of the structure center in
+        the region box) of every rotation """
+        scores = np.zeros(len(rotations))
+        shifts = np.zeros((len(rotations), 3), dtype=int)
+        box = tuple(slice(0, n) for n in self.region.shape)
+        for first in range(0, len(rotations), self.batchSize):
+            batch = rotations[first:first + self.batchSize]
+            templates = fft.rfftn(np.stack([self._splat(rotation) for rotation in batch]), axes=(1, 2, 3))
+            templates *= self.blur
+            norms = np.sqrt(np.sum(np.abs(templates) ** 2 * self.parseval, axis=(1, 2, 3)) / np.prod(self.shape))
+            correlation = fft.irfftn(self.regionFft * np.conj(templates), s=self.shape, axes=(1, 2, 3))
+            for idx in range(len(batch)):
+                valid = correlation[idx][box]
+                best = np.unravel_index(np.argmax(valid), valid.shape)
+                scores[first + idx] = valid[best] / (max(norms[idx], 1e-12) * self.regionNorm)
+                shifts[first + idx] = best
+        return scores, shifts
+
+    def fit(self, rotations, refineStep=0.0, refineRounds=2):
+        """ Best rotation of rotations, refined with local rotations of
+        refineStep / 2, refineStep / 4... degrees.
+        Returns (score, 4x4 matrix) where the matrix moves the atoms (Angstroms)
+        into the region box, the first voxel at 0 """
+        scores, shifts = self.score(rotations)
+        best = int(np.argmax(scores))
+        score, rotation, shift = scores[best], rotations[best], shifts[best]
+        step = refineStep
+        for _ in range(refineRounds if refineStep > 0 else 0):
+            step /= 2.0
+            candidates = np.array([rotation.dot(local) for local in localRotations(step)])
+            scores, shifts = self.score(candidates)
+            best = int(np.argmax(scores))
+            if scores[best] > score:
+                score, rotation, shift = scores[best], candidates[best], shifts[best]
+        matrix = np.eye(4)
+        matrix[:3, :3] = rotation
+        matrix[:3, 3] = shift[::-1] * self.voxelSize - rotation.dot(self.center)
+        return float(score), matrix
@@ -0,0 +1,119 @@
+# **************************************************************************
+# *
+# * Authors:     David Herreros Calero (dherreros@cnb.csic.es)
+# *
+# * BCU, Centro Nacional de Biotecnologia, CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+import os
+
+import numpy as np
+from scipy import ndimage
+from skimage.measure import marching_cubes
+
+from segger.convert import regionSlices
+
+
+# Chimera script showing the meshes of every file of meshFiles (written before
+# it) as one surface model per file, with a piece per region
+MESH_SCRIPT = """
+import os
+import numpy
+import chimera
+import _surface
+
+for meshFile in meshFiles:
+    meshes = numpy.load(meshFile)
+    model = _surface.SurfaceModel()
+    model.name = os.path.basename(meshFile)
+    vertexOffsets, triangleOffsets = meshes['vertexOffsets'], meshes['triangleOffsets']
+    for idx, regionId in enumerate(meshes['ids']):
+        vertices = numpy.array(meshes['vertices'][vertexOffsets[idx]:vertexOffsets[idx + 1]], numpy.float32)
+        triangles = numpy.array(meshes['triangles'][triangleOffsets[idx]:triangleOffsets[idx + 1]], numpy.int32)
+        color = numpy.random.RandomState(int(regionId)).uniform(0.2, 1.0, 3).tolist() + [1.0]
+        piece = model.addPiece(vertices, triangles, color)
+        piece.oslName = 'region %d' % regionId
+    chimera.openModels.add([model])
+"""
+
+
+def regionMeshes(mask, voxelSize, origin=(0, 0, 0), step=2, sections=None):
+    """ Surface mesh of every label of the mask, obtained with marching cubes
+    over the (slightly smoothed) region in its bounding box only. The mesh is
+    decimated by sampling the box every step voxels. Vertices are (x, y, z)
+    positions in Angstroms, origin being the position of the first voxel.
+    Yields (label, vertices, triangles) """
+    for label, box in sorted(regionSlices(mask, 1, sections).items()):
+        region = np.pad((np.asarray(mask[box]) == label).astype(np.float32), step)
+        region = ndimage.gaussian_filter(region, 1.0)
+        try:
+            vertices, triangles, _, _ = marching_cubes(region, level=0.5, step_size=step,
+                                                       allow_degenerate=False)
+        except (ValueError, RuntimeError):
+            # Regions too thin to cross the level
+            continue
+        vertices += np.array([s.start for s in box]) - step
+        vertices = vertices[:, ::-1] * voxelSize + np.asarray(origin)
+        yield label, vertices.astype(np.float32), triangles.astype(np.int32)
+
+
+def writeMeshes(path, meshes, signature=''):
+    """ Store meshes as (label, vertices, triangles) in a single compressed
+    file, concatenated and with the offsets of every region """
+    ids, vertices, triangles = [], [], []
+    for label, regionVertices, regionTriangles in meshes:
+        ids.append(label)
+        vertices.append(regionVertices)
+        triangles.append(regionTriangles)
+    np.savez_compressed(path + '.tmp.npz',
+                        ids=np.array(ids, dtype=np.int32),
+                        vertexOffsets=np.cumsum([0] + [len(v) for v in vertices]).astype(np.int64),
+                        triangleOffsets=np.cumsum([0] + [len(t) for t in triangles]).astype(np.int64),
+                        vertices=np.concatenate(vertices) if vertices else np.zeros((0, 3), np.float32),
+                        triangles=np.concatenate(triangles) if triangles else np.zeros((0, 3), np.int32),
+                        signature=np.array(signature))
+    os.rename(path + '.tmp.npz', path)
+
+
+def readMeshes(path):
+    """ Meshes written by writeMeshes, as a list of (label, vertices, triangles) """
+    with np.load(path) as data:
+        vertexOffsets, triangleOffsets = data['vertexOffsets'], data['triangleOffsets']
+        return [(int(label), data['vertices'][vertexOffsets[idx]:vertexOffsets[idx + 1]],
+                 data['triangles'][triangleOffsets[idx]:triangleOffsets[idx + 1]])
+                for idx, label in enumerate(data['ids'])]
+
+
+def isMeshCacheValid(path, signature):
+    """ Whether the meshes of path were computed for this signature """
+    if not os.path.exists(path):
+        return False
+    with np.load(path) as data:
+        return str(data['signature']) == signature
+
+
+def writeMeshScript(scriptFile, meshFiles):
+    """ Write the Chimera script showing the meshes of meshFiles """
+    with open(scriptFile, 'w') as f:
+        f.write('meshFiles = %s\n' % repr([os.path.abspath(path) for path in meshFiles]))
+        f.write(MESH_SCRIPT)
@@ -0,0 +1,102 @@
+# **************************************************************************
+# *
+# * Authors:     David Herreros Calero (dherreros@cnb.csic.es)
+# *
+# * BCU, Centro Nacional de Biotecnologia, CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+import json
+import time
+import resource
+from contextlib import contextmanager
+
+
+def cpuTime():
+    """ User + system CPU time of this process and its finished children """
+    t = os.times()
+    return t[0] + t[1] + t[2] + t[3]
+
+
+def peakRss():
+    """ Peak resident memory of this process, in MB """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+class StageTimer(object):
+    """ Wall time, CPU time and peak RSS of the stages of a run. Every stage
+    is a dictionary with its name, the volume it refers to (if any) and the
+    measures, the same records are written by the Chimera script. """
+
+    def __init__(self, stages=None):
+        self.stages = list(stages or [])
+
+    @contextmanager
+    def stage(self, name, volume=''):
+        wall, cpu = time.time(), cpuTime()
+        try:
+            yield
+        finally:
+            self.add(name, volume, time.time() - wall, cpuTime() - cpu, peakRss())
+
+    def add(self, name, volume, wall, cpu, peakRss):
+        self.stages.append({'stage': name, 'volume': volume, 'wall': wall, 'cpu': cpu, 'peakRss': peakRss})
+
+    def extend(self, stages, volume=None):
+        """ Add the stages recorded by another timer (e.g. the Chimera script),
+        optionally assigning them a volume """
+        for entry in stages:
+            entry = dict(entry)
+            if volume is not None:
+                entry['volume'] = volume
+            self.stages.append(entry)
+
+    def totals(self):
+        """ Stages merged by name, in order of appearance: summed wall and CPU
+        times and maximum peak RSS """
+        totals = []
+        byName = {}
+        for entry in self.stages:
+            if entry['stage'] not in byName:
+                byName[entry['stage']] = {'stage': entry['stage'], 'wall': 0.0, 'cpu': 0.0, 'peakRss': 0.0}
+                totals.append(byName[entry['stage']])
+            total = byName[entry['stage']]
+            total['wall'] += entry['wall']
+            total['cpu'] += entry['cpu']
+            total['peakRss'] = max(total['peakRss'], entry['peakRss'])
+        return totals
+
+    @classmethod
+    def load(cls, path):
+        if not os.path.exists(path):
+            return cls()
+        with open(path) as fid:
+            return cls(json.load(fid)['stages'])
+
+    def save(self, path, **info):
+        """ Write the stages and their totals as JSON, with any extra info
+        (e.g. plugin version and backend) to compare runs """
+        report = dict(info)
+        report['stages'] = self.stages
+        report['totals'] = self.totals()
+        with open(path, 'w') as fid:
+            json.dump(report, fid, indent=2)
@@ -24,4 +24,7 @@
 # *
 # **************************************************************************
 
-from .protocol_segment_map import ProtSegmentMap
\ No newline at end of file
+from .protocol_segment_map import ProtSegmentMap
+from .protocol_segment_sweep import ProtSegmentSweep
+from .protocol_segment_regroup import ProtSegmentRegroup
+from .protocol_segment_fit import ProtSegmentFit
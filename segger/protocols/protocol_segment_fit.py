@@ -0,0 +1,236 @@
+# **************************************************************************
+# *
+# * Authors:     David Herreros Calero (dherreros@cnb.csic.es)
+# *
+# * BCU, Centro Nacional de Biotecnologia, CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+import os
+import csv
+import json
+import numpy as np
+
+from pwem.objects import AtomStruct, SetOfAtomStructs
+from pwem.protocols import EMProtocol
+from pwem.emlib.image import ImageHandler
+from pwem.convert.atom_struct import AtomicStructHandler
+
+import pyworkflow.protocol.params as params
+from pyworkflow.object import Integer, Float, String
+from pyworkflow.protocol.constants import STEPS_PARALLEL
+
+from segger.convert import isMrcFile, openLabels
+from segger.fitting import RegionFitter, sampleRotations, structureVolume
+
+
+class ProtSegmentFit(EMProtocol):
+    """Protocol to fit atomic structures (e.g. chains or domains) as rigid bodies
+    into the regions of a segmentation. For every candidate region, all the
+    rotations are scored in batches with FFT cross-correlation restricted to the
+    region box, and the best fit is refined locally. Regions are fitted in
+    parallel when several threads are used and the best fits of every structure
+    are registered with their scores."""
+    _label = 'fit to segments'
+
+    def __init__(self, **kwargs):
+        EMProtocol.__init__(self, **kwargs)
+        self.stepsExecutionMode = STEPS_PARALLEL
+
+    # --------------------------- DEFINE param functions ----------------------
+    def _defineParams(self, form):
+        form.addSection(label='Input data')
+        form.addParam('inputGroups', params.PointerParam, pointerClass='SetOfVolumes',
+                      label='Segmented regions', important=True,
+                      help='Pieces of a segmentation (outputGroups of "segment map"). The density of every '
+                           'region is taken from the input map inside the non zero voxels of its piece')
+        form.addParam('inputVolume', params.PointerParam, pointerClass='Volume',
+                      label='Map', important=True,
+                      help='Map that was segmented')
+        form.addParam('inputStructures', params.PointerParam, pointerClass='AtomStruct,SetOfAtomStructs',
+                      label='Atomic structures', important=True,
+                      help='Structures (e.g. chains or domains) to fit into the regions')
+        form.addSection(label='Fitting')
+        form.addParam('resolution', params.FloatParam, default=5.0, label='Resolution (A)',
+                      help='Resolution of the maps simulated from the structures')
+        form.addParam('angularStep', params.FloatParam, default=20.0, label='Angular step (deg)',
+                      help='Sampling of the global rotational search. The best rotation is then refined '
+                           'locally with finer steps')
+        form.addParam('sizeRatio', params.FloatParam, default=2.0, label='Maximum size ratio',
+                      help='Only the regions whose volume is within this factor of the volume of a structure '
+                           '(estimated from its mass) are fitted with it. 0 fits every structure in every region')
+        form.addParam('numberOfFits', params.IntParam, default=1, label='Fits kept per structure',
+                      help='Number of best scoring fits (in different regions) registered for every structure')
+        form.addParam('batchSize', params.IntParam, default=8, expertLevel=params.LEVEL_ADVANCED,
+                      label='Rotations per batch',
+                      help='Number of rotations scored together, memory grows with it')
+        form.addParallelSection(threads=4, mpi=0)
+
+    # --------------------------- INSERT steps functions ----------------------
+    def _insertAllSteps(self):
+        convertStep = self._insertFunctionStep('convertInputStep')
+        fitSteps = []
+        for regionId in self.inputGroups.get().getIdSet():
+            fitSteps.append(self._insertFunctionStep('fitStep', regionId, prerequisites=[convertStep]))
+        self._insertFunctionStep('createOutputStep', prerequisites=fitSteps)
+
+    # --------------------------- STEPS functions -----------------------------
+    def convertInputStep(self):
+        """ Atom coordinates and masses of every structure and the file and origin
+        of every region, read once so that the fitting steps only read files """
+        regions = {}
+        for piece in self.inputGroups.get().iterItems():
+            regions[piece.getObjId()] = {'file': os.path.abspath(piece.getFileName()),
+                                         'origin': list(piece.getOrigin(force=True).getShifts())}
+        with open(self._getRegionsFile(), 'w') as fid:
+            json.dump(regions, fid)
+        for structId, structure in self._iterStructures():
+            atoms = list(AtomicStructHandler(structure.getFileName()).getStructure()[0].get_atoms())
+            np.savez(self._getAtomsFile(structId),
+                     coords=np.array([atom.get_coord() for atom in atoms], dtype=np.float64),
+                     masses=np.array([atom.mass for atom in atoms], dtype=np.float64))
+
+    def fitStep(self, regionId):
+        """ Fit every candidate structure into a region. Steps are independent,
+        so Scipion runs as many of them at once as threads are given """
+        with open(self._getRegionsFile()) as fid:
+            piece = json.load(fid)[str(regionId)]
+        region, origin = self._getRegionDensity(piece['file'], piece['origin'])
+        sr = self.inputVolume.get().getSamplingRate()
+        regionVolume = np.count_nonzero(region) * sr ** 3
+        rotations = sampleRotations(self.angularStep.get())
+        fits = []
+        for structId, _ in self._iterStructures():
+            atoms = np.load(self._getAtomsFile(structId))
+            volumeRatio = regionVolume / structureVolume(atoms['masses'])
+            ratio = self.sizeRatio.get()
+            if ratio > 0 and not 1.0 / ratio <= volumeRatio <= ratio:
+                continue
+            fitter = RegionFitter(atoms['coords'], atoms['masses'], region, sr, self.resolution.get(),
+                                  batchSize=self.batchSize.get())
+            score, matrix = fitter.fit(rotations, refineStep=self.angularStep.get())
+            matrix[:3, 3] += origin
+            fits.append({'structure': structId, 'region': regionId, 'score': score,
+                         'volumeRatio': volumeRatio, 'matrix': matrix.tolist()})
+        with open(self._getRegionFitsFile(regionId), 'w') as fid:
+            json.dump(fits, fid)
+
+    def createOutputStep(self):
+        fits = []
+        for regionId in self.inputGroups.get().getIdSet():
+            with open(self._getRegionFitsFile(regionId)) as fid:
+                fits.extend(json.load(fid))
+        fits.sort(key=lambda fit: -fit['score'])
+        self._writeFitsTable(fits)
+
+        setFits = self._createSetOfPDBs(suffix='Fits')
+        for structId, structure in self._iterStructures():
+            best = [fit for fit in fits if fit['structure'] == structId][:max(self.numberOfFits.get(), 1)]
+            for rank, fit in enumerate(best, 1):
+                handler = AtomicStructHandler(structure.getFileName())
+                handler.transform(np.array(fit['matrix']))
+                fitFile = self._getFitFile(structure, structId, fit['region'])
+                handler.write(fitFile)
+                atomStruct = AtomStruct(filename=fitFile)
+                atomStruct._structureId = Integer(structId)
+                atomStruct._regionId = Integer(fit['region'])
+                atomStruct._fitScore = Float(fit['score'])
+                atomStruct._fitRank = Integer(rank)
+                atomStruct._transform = String(' '.join('%g' % v for v in np.ravel(fit['matrix'])))
+                setFits.append(atomStruct)
+
+        self._defineOutputs(outputFits=setFits)
+        self._defineSourceRelation(self.inputGroups, setFits)
+        self._defineSourceRelation(self.inputStructures, setFits)
+
+    # --------------------------- UTILS functions ----------------------------
+    def _iterStructures(self):
+        """ Iterate over (id, structure) of the input structures, id 1 for a single one """
+        structures = self.inputStructures.get()
+        if isinstance(structures, SetOfAtomStructs):
+            for structure in structures.iterItems():
+                yield structure.getObjId(), structure.clone()
+        else:
+            yield 1, structures
+
+    def _getRegionDensity(self, pieceFile, origin):
+        """ Density of the map inside a piece, cropped to the box of the piece,
+        and the position (x, y, z) in Angstroms of its first voxel. origin is the
+        position of the first voxel of the piece """
+        inputVolume = self.inputVolume.get()
+        sr = inputVolume.getSamplingRate()
+        mapOrigin = np.array(inputVolume.getOrigin(force=True).getShifts())
+        mask = ImageHandler().read(pieceFile).getData()
+        start = np.rint((np.array(origin) - mapOrigin) / sr).astype(int)[::-1]
+        box = tuple(slice(s, s + n) for s, n in zip(start, mask.shape))
+        if isMrcFile(inputVolume.getFileName()):
+            with openLabels(inputVolume.getFileName()) as mrc:
+                density = np.array(mrc.data[box], dtype=np.float32)
+        else:
+            density = ImageHandler().read(inputVolume).getData()[box].astype(np.float32)
+        mask = mask[tuple(slice(0, n) for n in density.shape)]
+        return np.where(mask != 0, density, 0), mapOrigin + start[::-1] * sr
+
+    def _getRegionsFile(self):
+        return self._getTmpPath('regions.json')
+
+    def _getAtomsFile(self, structId):
+        return self._getTmpPath('atoms_%d.npz' % structId)
+
+    def _getRegionFitsFile(self, regionId):
+        return self._getTmpPath('fits_region_%d.json' % regionId)
+
+    def _getFitsFile(self):
+        return self._getExtraPath('fits.csv')
+
+    def _getFitFile(self, structure, structId, regionId):
+        base, ext = os.path.splitext(os.path.basename(structure.getFileName()))
+        return self._getExtraPath('%s_%d_region_%d%s' % (base, structId, regionId, ext))
+
+    def _writeFitsTable(self, fits):
+        with open(self._getFitsFile(), 'w') as fid:
+            writer = csv.writer(fid)
+            writer.writerow(['structure', 'region', 'score', 'volume_ratio'])
+            for fit in fits:
+                writer.writerow([fit['structure'], fit['region'], '%0.4f' % fit['score'],
+                                 '%0.3f' % fit['volumeRatio']])
+
+    # --------------------------- DEFINE info functions ----------------------
+    def _validate(self):
+        errors = []
+        if self.angularStep.get() <= 0:
+            errors.append('The angular step must be positive')
+        if self.resolution.get() <= 0:
+            errors.append('The resolution must be positive')
+        return errors
+
+    def _summary(self):
+        summary = []
+        if self.getOutputsSize() >= 1:
+            summary.append("%d fits registered, all scores stored in %s\n"
+                           % (len(self.outputFits), self._getFitsFile()))
+            for fit in self.outputFits:
+                summary.append("Structure %d in region %d: score %0.3f\n"
+                               % (fit._structureId.get(), fit._regionId.get(), fit._fitScore.get()))
+        else:
+            summary.append("Fitting not ready yet.")
+        return summary
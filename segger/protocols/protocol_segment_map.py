@@ -25,19 +25,180 @@
 # **************************************************************************
 
 import os
+import csv
+import json
+import time
+import threading
+from contextlib import contextmanager
 import numpy as np
 
-from pwem.objects import Volume
+from pwem.objects import Volume, SetOfVolumes, Transform, AtomStruct, SetOfAtomStructs
 from pwem.protocols import EMProtocol
+from pwem.constants import SCIPION_SYM_NAME, SYM_CYCLIC, SYM_DIHEDRAL_Y, SYM_I2n5r
 from pwem.emlib.image import ImageHandler
 
 import pyworkflow.protocol.params as params
 import pyworkflow.utils as pwutils
+from pyworkflow.object import Integer, Float, String, Set
+from pyworkflow.protocol.constants import STEPS_PARALLEL, STATUS_NEW
 
-from pwem.viewers.viewer_chimera import Chimera
 
-from segger import Plugin
-from chimera import Plugin as chimera
+from segger import Plugin, __version__
+from segger.constants import *
+from segger.segmentation import segmentMap, MergeTree, labelAgreement, mapStatistics
+from segger.symmetry import getRotations, symmetryCells, asymmetricUnitMask, keepAsymmetricRegions, expandSymmetry
+from segger.convert import (writeLabels, writeMap, compactLabels, openLabels, isMrcFile, slabSections, regionSlices,
+                            writePieces, writeMaskedPieces, regionStatistics, fileSignature, writePseudoAtoms)
+from segger.cache import fileHash
+from segger.meshes import isMeshCacheValid, regionMeshes, writeMeshes
+from segger.profiling import StageTimer, peakRss
+from segger.estimation import mapShape, estimateResources, executionMode, chooseExecutionMode
+
+
+# Files of the output sets of a set of volumes, filled in streaming
+MASKS_SET = 'volumesMasks.sqlite'
+PIECES_SET = 'volumes.sqlite'
+CENTROIDS_SET = 'atomstructsCentroids.sqlite'
+
+
+# Body of the script run by Chimera. The parameters and the list of jobs, tuples
+# (input map, output mask, output segmentation, cached watershed or '' and
+# optionally the threshold of that map), are written before it. When timingFile is given, the wall time, CPU time and peak
+# RSS of every stage are written there as JSON, the volume being the job index
+CHIMERA_SCRIPT = """
+import os
+import time
+import json
+import resource
+import numpy
+import chimera
+import VolumeViewer
+import regions
+import Segger
+from segcmd import export_mask
+from segfile import write_segmentation, read_segmentation
+
+scriptStart = time.time()
+stages = []
+
+
+class stage(object):
+    def __init__(self, name, job):
+        self.name = name
+        self.job = job
+
+    def __enter__(self):
+        self.wall = time.time()
+        self.cpu = sum(os.times()[:4])
+
+    def __exit__(self, *args):
+        stages.append({'stage': self.name, 'volume': self.job,
+                       'wall': time.time() - self.wall,
+                       'cpu': sum(os.times()[:4]) - self.cpu,
+                       'peakRss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0})
+
+
+def segment(job, dmap, outMask, outSeg, cacheFile, threshold):
+    if threshold is None:
+        with stage('threshold', job):
+            M = dmap.data.full_matrix()
+            threshold = numpy.average(M) + numpy.std(M) * 3.0
+    if cacheFile and os.path.exists(cacheFile):
+        # Initial watershed regions computed by a previous run for the same map and threshold
+        with stage('watershed cache lookup', job):
+            os.utime(cacheFile, None)
+            smod = read_segmentation(cacheFile, open=False)
+            smod.set_volume_data(dmap)
+    else:
+        with stage('watershed', job):
+            smod = regions.Segmentation(dmap.name, dmap)
+            smod.calculate_watershed_regions(dmap, threshold)
+        if cacheFile:
+            with stage('watershed cache store', job):
+                write_segmentation(smod, path=cacheFile + '.tmp%d' % os.getpid())
+                os.rename(cacheFile + '.tmp%d' % os.getpid(), cacheFile)
+    if minRegionSize > 1:
+        with stage('remove small regions', job):
+            smod.remove_small_regions(minRegionSize)
+    if minContactVoxels > 0:
+        with stage('remove contact regions', job):
+            smod.remove_contact_regions(minContactVoxels)
+    with stage('grouping', job):
+        if groupingMode == "smoothing":
+            smod.smooth_and_group(numSmoothingSteps, smoothingStepSize, stopAtNumberOfRegions)
+        elif groupingMode == "connectivity":
+            smod.group_connected_n(numConnectivitySteps, stopAtNumberOfRegions)
+    if exportMask:
+        with stage('mask export', job):
+            export_mask(smod, savePath=outMask)
+    with stage('seg export', job):
+        write_segmentation(smod, path=outSeg)
+
+
+# Maps are opened chunkSize at a time and closed once segmented to bound memory
+for start in range(0, len(jobs), chunkSize):
+    chunk = []
+    for job, entry in enumerate(jobs[start:start + chunkSize], start):
+        inputPath, outMask, outSeg, cacheFile = entry[:4]
+        threshold = entry[4] if len(entry) > 4 else mapThreshold
+        with stage('map open', job):
+            models = chimera.openModels.open(inputPath)
+        dmap = [m for m in models if isinstance(m, VolumeViewer.volume.Volume)][0]
+        chunk.append((job, dmap, outMask, outSeg, cacheFile, threshold))
+    for job, dmap, outMask, outSeg, cacheFile, threshold in chunk:
+        segment(job, dmap, outMask, outSeg, cacheFile, threshold)
+    chimera.openModels.close(chimera.openModels.list())
+
+if timingFile:
+    with open(timingFile, 'w') as fid:
+        json.dump({'started': scriptStart, 'stages': stages}, fid)
+"""
+
+
+def writeChimeraScript(scriptFile, jobs, chunkSize=1, threshold=None, groupingMode=GROUPING_SMOOTHING,
+                       minRegionSize=1, minContactVoxels=0, stopAtNumberOfRegions=1, numSmoothingSteps=4,
+                       smoothingStepSize=3, numConnectivitySteps=10, exportMask=True, timingFile=''):
+    """ Write the Chimera script segmenting every (input map, output mask, output
+    segmentation, cached watershed) of jobs with the given parameters. The
+    cached watershed file is read if it exists and written otherwise, an empty
+    path disables the cache for that job. A fifth item overrides the threshold
+    for that job. Without threshold (None) Chimera uses mean + 3 * std; any
+    other value, negative ones included, is used as given. When exportMask is False only the
+    segmentations are written. The stages of the script are timed into
+    timingFile if given. """
+    if groupingMode == GROUPING_SMOOTHING:
+        groupMode = 'smoothing'
+    else:
+        groupMode = 'connectivity'
+
+    jobs = [tuple(os.path.abspath(path) if path else '' for path in job[:4]) + tuple(job[4:]) for job in jobs]
+    contents = 'jobs = %s\n' \
+               'chunkSize = %d\n' \
+               'groupingMode = "%s"\n' \
+               'minRegionSize = %d\n' \
+               'minContactVoxels = %d\n' \
+               'stopAtNumberOfRegions = %d\n' \
+               'mapThreshold = %r\n' \
+               'numSmoothingSteps = %d\n' \
+               'smoothingStepSize = %d\n' \
+               'numConnectivitySteps = %d\n' \
+               'exportMask = %s\n' \
+               'timingFile = %s\n' % \
+               (repr(jobs), max(chunkSize, 1), groupMode, minRegionSize, minContactVoxels,
+                stopAtNumberOfRegions, None if threshold is None else float(threshold), numSmoothingSteps,
+                smoothingStepSize, numConnectivitySteps, bool(exportMask),
+                repr(os.path.abspath(timingFile) if timingFile else ''))
+
+    f = open(scriptFile, "w")
+    f.write(contents)
+    f.write(CHIMERA_SCRIPT)
+    f.close()
+
+
+def runChimeraScript(scriptFile):
+    """ Run a script in a headless Chimera, or in a persistent worker if enabled """
+    args = '--nogui --silent --nostatus --script %s' % os.path.abspath(scriptFile)
+    Plugin.runChimeraProgram(Plugin.getProgram(), args)
 
 
 class ProtSegmentMap(EMProtocol):
@@ -49,13 +210,66 @@ class ProtSegmentMap(EMProtocol):
 
     def __init__(self, **kwargs):
         EMProtocol.__init__(self, **kwargs)
+        self.stepsExecutionMode = STEPS_PARALLEL
+        self._lock = threading.Lock()
 
     # --------------------------- DEFINE param functions ----------------------
     def _defineParams(self, form):
         form.addSection(label='Input data')
-        form.addParam('inputVolume', params.PointerParam, pointerClass='Volume', label='Input volume', important=True,
-                      help='Select a Volume to be segmented')
+        form.addParam('inputVolume', params.PointerParam, pointerClass='Volume,SetOfVolumes',
+                      label='Input volume(s)', important=True,
+                      help='Select a Volume or a SetOfVolumes to be segmented. Sets are processed in streaming: '
+                           'the volumes found at every check of the input are segmented in the same Chimera '
+                           'session and appended to the outputs, until the input set is closed')
+        form.addParam('chunkSize', params.IntParam, default=10, expertLevel=params.LEVEL_ADVANCED,
+                      label='Volumes opened at once',
+                      help='When segmenting a SetOfVolumes, Chimera opens this number of volumes at a time and '
+                           'closes them once segmented, which keeps memory bounded')
         form.addSection(label='Mode')
+        form.addParam('backend', params.EnumParam, choices=BACKEND_NAMES, default=BACKEND_CHIMERA,
+                      label='Segmentation backend', display=params.EnumParam.DISPLAY_HLIST,
+                      help='Chimera: run Segger inside a headless Chimera session\n'
+                           'Native: run the watershed and grouping inside the protocol with NumPy/SciPy, '
+                           'avoiding the Chimera startup and map loading')
+        form.addParam('useCache', params.BooleanParam, default=True, expertLevel=params.LEVEL_ADVANCED,
+                      label='Reuse cached watershed regions?',
+                      help='The initial watershed regions only depend on the map and the threshold. They are '
+                           'kept in a cache shared by all the runs (see the SEGGER_CACHE and SEGGER_CACHE_SIZE '
+                           'variables), so runs differing only in the filtering or grouping parameters skip '
+                           'the watershed')
+        form.addParam('tiled', params.BooleanParam, default=False, condition='backend == %d' % BACKEND_NATIVE,
+                      label='Tiled watershed?',
+                      help='Split the map into overlapping tiles that are segmented independently, in parallel '
+                           'over the threads of the protocol, and stitch their regions back together. The result '
+                           'is the same as segmenting the whole map, but MRC maps are read memory-mapped and only '
+                           'one tile per thread is held in memory during the watershed. The grouping still '
+                           'works on the whole map, so the peak memory is roughly halved, not bounded by the tiles')
+        form.addParam('tileSize', params.IntParam, default=128, condition='backend == %d and tiled' % BACKEND_NATIVE,
+                      expertLevel=params.LEVEL_ADVANCED, label='Tile size (voxels)')
+        form.addParam('tileHalo', params.IntParam, default=4, condition='backend == %d and tiled' % BACKEND_NATIVE,
+                      expertLevel=params.LEVEL_ADVANCED, label='Tile overlap (voxels)',
+                      help='Voxels shared with every neighbouring tile (at least 2)')
+        form.addParam('binning', params.IntParam, default=1, condition='backend == %d' % BACKEND_NATIVE,
+                      label='Coarse-to-fine binning factor',
+                      help='Segment the map binned by this factor and project the regions back to the full '
+                           'resolution map, where only the voxels close to a region border are recomputed. Region '
+                           'sizes and smoothing steps are scaled by the factor. Much faster for large, low '
+                           'resolution maps (1 segments the map at full resolution)')
+        form.addParam('compareFullResolution', params.BooleanParam, default=False,
+                      condition='backend == %d and binning > 1' % BACKEND_NATIVE, expertLevel=params.LEVEL_ADVANCED,
+                      label='Compare with full resolution?',
+                      help='Also segment every map at full resolution and report the time taken by both and the '
+                           'agreement of their regions in the summary')
+        form.addParam('autoMode', params.BooleanParam, default=False, label='Choose the execution mode automatically?',
+                      help='Estimate the peak memory of the run from the dimensions in the map header and, if '
+                           'the settings above (and the piece cropping) would exceed the memory limit, crop the '
+                           'pieces or else switch to a tiled watershed with the native backend, with the largest '
+                           'tiles that fit. When disabled, the settings above are always used and the mode that '
+                           'would fit is only suggested in a warning. The estimate, the mode and the backend '
+                           'used are shown in the summary')
+        form.addParam('memoryLimit', params.FloatParam, default=16.0, label='Memory limit (GB)',
+                      help='Memory available to the run (e.g. in a node of the queue). Launching a run estimated '
+                           'to need more shows a warning')
         form.addParam('grouping', params.EnumParam, choices=['Smoothing', 'Connectivity'], default=0,
                       label='Grouping mode', display=params.EnumParam.DISPLAY_HLIST,
                       help='smoothing tends to work better at lower resolutions (4A and lower)\n'
@@ -76,133 +290,1015 @@ class ProtSegmentMap(EMProtocol):
                       help='0 means no regions are removed')
         form.addParam('stopGroup', params.IntParam, default=1, label='Stop grouping',
                       help='When to stop the grouping process')
+        form.addParam('recordHierarchy', params.BooleanParam, default=True, expertLevel=params.LEVEL_ADVANCED,
+                      label='Record the complete hierarchy?',
+                      help='Go on grouping until a single region is left and store the whole merge tree in the '
+                           '.seg file. The mask is then obtained by stopping the tree at the requested number of '
+                           'regions, and the "regroup segmentation" protocol can cut it at any other number of '
+                           'regions without segmenting again')
         form.addParam('mapThreshold', params.FloatParam, default=-1, label='Map threshold',
-                      help='Only include voxels with map value above this values (by default, 3sigma above mean will be used')
+                      help='Only include voxels with map value above this values (by default, 3sigma above mean will be used). '
+                           'The wizard previews the approximate number of regions for several automatic '
+                           'thresholds and selects the chosen one')
+        form.addParam('thresholdMode', params.EnumParam, choices=['Sigma', 'Percentile'], default=THRESHOLD_SIGMA,
+                      condition='mapThreshold < 0', display=params.EnumParam.DISPLAY_HLIST,
+                      label='Automatic threshold',
+                      help='Threshold used when none is given, computed from the statistics of the map '
+                           'accumulated in a single pass over it: the mean plus a number of standard deviations, '
+                           'or a percentile of the map values')
+        form.addParam('thresholdSigma', params.FloatParam, default=3.0,
+                      condition='mapThreshold < 0 and thresholdMode == %d' % THRESHOLD_SIGMA,
+                      label='Standard deviations above the mean')
+        form.addParam('thresholdPercentile', params.FloatParam, default=99.0,
+                      condition='mapThreshold < 0 and thresholdMode == %d' % THRESHOLD_PERCENTILE,
+                      label='Percentile of the map values')
+        form.addParam('applySymmetry', params.BooleanParam, default=False, label='Use map symmetry?',
+                      help='Segment only the asymmetric unit of a symmetric map (plus a margin) and obtain the '
+                           'regions of the rest of the map by applying the symmetry operators. Region i of the '
+                           'asymmetric unit is labelled k * N + i in the k-th symmetry copy, N being the number '
+                           'of regions of the asymmetric unit, where the grouping also stops. The symmetry axes go '
+                           'through the center of the box')
+        form.addParam('symmetryGroup', params.EnumParam, condition='applySymmetry',
+                      choices=[SCIPION_SYM_NAME[sym] for sym in range(SYM_I2n5r + 1)], default=SYM_CYCLIC,
+                      label='Symmetry group',
+                      help='Symmetry group of the map, using the Scipion conventions: '
+                           'https://scipion-em.github.io/docs/docs/developer/symmetries')
+        form.addParam('symmetryOrder', params.IntParam, default=1,
+                      condition='applySymmetry and symmetryGroup <= %d' % SYM_DIHEDRAL_Y,
+                      label='Symmetry order', help='Order of the cyclic or dihedral symmetry')
+        form.addParam('symmetryMargin', params.FloatParam, default=10.0, condition='applySymmetry',
+                      expertLevel=params.LEVEL_ADVANCED, label='Asymmetric unit margin (A)',
+                      help='Density around the asymmetric unit that is also segmented, so that the regions '
+                           'crossing its border are kept whole. Regions having more voxels in any of the symmetry '
+                           'copies of the asymmetric unit are discarded')
         form.addSection(label='Output')
         form.addParam('pieces', params.EnumParam, label='Type of mask', choices=['Mask', 'Pieces', 'Both'], default=0,
                       display=params.EnumParam.DISPLAY_HLIST,
                       help='Mask: A single Volume containing several identifiers for each piece\n'
                            'Pieces: Several Volumes (files) one for each segmented region'
                            'Both: Mask + Pieces')
+        form.addParam('pieceContent', params.EnumParam, choices=['Binary mask', 'Masked density', 'Soft mask'],
+                      default=PIECE_MASK, condition='pieces != 0', display=params.EnumParam.DISPLAY_HLIST,
+                      label='Content of the pieces',
+                      help='Binary mask: 1 inside the region and 0 elsewhere\n'
+                           'Masked density: the input map inside the region and 0 elsewhere\n'
+                           'Soft mask: the region mask, dilated and with a soft edge (e.g. for signal subtraction '
+                           'or focused refinement)\n'
+                           'Masked densities and soft masks are written for all the regions in a single pass over '
+                           'the map, from a single distance transform of the segmentation')
+        form.addParam('maskDilation', params.FloatParam, default=0.0,
+                      condition='pieces != 0 and pieceContent != %d' % PIECE_MASK,
+                      label='Dilation (A)',
+                      help='Distance the regions are grown by before adding the soft edge. Every voxel belongs '
+                           'to the nearest region, so the pieces never overlap')
+        form.addParam('softEdge', params.FloatParam, default=0.0,
+                      condition='pieces != 0 and pieceContent != %d' % PIECE_MASK,
+                      label='Soft edge (A)',
+                      help='Width of the edge added around every (dilated) region, 0 for a hard edge')
+        form.addParam('edgeShape', params.EnumParam, choices=['Cosine', 'Gaussian'], default=EDGE_COSINE,
+                      condition='pieces != 0 and pieceContent != %d and softEdge > 0' % PIECE_MASK,
+                      display=params.EnumParam.DISPLAY_HLIST, label='Soft edge shape',
+                      help='Cosine: raised cosine falling to 0 at the edge width\n'
+                           'Gaussian: Gaussian with a standard deviation of a third of the edge width')
+        form.addParam('cropPieces', params.BooleanParam, default=True, condition='pieces != 0',
+                      label='Crop pieces to their region?',
+                      help='Store every piece cropped to the bounding box of its region (plus a margin) with '
+                           'its origin set accordingly. Select No to write every piece with the full input box')
+        form.addParam('cropMargin', params.IntParam, default=4, condition='pieces != 0 and cropPieces',
+                      label='Crop margin (voxels)',
+                      help='Number of voxels added around the bounding box of every region')
+        form.addParam('pieceSteps', params.IntParam, default=4, condition='pieces != 0',
+                      expertLevel=params.LEVEL_ADVANCED, label='Piece writing steps',
+                      help='The pieces are written by this number of independent steps (run in parallel with '
+                           'several threads). Every piece written is recorded, so a continued run only writes '
+                           'the missing ones')
+        form.addParam('writerThreads', params.IntParam, default=4, condition='pieces != 0',
+                      expertLevel=params.LEVEL_ADVANCED, label='Piece writer threads',
+                      help='Threads writing the binary pieces to disk while the next regions are extracted '
+                           'from the mask. Mostly useful on network file systems')
+        form.addParam('meshStep', params.IntParam, default=2, expertLevel=params.LEVEL_ADVANCED,
+                      label='Surface mesh step (voxels)',
+                      help='The surface of every region is computed once, sampling the mask every this number of '
+                           'voxels (larger values give lighter meshes), and shown by the viewer instead of '
+                           'opening the full segmentation in Chimera')
+        form.addParam('memoryBudget', params.IntParam, default=1024, expertLevel=params.LEVEL_ADVANCED,
+                      label='Memory budget (MB)',
+                      help='The mask is read memory-mapped and processed in slabs that fit in this amount of '
+                           'memory while writing the outputs. The peak memory used is reported in the run log')
+        form.addParallelSection(threads=1, mpi=0)
 
     # --------------------------- INSERT steps functions ----------------------
     def _insertAllSteps(self):
-        self._insertFunctionStep('segmentationStep')
-        self._insertFunctionStep('createOutputStep')
+        if not self._isInputSet():
+            # The outputs are written by independent steps, every finished piece
+            # being recorded in a manifest, so that a continued run only writes the
+            # missing ones. The segmentation is reused while its inputs and
+            # parameters (the argument of its step) do not change
+            segmentationStep = self._insertFunctionStep('segmentationStep', self._getSegmentationSignature())
+            outputSteps = [self._insertFunctionStep('prepareOutputStep', prerequisites=[segmentationStep])]
+            if self._outputPieces():
+                outputSteps = [self._insertFunctionStep('writePiecesStep', chunk, prerequisites=outputSteps)
+                               for chunk in range(self._getPieceChunks())]
+            self._insertFunctionStep('createOutputStep', prerequisites=outputSteps)
+            return
+        # Sets are processed in streaming: the volumes found at every check of the
+        # input are segmented in one batch and appended to the growing outputs.
+        # Volumes already done (checkpoint file) are not segmented again
+        self._insertedIds = set(self._getDoneIds())
+        batchSteps = self._insertNewBatch(self._loadInputSet())
+        self._insertFunctionStep('closeOutputStep', prerequisites=batchSteps, wait=True)
+
+    def _insertNewBatch(self, inputSet):
+        newIds = [objId for objId in inputSet.getIdSet() if objId not in self._insertedIds]
+        if not newIds:
+            return []
+        self._insertedIds.update(newIds)
+        return [self._insertFunctionStep('segmentBatchStep', sorted(newIds), prerequisites=[])]
+
+    def _stepsCheck(self):
+        if self._isInputSet():
+            self._checkNewInput()
+            self._checkNewOutput()
+
+    def _checkNewInput(self):
+        inputSet = self._loadInputSet()
+        if self._insertNewBatch(inputSet):
+            self.updateSteps()
+        inputSet.close()
+
+    def _checkNewOutput(self):
+        doneIds = self._getDoneIds()
+        if not hasattr(self, '_registeredIds'):
+            self._registeredIds = set()
+            if os.path.exists(self._getPath(CENTROIDS_SET)):
+                centroids = SetOfAtomStructs(filename=self._getPath(CENTROIDS_SET))
+                self._registeredIds.update(centroids.getIdSet())
+                centroids.close()
+        newIds = [objId for objId in doneIds if objId not in self._registeredIds]
+        inputSet = self._loadInputSet()
+        allDone = inputSet.isStreamClosed() and set(inputSet.getIdSet()) <= set(doneIds)
+        if not newIds and not allDone:
+            inputSet.close()
+            return
+
+        volumes = [inputSet[objId].clone() for objId in newIds]
+        sr = inputSet.getSamplingRate()
+        inputSet.close()
+        state = Set.STREAM_CLOSED if allDone else Set.STREAM_OPEN
+        outputSets = {'outputCentroids': self._loadOutputSet(SetOfAtomStructs, CENTROIDS_SET)}
+        if self._outputMask():
+            outputSets['outputSegmentation'] = self._loadOutputSet(SetOfVolumes, MASKS_SET, sr)
+        if self._outputPieces():
+            outputSets['outputGroups'] = self._loadOutputSet(SetOfVolumes, PIECES_SET, sr)
+        for inputVolume in volumes:
+            outputSets['outputCentroids'].append(self._createCentroids(inputVolume))
+            if self._outputMask():
+                outputSets['outputSegmentation'].append(self._createMask(inputVolume))
+            if self._outputPieces():
+                for piece in self._loadPieces(inputVolume):
+                    outputSets['outputGroups'].append(piece)
+        for outputName, outputSet in outputSets.items():
+            isNew = not hasattr(self, outputName)
+            self._updateOutputSet(outputName, outputSet, state)
+            if isNew:
+                self._defineSourceRelation(self.inputVolume, outputSet)
+        self._registeredIds.update(newIds)
+
+        if allDone:
+            for step in self._steps:
+                if step.funcName.get() == 'closeOutputStep' and step.isWaiting():
+                    step.setStatus(STATUS_NEW)
 
     # --------------------------- STEPS functions -----------------------------
-    def segmentationStep(self):
-        self.writeChimeraScript()
-        args = '--nogui --silent --nostatus --script %s' % (os.path.join(chimera.getHome(), 'share', 'Segger', 'scriptChimera.py'))
+    def segmentationStep(self, signature=None):
+        timer = StageTimer()
+        self._segmentVolumes(list(self._iterInputVolumes()), timer)
+        self._addTiming(timer)
+
+    def prepareOutputStep(self):
+        timer = StageTimer()
+        self._prepareVolumeOutputs(self.inputVolume.get(), timer)
+        self._addTiming(timer)
+
+    def writePiecesStep(self, chunk):
+        """ Write the pieces of a chunk of the regions that are not in the manifest yet """
+        timer = StageTimer()
+        inputVolume = self.inputVolume.get()
+        with timer.stage('piece writing', self._getOutputBase(inputVolume)):
+            self._writePieces(inputVolume, chunk, self._getPieceChunks())
+        self._addTiming(timer)
 
-        Chimera.runProgram(Plugin.getProgram(), args)
+    def segmentBatchStep(self, volumeIds):
+        """ Segment a batch of volumes of the input set, with a single Chimera call
+        when using Chimera, and write their outputs """
+        doneIds = set(self._getDoneIds())
+        inputSet = self._loadInputSet()
+        volumes = [inputSet[objId].clone() for objId in volumeIds if objId not in doneIds]
+        inputSet.close()
+        timer = StageTimer()
+        self._segmentVolumes(volumes, timer, batch='_%d' % volumeIds[0])
+        for inputVolume in volumes:
+            self._writeVolumeOutputs(inputVolume, timer)
+            self._setDone(inputVolume.getObjId())
+        self._addTiming(timer)
+
+    def _segmentVolumes(self, volumes, timer, batch=''):
+        """ Segment the volumes, except those already segmented with the current
+        parameters (e.g. by an interrupted run) """
+        pending = []
+        for inputVolume in volumes:
+            if self._isSegmentationDone(inputVolume):
+                self.info("Reusing the segmentation of %s" % self._getOutputBase(inputVolume))
+            else:
+                pwutils.cleanPath(self._getSegmentationDoneFile(inputVolume))
+                pending.append(inputVolume)
+        if not pending:
+            return
+        plan = self._getExecutionPlan()
+        if plan is not None:
+            with self._lock, open(self._getExecutionPlanFile(), 'w') as fid:
+                json.dump(plan, fid, indent=2)
+        if self._getSetting('backend') == BACKEND_NATIVE:
+            self.nativeSegmentation(pending, timer)
+        else:
+            self.chimeraSegmentation(pending, timer, batch)
+        for inputVolume in pending:
+            self._setSegmentationDone(inputVolume)
+
+    def chimeraSegmentation(self, volumes, timer, batch=''):
+        thresholds = {}
+        if self.applySymmetry.get():
+            for inputVolume in volumes:
+                thresholds[inputVolume.getObjId()] = self._writeAsymmetricUnit(inputVolume, timer)[1]
+        self.writeChimeraScript(volumes, batch, thresholds, timer)
+        launched = time.time()
+        with timer.stage('chimera run'):
+            runChimeraScript(self._getScriptFile(batch))
+        names = [self._getOutputBase(volume) for volume in volumes]
+        with open(self._getScriptTimingFile(batch)) as fid:
+            scriptTiming = json.load(fid)
+        timer.add('chimera startup', '', scriptTiming['started'] - launched, 0.0, 0.0)
+        for entry in scriptTiming['stages']:
+            entry['volume'] = names[entry['volume']]
+        timer.extend(scriptTiming['stages'])
+        if self.useCache.get():
+            with timer.stage('cache eviction'):
+                Plugin.getCache().evict()
+        for inputVolume in volumes:
+            if self.recordHierarchy.get():
+                with timer.stage('mask from hierarchy', self._getOutputBase(inputVolume)):
+                    self._writeMaskFromTree(MergeTree.fromSegFile(self._getSegFile(inputVolume)), inputVolume)
+            else:
+                with timer.stage('mask compaction', self._getOutputBase(inputVolume)):
+                    compactLabels(self._getMaskFile(inputVolume),
+                                  slabSections(inputVolume.getDim()[::-1], self.memoryBudget.get() * 1024 * 1024))
+            if self.applySymmetry.get():
+                self._expandSymmetry(inputVolume, timer)
+
+    def nativeSegmentation(self, volumes, timer):
+        ih = ImageHandler()
+        report = []
+        cache = Plugin.getCache() if self.useCache.get() else None
+        for inputVolume in volumes:
+            fileName = inputVolume.getFileName()
+            volumeName = self._getOutputBase(inputVolume)
+            tiling = None
+            if self._getSetting('tiled'):
+                tiling = {'tileSize': self._getSetting('tileSize'),
+                          'halo': self.tileHalo.get(),
+                          'workers': self.numberOfThreads.get(),
+                          'workDir': self._getTmpPath()}
+            params = self._getSegmentationParams()
+            if self.applySymmetry.get():
+                # The asymmetric unit is segmented instead of the whole map
+                fileName, params['threshold'] = self._writeAsymmetricUnit(inputVolume, timer)
+            else:
+                params['threshold'] = self._getThreshold(inputVolume, timer)
+            mrc = None
+            try:
+                with timer.stage('map open', volumeName):
+                    if tiling and isMrcFile(fileName):
+                        # Workers read their own tiles and the regions are kept on disk
+                        mrc = openLabels(fileName)
+                        data = mrc.data
+                        tiling['source'] = os.path.abspath(fileName)
+                        tiling['out'] = np.lib.format.open_memmap(self._getTmpPath('regions_%s.npy' % volumeName),
+                                                                  mode='w+', dtype=np.int32, shape=data.shape)
+                    else:
+                        data = ih.read(fileName).getData()
+                mapHash = None
+                if cache is not None:
+                    with timer.stage('map hash', volumeName):
+                        mapHash = self._getMapHash(fileName)
+                binning = self._getSetting('binning')
+                volumeTimer = StageTimer()
+                smod = segmentMap(data, cache=cache, mapHash=mapHash, tiling=tiling, binning=binning,
+                                  timer=volumeTimer, **params)
+                timer.extend(volumeTimer.stages, volume=volumeName)
+                if binning > 1 and self.compareFullResolution.get():
+                    coarseTime = sum(entry['wall'] for entry in volumeTimer.stages)
+                    report.append(self._compareFullResolution(inputVolume, data, smod, coarseTime))
+                with timer.stage('mask export', volumeName):
+                    if self.recordHierarchy.get():
+                        self._writeMaskFromTree(MergeTree.fromSegmentation(smod), inputVolume)
+                    else:
+                        writeLabels(self._getMaskFile(inputVolume), smod.groupedMask(), inputVolume.getSamplingRate())
+                with timer.stage('seg export', volumeName):
+                    smod.writeSegmentation(self._getSegFile(inputVolume), name=volumeName,
+                                           mapPath=os.path.abspath(fileName))
+            finally:
+                if mrc is not None:
+                    mrc.close()
+            if self.applySymmetry.get():
+                self._expandSymmetry(inputVolume, timer)
+
+        if report:
+            with self._lock:
+                if os.path.exists(self._getCoarseToFineFile()):
+                    with open(self._getCoarseToFineFile()) as fid:
+                        report = json.load(fid) + report
+                with open(self._getCoarseToFineFile(), 'w') as fid:
+                    json.dump(report, fid, indent=2)
+
+    def _compareFullResolution(self, inputVolume, data, smod, coarseTime):
+        start = time.time()
+        params = self._getSegmentationParams()
+        params['threshold'] = self._getThreshold(inputVolume)
+        full = segmentMap(data, **params)
+        fullTime = time.time() - start
+        if self.recordHierarchy.get():
+            coarseMask = self._cutTree(MergeTree.fromSegmentation(smod))
+            fullMask = self._cutTree(MergeTree.fromSegmentation(full))
+        else:
+            coarseMask, fullMask = smod.groupedMask(), full.groupedMask()
+        return {'volume': self._getOutputBase(inputVolume),
+                'binning': self._getSetting('binning'),
+                'coarseTime': coarseTime,
+                'fullTime': fullTime,
+                'regionAgreement': labelAgreement(fullMask, coarseMask),
+                'leafAgreement': labelAgreement(full.regions, smod.regions)}
 
     def createOutputStep(self):
-        file = 'segmask_' + pwutils.removeBaseExt(self.inputVolume.get().getFileName()) + '.mrc'
-        file = self._getExtraPath(file)
-        volume = Volume()
-        volume.setLocation(file)
-        volume.setSamplingRate(self.inputVolume.get().getSamplingRate())
-        if self.pieces.get() == 0 or self.pieces.get() == 2:
-            self._defineOutputs(outputSegmentation=volume)
-            self._defineSourceRelation(self.inputVolume, volume)
-        if self.pieces.get() == 1 or self.pieces.get() == 2:
-            setVolumes = self._createSetOfVolumes()
-            setVolumes.setSamplingRate(self.inputVolume.get().getSamplingRate())
-            ih = ImageHandler()
-            mask = ih.read(volume)
-            mask = mask.getData()
-            ids_mask = np.unique(mask)
-            ids_mask = np.delete(ids_mask, 0)
-            for idm in ids_mask:
-                piece = Volume()
-                piece.setLocation(self._getExtraPath('segmentation_group_%d.mrc' % int(idm)))
-                piece.setSamplingRate(self.inputVolume.get().getSamplingRate())
-                mask_logical = mask == idm
-                pieceData = mask * mask_logical / idm
-                img = ih.createImage()
-                img.setData(pieceData)
-                ih.write(img, piece)
-                setVolumes.append(piece)
-            self._defineOutputs(outputGroups=setVolumes)
-            self._defineSourceRelation(self.inputVolume, setVolumes)
+        timer = StageTimer()
+        inputVolume = self.inputVolume.get()
+        if self._outputPieces():
+            self._finishPieces(inputVolume)
+        self.info("Peak memory: %0.1f MB" % peakRss())
 
+        with timer.stage('output registration'):
+            if self._outputMask():
+                volume = self._createMask(inputVolume)
+                self._defineOutputs(outputSegmentation=volume)
+                self._defineSourceRelation(self.inputVolume, volume)
+            if self._outputPieces():
+                setVolumes = self._createSetOfVolumes()
+                setVolumes.setSamplingRate(inputVolume.getSamplingRate())
+                for piece in self._loadPieces(inputVolume):
+                    setVolumes.append(piece)
+                self._defineOutputs(outputGroups=setVolumes)
+                self._defineSourceRelation(self.inputVolume, setVolumes)
+            centroids = self._createCentroids(inputVolume)
+            self._defineOutputs(outputCentroids=centroids)
+            self._defineSourceRelation(self.inputVolume, centroids)
+        self._addTiming(timer)
 
+    def closeOutputStep(self):
+        """ Runs once every volume of the closed input set has been segmented and
+        registered, the output sets are already closed """
+        self.info("Peak memory: %0.1f MB" % peakRss())
 
     # --------------------------- UTILS functions ----------------------------
-    def writeChimeraScript(self):
-        f = open(os.path.join(chimera.getHome(), 'share', 'Segger', 'scriptChimera.py'), "w")
-        f.write("from chimera import runCommand\n")
-        f.write("runCommand('open %s')\n" % self.inputVolume.get().getFileName())
+    def _isInputSet(self):
+        return isinstance(self.inputVolume.get(), SetOfVolumes)
+
+    def _outputMask(self):
+        return self.pieces.get() in [OUTPUT_MASK, OUTPUT_BOTH]
+
+    def _outputPieces(self):
+        return self.pieces.get() in [OUTPUT_PIECES, OUTPUT_BOTH]
+
+    def _loadInputSet(self):
+        """ Current contents of the input set, read again from its file to see the
+        volumes added in streaming """
+        inputSet = SetOfVolumes(filename=self.inputVolume.get().getFileName())
+        inputSet.loadAllProperties()
+        return inputSet
+
+    def _loadOutputSet(self, SetClass, baseName, samplingRate=None):
+        setFile = self._getPath(baseName)
+        if os.path.exists(setFile):
+            outputSet = SetClass(filename=setFile)
+            outputSet.loadAllProperties()
+            outputSet.enableAppend()
+        else:
+            outputSet = SetClass(filename=setFile)
+            outputSet.setStreamState(outputSet.STREAM_OPEN)
+            if samplingRate is not None:
+                outputSet.setSamplingRate(samplingRate)
+        return outputSet
+
+    def _getDoneFile(self):
+        return self._getExtraPath('done_ids.txt')
+
+    def _getDoneIds(self):
+        """ Ids of the input volumes whose outputs are written (checkpoint of the streaming) """
+        if not os.path.exists(self._getDoneFile()):
+            return []
+        with open(self._getDoneFile()) as fid:
+            return [int(line) for line in fid if line.strip()]
+
+    def _setDone(self, objId):
+        with self._lock:
+            with open(self._getDoneFile(), 'a') as fid:
+                fid.write('%d\n' % objId)
+
+    def _iterInputVolumes(self):
+        """ Iterate over the input volume or over every volume of the input set """
+        if self._isInputSet():
+            for volume in self.inputVolume.get().iterItems():
+                yield volume.clone()
+        else:
+            yield self.inputVolume.get()
+
+    def _getChimeraCacheFile(self, fileName, threshold, volume=None, timer=None):
+        """ Cache entry holding the initial watershed of a map, '' when the cache is not used """
+        if not self.useCache.get():
+            return ''
+        cache = Plugin.getCache()
+        with (timer or StageTimer()).stage('map hash', self._getOutputBase(volume) if volume else ''):
+            mapHash = self._getMapHash(fileName)
+        return cache.getFile(cache.getKey(mapHash, threshold), '.seg')
+
+    def _getMapHash(self, fileName):
+        """ Content hash of a map for the watershed cache, computed once for every
+        version (size and modification time) of the file """
+        if getattr(self, '_mapHashes', None) is None:
+            self._mapHashes = {}
+        key = (os.path.abspath(fileName), fileSignature(fileName))
+        if key not in self._mapHashes:
+            self._mapHashes[key] = fileHash(fileName)
+        return self._mapHashes[key]
+
+    def _getScriptFile(self, batch=''):
+        """ Chimera script of this run (or of a batch of a streaming run), kept inside the run
+        folder so that concurrent runs do not overwrite each other """
+        return self._getTmpPath('scriptChimera%s.py' % batch)
+
+    def _getOutputBase(self, volume):
+        """ Name identifying the outputs of an input volume. Volumes of a set are
+        also identified by their id, as several of them may share the file name """
+        base = pwutils.removeBaseExt(volume.getFileName())
+        if self._isInputSet():
+            base += '_%d' % volume.getObjId()
+        return base
+
+    def _getMaskFile(self, volume):
+        return self._getExtraPath('segmask_' + self._getOutputBase(volume) + '.mrc')
+
+    def _getSegFile(self, volume):
+        return self._getExtraPath('seg_' + self._getOutputBase(volume) + '.seg')
+
+    def _getRegionStatsFile(self, volume):
+        return self._getExtraPath('regions_' + self._getOutputBase(volume) + '.csv')
+
+    def _getCentroidsFile(self, volume):
+        return self._getExtraPath('centroids_' + self._getOutputBase(volume) + '.pdb')
+
+    def _getTimingFile(self):
+        return self._getExtraPath('timing.json')
+
+    def _getScriptTimingFile(self, batch=''):
+        return self._getTmpPath('timingChimera%s.json' % batch)
 
-        if self.grouping.get() == 0:
-            groupMode = 'smoothing'
+    def _addTiming(self, timer):
+        """ Add the stages timed by a step to the timing file of the run """
+        with self._lock:
+            runTimer = StageTimer.load(self._getTimingFile())
+            runTimer.extend(timer.stages)
+            runTimer.save(self._getTimingFile(), pluginVersion=__version__,
+                          backend='native' if self._getSetting('backend') == BACKEND_NATIVE else 'chimera')
+
+    def _getCoarseToFineFile(self):
+        return self._getExtraPath('coarse_to_fine.json')
+
+    def _getMeshesFile(self, volume):
+        return self._getExtraPath('meshes_' + self._getOutputBase(volume) + '.npz')
+
+    def _getPiecesFile(self, volume):
+        return self._getExtraPath('pieces_' + self._getOutputBase(volume) + '.json')
+
+    def _getThresholdFile(self, volume):
+        return self._getExtraPath('threshold_' + self._getOutputBase(volume) + '.json')
+
+    def _getThreshold(self, volume, timer=None):
+        """ Threshold of a volume: the one given or else computed from the statistics
+        of the map, accumulated slab by slab over the memory-mapped file. The
+        statistics are kept in the extra folder while the map and the threshold
+        parameters do not change """
+        if self.mapThreshold.get() >= 0:
+            return self.mapThreshold.get()
+        thresholdFile = self._getThresholdFile(volume)
+        signature = fileSignature(volume.getFileName(), self.thresholdMode.get(), self.thresholdSigma.get(),
+                                  self.thresholdPercentile.get())
+        if os.path.exists(thresholdFile):
+            with open(thresholdFile) as fid:
+                saved = json.load(fid)
+            if saved['signature'] == signature:
+                return saved['threshold']
+        with (timer or StageTimer()).stage('threshold', self._getOutputBase(volume)):
+            stats = self._getMapStatistics(volume)
+        threshold = stats.threshold(self.thresholdMode.get(), self.thresholdSigma.get(),
+                                    self.thresholdPercentile.get())
+        with open(thresholdFile, 'w') as fid:
+            json.dump({'signature': signature, 'threshold': threshold, 'mean': stats.mean, 'std': stats.std,
+                       'min': float(stats.min), 'max': float(stats.max)}, fid)
+        return threshold
+
+    def _getMapStatistics(self, volume):
+        """ MapStatistics of a volume, accumulated slab by slab over the memory-mapped
+        file within the memory budget """
+        with self._openDensity(volume) as density:
+            return mapStatistics(density, slabSections(density.shape, self.memoryBudget.get() * 1024 * 1024))
+
+    def _getExecutionPlanFile(self):
+        return self._getExtraPath('execution.json')
+
+    def _getMapShape(self):
+        """ (z, y, x) dimensions of the input volume (the first one of a set), from
+        the header of MRC files. None for an empty set """
+        volume = next(self._iterInputVolumes(), None)
+        if volume is None:
+            return None
+        if isMrcFile(volume.getFileName()):
+            return mapShape(volume.getFileName())
+        return tuple(volume.getDim()[::-1])
+
+    def _getExecutionSettings(self):
+        """ Configured settings, as keyword arguments of estimateResources """
+        return {'backend': self.backend.get(),
+                'grouping': self.grouping.get(),
+                'pieces': self._outputPieces(),
+                'cropPieces': self.cropPieces.get(),
+                'pieceBytes': 1 if self.pieceContent.get() == PIECE_MASK else 4,
+                'numRegions': self.stopGroup.get(),
+                'tiled': self.tiled.get(),
+                'tileSize': self.tileSize.get(),
+                'tileHalo': self.tileHalo.get(),
+                'threads': self.numberOfThreads.get(),
+                'binning': self.binning.get(),
+                'memoryBudget': self.memoryBudget.get()}
+
+    def _getExecutionPlan(self):
+        """ Execution mode and settings of the run, with their estimated peak
+        memory (MB) and runtime (s). In automatic mode the settings are those of
+        the first mode fitting in the memory limit """
+        shape = self._getMapShape()
+        if shape is None:
+            return None
+        settings = self._getExecutionSettings()
+        memoryLimit = self.memoryLimit.get() * 1024
+        if self.autoMode.get():
+            mode, settings, estimate, fits = chooseExecutionMode(shape, memoryLimit, **settings)
         else:
-            groupMode = 'connectivity'
-
-        contents = 'path = "%s"\n' \
-                   'groupingMode = "%s"\n' \
-                   'minRegionSize = %d\n' \
-                   'minContactVoxels = %d\n' \
-                   'stopAtNumberOfRegions = %d\n' \
-                   'mapThreshold = %f\n' \
-                   'if mapThreshold < 0:\n' \
-                   '\tmapThreshold=None\n' \
-                   'numSmoothingSteps = %d\n' \
-                   'smoothingStepSize = %d\n' \
-                   'numConnectivitySteps = %d\n' \
-                   'outputRegions = []\n' \
-                   'options = {}\n' \
-                   'options["outputMapSize"] = "box"\n' \
-                   'options["borderWidth"] = 4\n' \
-                   'options["mask01"] = False\n' \
-                   'import Segger\n' \
-                   'import chimera\n' \
-                   'import VolumeViewer\n' \
-                   'import regions\n' \
-                   'import numpy\n' \
-                   'from segcmd import export_mask\n' \
-                   'from segfile import write_segmentation\n' \
-                   'maps = chimera.openModels.list (modelTypes = [VolumeViewer.volume.Volume])\n' \
-                   'for dmap in maps:\n' \
-                   '\tif mapThreshold == None :\n' \
-                   '\t\tM = dmap.data.full_matrix()\n' \
-                   '\t\tmapThreshold = numpy.average(M)+numpy.std(M)*3.0\n' \
-                   '\tsmod = regions.Segmentation(dmap.name, dmap)\n' \
-                   '\tsmod.calculate_watershed_regions ( dmap, mapThreshold )\n' \
-                   '\tif minRegionSize > 1 :\n' \
-                   '\t\tsmod.remove_small_regions(minRegionSize)\n' \
-                   '\tif minContactVoxels > 0 :\n' \
-                   '\t\tsmod.remove_contact_regions(minContactVoxels)\n' \
-                   '\tif groupingMode == "smoothing" :\n' \
-                   '\t\tsmod.smooth_and_group(numSmoothingSteps, smoothingStepSize, stopAtNumberOfRegions)\n' \
-                   '\telif groupingMode == "connectivity" :\n' \
-                   '\t\tsmod.group_connected_n (numConnectivitySteps, stopAtNumberOfRegions)\n' \
-                   '\tregions_seg = smod.grouped_regions()\n' \
-                   '\toutputN = len(regions_seg)\n' \
-                   '\timport os\n' \
-                   '\tmdir, mfile = os.path.split(dmap.data.path)\n' \
-                   '\tmname, mext = os.path.splitext ( mfile )\n' \
-                   '\tif outputN > 0 :\n' \
-                   '\t\timport Segger.extract_region_dialog\n' \
-                   '\t\tfor i in range ( outputN ) :\n' \
-                   '\t\t\treg = regions_seg[i]\n' \
-                   '\tfileName = os.path.splitext(dmap.name)[0]\n' \
-                   '\toutMask = os.path.join(path, "segmask_" + fileName + ".mrc") \n' \
-                   '\toutSeg = os.path.join(path, "seg_" + fileName + ".seg") \n'\
-                   '\texport_mask(smod, savePath=outMask)\n' \
-                   '\twrite_segmentation(smod, path=outSeg)\n' % \
-                   (self._getExtraPath(), groupMode, self.minRegionSize.get(), self.minContactVoxels.get(), self.stopGroup.get(),
-                    self.mapThreshold.get(), self.smoothSteps.get(), self.smoothStepSize.get(), self.connectSteps.get())
-
-        f.write(contents)
-        f.close()
+            mode, estimate = executionMode(settings), estimateResources(shape, **settings)
+            fits = estimate['memory'] <= memoryLimit
+        return {'shape': list(shape), 'mode': mode, 'settings': settings, 'estimate': estimate, 'fits': fits,
+                'automatic': self.autoMode.get(), 'memoryLimit': memoryLimit}
+
+    def _getSetting(self, name):
+        """ Value of backend, tiled, tileSize, binning or cropPieces used by the run,
+        which the automatic execution mode may change """
+        if getattr(self, '_executionSettings', None) is None:
+            plan = self._getExecutionPlan()
+            if plan is None:
+                return self._getExecutionSettings()[name]
+            self._executionSettings = plan['settings']
+        return self._executionSettings[name]
+
+    def _getPieceBoxesFile(self, volume):
+        return self._getExtraPath('pieces_' + self._getOutputBase(volume) + '_boxes.json')
+
+    def _getManifestFile(self, volume):
+        return self._getExtraPath('pieces_' + self._getOutputBase(volume) + '.manifest')
+
+    def _getPieceChunks(self):
+        return max(self.pieceSteps.get(), 1)
+
+    def _getWriterThreads(self):
+        return max(self.writerThreads.get(), 1)
+
+    def _getSegmentationDoneFile(self, volume):
+        return self._getExtraPath('segmentation_' + self._getOutputBase(volume) + '.json')
+
+    def _getSegmentationSignature(self):
+        """ Parameters the masks and segmentations depend on, as a string """
+        signature = self._getSegmentationParams()
+        for name in ['thresholdMode', 'thresholdSigma', 'thresholdPercentile', 'stopGroup', 'recordHierarchy',
+                     'tileHalo', 'applySymmetry', 'symmetryGroup', 'symmetryOrder',
+                     'symmetryMargin']:
+            signature[name] = getattr(self, name).get()
+        for name in ['backend', 'tiled', 'tileSize', 'binning']:
+            signature[name] = self._getSetting(name)
+        return json.dumps(signature, sort_keys=True)
+
+    def _isSegmentationDone(self, volume):
+        """ Whether the mask and segmentation of a volume were obtained from the
+        same input map (same size and modification time) and parameters """
+        doneFile = self._getSegmentationDoneFile(volume)
+        if not all(os.path.exists(path) for path in [doneFile, self._getMaskFile(volume), self._getSegFile(volume)]):
+            return False
+        with open(doneFile) as fid:
+            done = json.load(fid)
+        return (done['parameters'] == self._getSegmentationSignature() and
+                done['input'] == fileSignature(volume.getFileName()))
+
+    def _setSegmentationDone(self, volume):
+        with open(self._getSegmentationDoneFile(volume), 'w') as fid:
+            json.dump({'parameters': self._getSegmentationSignature(),
+                       'input': fileSignature(volume.getFileName())}, fid)
+
+    def _getPieceFile(self, volume, idm):
+        if self._isInputSet():
+            return self._getExtraPath('segmentation_%s_group_%d.mrc' % (self._getOutputBase(volume), idm))
+        return self._getExtraPath('segmentation_group_%d.mrc' % idm)
+
+    def _getAsymmetricUnitFile(self, volume):
+        return self._getTmpPath('asu_' + self._getOutputBase(volume) + '.mrc')
+
+    def _getSymmetryCellsFile(self, volume):
+        return self._getTmpPath('cells_' + self._getOutputBase(volume) + '.npy')
+
+    def _getSymmetryFile(self, volume):
+        return self._getExtraPath('symmetry_' + self._getOutputBase(volume) + '.json')
+
+    def _getRotations(self):
+        return getRotations(self.symmetryGroup.get(), self.symmetryOrder.get())
+
+    def _getAsymmetricUnit(self, volume):
+        """ Symmetry of a segmented volume: group, number of copies, threshold and
+        number of regions of its asymmetric unit """
+        with open(self._getSymmetryFile(volume)) as fid:
+            return json.load(fid)
+
+    def _getSymmetryCells(self, inputVolume, shape, reuse=True):
+        """ Symmetry copy every voxel of the box belongs to (see symmetryCells),
+        computed once per volume when writing its asymmetric unit and kept in the
+        tmp folder for the symmetry expansion """
+        cellsFile = self._getSymmetryCellsFile(inputVolume)
+        if reuse and os.path.exists(cellsFile):
+            return np.load(cellsFile, mmap_mode='r')
+        cells = symmetryCells(shape, self._getRotations(),
+                              slabSections(shape, self.memoryBudget.get() * 1024 * 1024, bytesPerVoxel=10))
+        np.save(cellsFile, cells)
+        return cells
+
+    def _writeAsymmetricUnit(self, inputVolume, timer):
+        """ Write the asymmetric unit of a volume plus its margin, the rest of the box
+        set to the minimum of the map. Returns its file and the threshold, that
+        is computed over the whole map """
+        volumeName = self._getOutputBase(inputVolume)
+        with timer.stage('asymmetric unit', volumeName):
+            data = ImageHandler().read(inputVolume).getData()
+            threshold = self._getThreshold(inputVolume)
+            rotations = self._getRotations()
+            cells = self._getSymmetryCells(inputVolume, data.shape, reuse=False)
+            inside = asymmetricUnitMask(cells, self.symmetryMargin.get() / inputVolume.getSamplingRate())
+            writeMap(self._getAsymmetricUnitFile(inputVolume), np.where(inside, data, data.min()),
+                     inputVolume.getSamplingRate())
+            with open(self._getSymmetryFile(inputVolume), 'w') as fid:
+                json.dump({'group': SCIPION_SYM_NAME[self.symmetryGroup.get()],
+                           'order': self.symmetryOrder.get(),
+                           'copies': len(rotations),
+                           'threshold': float(threshold)}, fid)
+        return self._getAsymmetricUnitFile(inputVolume), threshold
+
+    def _expandSymmetry(self, inputVolume, timer):
+        """ Keep the regions of the mask lying mostly in the asymmetric unit and add
+        their symmetry copies, with consistent ids per copy """
+        with timer.stage('symmetry expansion', self._getOutputBase(inputVolume)):
+            rotations = self._getRotations()
+            with openLabels(self._getMaskFile(inputVolume)) as mrc:
+                labels = np.array(mrc.data)
+            cells = self._getSymmetryCells(inputVolume, labels.shape)
+            labels, numRegions = keepAsymmetricRegions(labels, cells)
+            writeLabels(self._getMaskFile(inputVolume), expandSymmetry(labels, numRegions, rotations, cells),
+                        inputVolume.getSamplingRate())
+            symmetry = self._getAsymmetricUnit(inputVolume)
+            symmetry['regions'] = numRegions
+            with open(self._getSymmetryFile(inputVolume), 'w') as fid:
+                json.dump(symmetry, fid)
+
+    def _writeRegionStatistics(self, inputVolume, maskFile):
+        """ Statistics of every region of the mask over the input map, written as a
+        CSV table, and their centroids as pseudo-atoms """
+        sr = inputVolume.getSamplingRate()
+        with openLabels(maskFile) as mrc, self._openDensity(inputVolume) as density:
+            mask = mrc.data
+            sections = slabSections(mask.shape, self.memoryBudget.get() * 1024 * 1024, bytesPerVoxel=48)
+            stats = regionStatistics(mask, density, sections)
+
+        ids = np.flatnonzero(stats['voxels'])
+        ids = ids[ids > 0]
+        stats['position'] = np.array([self._getPieceOrigin(inputVolume, stats['centroid'][idm])
+                                      for idm in range(len(stats['voxels']))])
+        with open(self._getRegionStatsFile(inputVolume), 'w') as fid:
+            writer = csv.writer(fid)
+            writer.writerow(['region', 'voxels', 'volume_A3', 'centroid_x', 'centroid_y', 'centroid_z',
+                             'bbox_x0', 'bbox_y0', 'bbox_z0', 'bbox_x1', 'bbox_y1', 'bbox_z1',
+                             'mean_density', 'max_density', 'neighbours'])
+            for idm in ids:
+                writer.writerow([idm, stats['voxels'][idm], '%0.3f' % (stats['voxels'][idm] * sr ** 3)] +
+                                ['%0.3f' % c for c in stats['position'][idm]] +
+                                list(stats['lower'][idm][::-1]) + list(stats['upper'][idm][::-1] - 1) +
+                                ['%g' % stats['meanDensity'][idm], '%g' % stats['maxDensity'][idm],
+                                 ' '.join(str(n) for n in stats['neighbours'][idm])])
+        writePseudoAtoms(self._getCentroidsFile(inputVolume), ids, stats['position'][ids])
+
+    def _readRegionStatistics(self, inputVolume):
+        """ Statistics of every region written by _writeRegionStatistics, by region id """
+        with open(self._getRegionStatsFile(inputVolume)) as fid:
+            return dict((int(row['region']), row) for row in csv.DictReader(fid))
+
+    def _writeVolumeOutputs(self, inputVolume, timer):
+        """ Region statistics, meshes and pieces of a segmented volume. The pieces
+        are listed in a JSON file, from which they are registered in the output """
+        self._prepareVolumeOutputs(inputVolume, timer)
+        if self._outputPieces():
+            with timer.stage('piece writing', self._getOutputBase(inputVolume)):
+                self._writePieces(inputVolume)
+            self._finishPieces(inputVolume)
+
+    def _prepareVolumeOutputs(self, inputVolume, timer):
+        """ Region statistics and meshes of a segmented volume, and the boxes of
+        the pieces to write """
+        volumeName = self._getOutputBase(inputVolume)
+        with timer.stage('region statistics', volumeName):
+            self._writeRegionStatistics(inputVolume, self._getMaskFile(inputVolume))
+        with timer.stage('surface meshes', volumeName):
+            self._writeMeshes(inputVolume)
+        if self._outputPieces():
+            with timer.stage('piece boxes', volumeName):
+                self._preparePieces(inputVolume)
+
+    def _writeMeshes(self, inputVolume):
+        """ Surface meshes of the regions of a volume, unless the cached ones were
+        computed for the current mask and mesh step """
+        maskFile = self._getMaskFile(inputVolume)
+        signature = fileSignature(maskFile, self.meshStep.get())
+        if isMeshCacheValid(self._getMeshesFile(inputVolume), signature):
+            return
+        with openLabels(maskFile) as mrc:
+            mask = mrc.data
+            sections = slabSections(mask.shape, self.memoryBudget.get() * 1024 * 1024)
+            meshes = regionMeshes(mask, inputVolume.getSamplingRate(), self._getPieceOrigin(inputVolume, (0, 0, 0)),
+                                  step=self.meshStep.get(), sections=sections)
+            writeMeshes(self._getMeshesFile(inputVolume), meshes, signature)
+
+    def _createMask(self, inputVolume):
+        volume = Volume()
+        volume.setLocation(self._getMaskFile(inputVolume))
+        volume.setSamplingRate(inputVolume.getSamplingRate())
+        if self._isInputSet():
+            volume.setObjId(inputVolume.getObjId())
+        return volume
+
+    def _createCentroids(self, inputVolume):
+        centroids = AtomStruct(filename=self._getCentroidsFile(inputVolume))
+        if self._isInputSet():
+            centroids.setObjId(inputVolume.getObjId())
+        return centroids
+
+    def _loadPieces(self, inputVolume):
+        """ Pieces of a volume listed by _finishPieces, with their region statistics """
+        sr = inputVolume.getSamplingRate()
+        with open(self._getPiecesFile(inputVolume)) as fid:
+            entries = json.load(fid)
+        stats = self._readRegionStatistics(inputVolume)
+        for entry in entries:
+            piece = Volume()
+            piece.setLocation(entry['file'])
+            piece.setSamplingRate(sr)
+            if entry['origin'] is not None:
+                self._setPieceOrigin(piece, entry['origin'])
+            if self._isInputSet():
+                piece._inputId = Integer(inputVolume.getObjId())
+            row = stats[entry['regionId']]
+            piece._regionId = Integer(entry['regionId'])
+            piece._voxels = Integer(int(row['voxels']))
+            piece._volume = Float(int(row['voxels']) * sr ** 3)
+            piece._centroidX = Float(float(row['centroid_x']))
+            piece._centroidY = Float(float(row['centroid_y']))
+            piece._centroidZ = Float(float(row['centroid_z']))
+            piece._meanDensity = Float(float(row['mean_density']))
+            piece._maxDensity = Float(float(row['max_density']))
+            piece._neighbours = String(row['neighbours'])
+            if 'symmetryCopy' in entry:
+                piece._symmetryCopy = Integer(entry['symmetryCopy'])
+                piece._asymmetricRegion = Integer(entry['asymmetricRegion'])
+            yield piece
+
+    def _getPiecesSignature(self, inputVolume):
+        """ Signature of the mask and of the parameters of the pieces. Pieces
+        recorded in the manifest for another signature are written again """
+        return fileSignature(self._getMaskFile(inputVolume), self.pieceContent.get(), self.maskDilation.get(),
+                             self.softEdge.get(), self.edgeShape.get(), self._getSetting('cropPieces'),
+                             self.cropMargin.get())
+
+    def _preparePieces(self, inputVolume):
+        """ Boxes of the pieces of a volume, and its manifest of written pieces,
+        emptied unless it was started for the current mask and parameters """
+        sr = inputVolume.getSamplingRate()
+        softEdge = self.softEdge.get() / sr if self.pieceContent.get() != PIECE_MASK else 0.0
+        dilation = self.maskDilation.get() / sr if self.pieceContent.get() != PIECE_MASK else 0.0
+        margin = self.cropMargin.get() + int(np.ceil(softEdge + dilation)) if self._getSetting('cropPieces') else 0
+        with openLabels(self._getMaskFile(inputVolume)) as mrc:
+            mask = mrc.data
+            boxes = regionSlices(mask, margin, slabSections(mask.shape, self.memoryBudget.get() * 1024 * 1024))
+        with open(self._getPieceBoxesFile(inputVolume), 'w') as fid:
+            json.dump(dict((str(idm), [[s.start, s.stop] for s in box]) for idm, box in boxes.items()), fid)
+        signature = self._getPiecesSignature(inputVolume)
+        if self._readManifest(inputVolume) is None:
+            with open(self._getManifestFile(inputVolume), 'w') as fid:
+                fid.write(json.dumps({'signature': signature}) + '\n')
+
+    def _readManifest(self, inputVolume):
+        """ Pieces of a volume already written, by region id, or None if the
+        manifest does not exist or was started for other mask or parameters """
+        manifestFile = self._getManifestFile(inputVolume)
+        if not os.path.exists(manifestFile):
+            return None
+        with open(manifestFile) as fid:
+            lines = [json.loads(line) for line in fid if line.strip()]
+        if not lines or lines[0].get('signature') != self._getPiecesSignature(inputVolume):
+            return None
+        return dict((entry['regionId'], entry) for entry in lines[1:])
+
+    def _addToManifest(self, inputVolume, entries):
+        with self._lock:
+            with open(self._getManifestFile(inputVolume), 'a') as fid:
+                for entry in entries:
+                    fid.write(json.dumps(entry) + '\n')
+
+    def _writePieces(self, inputVolume, chunk=0, chunks=1):
+        """ Write every region (of the given chunk) of the mask of a volume as a
+        separate volume: its binary mask, the masked density or a soft mask.
+        Regions already in the manifest are skipped. The mask is read
+        memory-mapped, slab by slab, within the configured memory budget """
+        sr = inputVolume.getSamplingRate()
+        crop = self._getSetting('cropPieces')
+        numRegions = self._getAsymmetricUnit(inputVolume)['regions'] if self.applySymmetry.get() else 0
+        masked = self.pieceContent.get() != PIECE_MASK
+        softEdge = self.softEdge.get() / sr if masked else 0.0
+        dilation = self.maskDilation.get() / sr if masked else 0.0
+        with open(self._getPieceBoxesFile(inputVolume)) as fid:
+            boxes = dict((int(idm), tuple(slice(*limits) for limits in box)) for idm, box in json.load(fid).items())
+        done = self._readManifest(inputVolume) or {}
+        # Chunks are contiguous runs of the regions sorted along Z, so that every
+        # step only reads (and, for masked or soft pieces, computes the distance
+        # transform of) the slabs spanned by its own regions
+        ordered = sorted(boxes, key=lambda idm: (boxes[idm][0].start, idm))
+        todo = [idm for idm in ordered[len(ordered) * chunk // chunks:len(ordered) * (chunk + 1) // chunks]
+                if idm not in done]
+        if not todo:
+            return
+        start = time.time()
+        entries = []
+        for idm in todo:
+            entries.append({'file': self._getPieceFile(inputVolume, idm),
+                            'origin': self._getPieceOrigin(inputVolume, [s.start for s in boxes[idm]])
+                            if crop else None,
+                            'regionId': int(idm)})
+            if numRegions:
+                entries[-1]['symmetryCopy'] = int((idm - 1) // numRegions)
+                entries[-1]['asymmetricRegion'] = int((idm - 1) % numRegions + 1)
+        with openLabels(self._getMaskFile(inputVolume)) as mrc:
+            mask = mrc.data
+            sections = slabSections(mask.shape, self.memoryBudget.get() * 1024 * 1024, bytesPerVoxel=48)
+            if masked:
+                fullBox = tuple(slice(0, n) for n in mask.shape)
+                pieceBoxes = dict((entry['regionId'], boxes[entry['regionId']] if crop else fullBox)
+                                  for entry in entries)
+                files = dict((entry['regionId'], entry['file']) for entry in entries)
+                origins = dict((entry['regionId'], entry['origin']) for entry in entries)
+                options = {'softEdge': softEdge, 'dilation': dilation, 'edgeShape': self.edgeShape.get(),
+                           'sections': sections, 'origins': origins}
+                if self.pieceContent.get() == PIECE_SOFT_MASK:
+                    writeMaskedPieces(mask, None, pieceBoxes, files, sr, **options)
+                else:
+                    with self._openDensity(inputVolume) as density:
+                        writeMaskedPieces(mask, density, pieceBoxes, files, sr, **options)
+                self._addToManifest(inputVolume, entries)
+            else:
+                byRegion = dict((entry['regionId'], entry) for entry in entries)
+                writePieces(mask, dict((idm, boxes[idm]) for idm in byRegion),
+                            dict((idm, entry['file']) for idm, entry in byRegion.items()), sr,
+                            fullBox=not crop, sections=sections,
+                            origins=dict((idm, entry['origin']) for idm, entry in byRegion.items()),
+                            threads=self._getWriterThreads(),
+                            onWritten=lambda idm: self._addToManifest(inputVolume, [byRegion[idm]]))
+        elapsed = time.time() - start
+        self.info("Wrote %d pieces of %s in %0.1f s (%0.1f pieces/s)"
+                  % (len(entries), self._getOutputBase(inputVolume), elapsed, len(entries) / max(elapsed, 1e-6)))
+
+    def _finishPieces(self, inputVolume):
+        """ List the pieces of the manifest, once all of them are written """
+        with open(self._getPieceBoxesFile(inputVolume)) as fid:
+            regionIds = sorted(int(idm) for idm in json.load(fid))
+        done = self._readManifest(inputVolume) or {}
+        missing = [idm for idm in regionIds if idm not in done]
+        if missing:
+            raise Exception("Pieces of %d regions of %s were not written: %s"
+                            % (len(missing), self._getOutputBase(inputVolume), missing[:10]))
+        with open(self._getPiecesFile(inputVolume), 'w') as fid:
+            json.dump([done[idm] for idm in regionIds], fid)
+
+    @contextmanager
+    def _openDensity(self, inputVolume):
+        """ Density of a volume, memory-mapped when it is an MRC file """
+        if isMrcFile(inputVolume.getFileName()):
+            with openLabels(inputVolume.getFileName()) as mrc:
+                yield mrc.data
+        else:
+            yield ImageHandler().read(inputVolume).getData()
+
+    def _getPieceOrigin(self, inputVolume, start):
+        """ Position (x, y, z) in Angstroms of the voxel start (z, y, x) of the input box """
+        sr = inputVolume.getSamplingRate()
+        x, y, z = inputVolume.getOrigin(force=True).getShifts()
+        return x + start[2] * sr, y + start[1] * sr, z + start[0] * sr
+
+    def _setPieceOrigin(self, piece, origin):
+        transform = Transform()
+        transform.setShifts(*origin)
+        piece.setOrigin(transform)
+
+    def _writeMaskFromTree(self, tree, inputVolume):
+        """ Mask obtained by stopping the recorded hierarchy at the requested number of regions """
+        writeLabels(self._getMaskFile(inputVolume), self._cutTree(tree), inputVolume.getSamplingRate())
+
+    def _cutTree(self, tree):
+        return tree.groupedMask(tree.cutAtRegions(self.stopGroup.get()))
+
+    def _getSegmentationParams(self):
+        """ Segmentation parameters, as keyword arguments of segmentMap and writeChimeraScript.
+        When the hierarchy is recorded the grouping goes on until a single region is left """
+        stop = 1 if self.recordHierarchy.get() else self.stopGroup.get()
+        return {'threshold': self.mapThreshold.get(),
+                'groupingMode': self.grouping.get(),
+                'minRegionSize': self.minRegionSize.get(),
+                'minContactVoxels': self.minContactVoxels.get(),
+                'stopAtNumberOfRegions': stop,
+                'numSmoothingSteps': self.smoothSteps.get(),
+                'smoothingStepSize': self.smoothStepSize.get(),
+                'numConnectivitySteps': self.connectSteps.get()}
+
+    def writeChimeraScript(self, volumes, batch='', thresholds=None, timer=None):
+        """ Chimera script segmenting the volumes, or their asymmetric units when
+        a threshold is given for them. The threshold and map hash stages are
+        recorded in timer, as for the native backend """
+        jobs = []
+        for volume in volumes:
+            if thresholds and volume.getObjId() in thresholds:
+                threshold = thresholds[volume.getObjId()]
+                fileName = self._getAsymmetricUnitFile(volume)
+                jobs.append((fileName, self._getMaskFile(volume), self._getSegFile(volume),
+                             self._getChimeraCacheFile(fileName, threshold, volume, timer), threshold))
+            else:
+                threshold = self._getThreshold(volume, timer)
+                jobs.append((volume.getFileName(), self._getMaskFile(volume), self._getSegFile(volume),
+                             self._getChimeraCacheFile(volume.getFileName(), threshold, volume, timer), threshold))
+        # Every job carries the threshold computed for it
+        params = self._getSegmentationParams()
+        del params['threshold']
+        writeChimeraScript(self._getScriptFile(batch), jobs, chunkSize=self.chunkSize.get(),
+                           exportMask=not self.recordHierarchy.get(), timingFile=self._getScriptTimingFile(batch),
+                           **params)
 
     # --------------------------- DEFINE info functions ----------------------
+    def _warnings(self):
+        warnings = []
+        plan = self._getExecutionPlan()
+        if plan is not None and not plan['fits']:
+            warnings.append("The run is estimated to need %0.1f GB of memory (%s mode), more than the limit of "
+                            "%0.1f GB. Consider a tiled watershed, a coarse-to-fine binning or cropped pieces"
+                            % (plan['estimate']['memory'] / 1024, EXECUTION_NAMES[plan['mode']],
+                               self.memoryLimit.get()))
+            if not plan['automatic']:
+                mode, settings, estimate, fits = chooseExecutionMode(plan['shape'], plan['memoryLimit'],
+                                                                     **plan['settings'])
+                if fits:
+                    warnings.append("The %s mode with the %s backend is estimated to fit. Choose the execution "
+                                    "mode automatically to use it"
+                                    % (EXECUTION_NAMES[mode], BACKEND_NAMES[settings['backend']]))
+        return warnings
+
     def _methods(self):
         methodsMsgs = []
         if self.getOutputsSize() >= 1:
-            if hasattr(self, 'outputSegmentation'):
+            if hasattr(self, 'outputSegmentation') and isinstance(self.outputSegmentation, SetOfVolumes):
+                msg = ("Segmentation masks succesfully generated for %d volumes\n" % len(self.outputSegmentation))
+                methodsMsgs.append(msg)
+            elif hasattr(self, 'outputSegmentation'):
                 msg = ("Segmentation mask succesfully generated: %s\n" % self.outputSegmentation.getFileName())
                 methodsMsgs.append(msg)
             if hasattr(self, 'outputGroups'):
@@ -214,15 +1310,67 @@ class ProtSegmentMap(EMProtocol):
 
     def _summary(self):
         summary = []
-        summary.append("Input Volume provided: %s\n"
-                       % self.inputVolume.get().getFileName())
+        if self._isInputSet():
+            summary.append("Input set of %d volumes provided, %d segmented\n"
+                           % (len(self.inputVolume.get()), len(self._getDoneIds())))
+        else:
+            summary.append("Input Volume provided: %s\n"
+                           % self.inputVolume.get().getFileName())
         if self.getOutputsSize() >= 1:
-            if hasattr(self, 'outputSegmentation'):
+            if hasattr(self, 'outputSegmentation') and isinstance(self.outputSegmentation, SetOfVolumes):
+                msg = ("Segmentation masks succesfully generated for %d volumes\n" % len(self.outputSegmentation))
+                summary.append(msg)
+            elif hasattr(self, 'outputSegmentation'):
                 msg = ("Segmentation mask succesfully generated: %s\n" % self.outputSegmentation.getFileName())
                 summary.append(msg)
             if hasattr(self, 'outputGroups'):
                 msg = ("Groups seprated into %d different masks\n" % len(self.outputGroups))
                 summary.append(msg)
+            if hasattr(self, 'outputCentroids'):
+                summary.append("Region statistics (size, centroid, bounding box, density and neighbours) "
+                               "stored in the extra folder as regions_*.csv, centroids in outputCentroids\n")
         else:
             summary.append("Segmentations not ready yet.")
+        for volume in self._iterInputVolumes():
+            if os.path.isfile(self._getThresholdFile(volume)):
+                with open(self._getThresholdFile(volume)) as fid:
+                    stats = json.load(fid)
+                summary.append("Threshold of %s: %g (mean %g, std %g)\n"
+                               % (self._getOutputBase(volume), stats['threshold'], stats['mean'], stats['std']))
+        if os.path.isfile(self._getExecutionPlanFile()):
+            with open(self._getExecutionPlanFile()) as fid:
+                plan = json.load(fid)
+            summary.append("Execution mode: %s (%s), %s backend\n"
+                           % (EXECUTION_NAMES[plan['mode']], 'automatic' if plan['automatic'] else 'configured',
+                              BACKEND_NAMES[plan['settings']['backend']]))
+        else:
+            plan = self._getExecutionPlan()
+        if plan is not None:
+            summary.append("Estimated for a %s map: %0.0f MB of peak memory and %0.0f s (limit %0.0f MB)\n"
+                           % ('x'.join(str(n) for n in plan['shape'][::-1]), plan['estimate']['memory'],
+                              plan['estimate']['time'], plan['memoryLimit']))
+        if self.applySymmetry.get():
+            for volume in self._iterInputVolumes():
+                if os.path.isfile(self._getSymmetryFile(volume)):
+                    symmetry = self._getAsymmetricUnit(volume)
+                    if 'regions' in symmetry:
+                        summary.append("%s symmetry (%d copies): %d regions segmented in the asymmetric unit of "
+                                       "%s, labelled k * %d + i in the k-th copy\n"
+                                       % (symmetry['group'], symmetry['copies'], symmetry['regions'],
+                                          self._getOutputBase(volume), symmetry['regions']))
+        if os.path.isfile(self._getTimingFile()):
+            summary.append("Time per stage (wall / CPU / peak memory):\n")
+            for total in StageTimer.load(self._getTimingFile()).totals():
+                summary.append("  %s: %0.2f s / %0.2f s / %0.1f MB\n"
+                               % (total['stage'], total['wall'], total['cpu'], total['peakRss']))
+                if total['stage'] == 'piece writing' and hasattr(self, 'outputGroups') and total['wall'] > 0:
+                    summary.append("  piece writing throughput: %0.1f pieces/s\n"
+                                   % (len(self.outputGroups) / total['wall']))
+        if os.path.isfile(self._getCoarseToFineFile()):
+            with open(self._getCoarseToFineFile()) as fid:
+                for entry in json.load(fid):
+                    summary.append("Coarse-to-fine (binning %d) %s: %0.1f s vs %0.1f s at full resolution, "
+                                   "region agreement %0.3f (leaf regions %0.3f)\n"
+                                   % (entry['binning'], entry['volume'], entry['coarseTime'], entry['fullTime'],
+                                      entry['regionAgreement'], entry['leafAgreement']))
         return summary
@@ -0,0 +1,172 @@
+# **************************************************************************
+# *
+# * Authors:     David Herreros Calero (dherreros@cnb.csic.es)
+# *
+# * BCU, Centro Nacional de Biotecnologia, CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+
+from pwem.objects import Volume, SetOfVolumes
+from pwem.protocols import EMProtocol
+
+import pyworkflow.protocol.params as params
+import pyworkflow.utils as pwutils
+
+from segger.segmentation import MergeTree
+from segger.convert import writeLabels, openLabels, slabSections, regionSlices, writePieces
+
+
+CUT_REGIONS = 0
+CUT_LEVEL = 1
+
+MEMORY_BUDGET = 1024 * 1024 * 1024
+
+
+class ProtSegmentRegroup(EMProtocol):
+    """Protocol to regroup a segmentation by cutting the merge hierarchy stored
+    in the .seg files of a previous 'segment map' run, either at a number of
+    regions or at a grouping level. No segmentation is computed again, so new
+    masks are obtained in seconds."""
+    _label = 'regroup segmentation'
+
+    def __init__(self, **kwargs):
+        EMProtocol.__init__(self, **kwargs)
+
+    # --------------------------- DEFINE param functions ----------------------
+    def _defineParams(self, form):
+        form.addSection(label='Input data')
+        form.addParam('inputProtocol', params.PointerParam, pointerClass='ProtSegmentMap',
+                      label='Segmentation run', important=True,
+                      help='Select a finished "segment map" run. Run it with "Record the complete hierarchy" '
+                           'to be able to regroup into fewer regions than its "Stop grouping" value')
+        form.addParam('cutMode', params.EnumParam, choices=['Number of regions', 'Level'], default=CUT_REGIONS,
+                      label='Cut hierarchy at', display=params.EnumParam.DISPLAY_HLIST,
+                      help='Number of regions: stop grouping once this number of regions or less is reached, '
+                           'as "Stop grouping" does\n'
+                           'Level: keep the groups formed up to this smoothing level (smoothing grouping) or '
+                           'step (connectivity grouping)')
+        form.addParam('numberOfRegions', params.IntParam, default=10, condition='cutMode == %d' % CUT_REGIONS,
+                      label='Number of regions')
+        form.addParam('level', params.FloatParam, default=3, condition='cutMode == %d' % CUT_LEVEL,
+                      label='Level')
+        form.addSection(label='Output')
+        form.addParam('outputPieces', params.BooleanParam, default=False, label='Output pieces?',
+                      help='Also write every region as a separate binary volume, cropped to its bounding box')
+
+    # --------------------------- INSERT steps functions ----------------------
+    def _insertAllSteps(self):
+        self._insertFunctionStep('regroupStep')
+        self._insertFunctionStep('createOutputStep')
+
+    # --------------------------- STEPS functions -----------------------------
+    def regroupStep(self):
+        for inputVolume in self._iterInputVolumes():
+            tree = MergeTree.fromSegFile(self.inputProtocol.get()._getSegFile(inputVolume))
+            if self.cutMode.get() == CUT_REGIONS:
+                cut = tree.cutAtRegions(self.numberOfRegions.get())
+            else:
+                cut = tree.cutAtLevel(self.level.get())
+            writeLabels(self._getMaskFile(inputVolume), tree.groupedMask(cut), inputVolume.getSamplingRate())
+
+    def createOutputStep(self):
+        inputProt = self.inputProtocol.get()
+        isSet = inputProt._isInputSet()
+        sr = inputProt.inputVolume.get().getSamplingRate()
+        if isSet:
+            setMasks = self._createSetOfVolumes(suffix='Masks')
+            setMasks.setSamplingRate(sr)
+        if self.outputPieces.get():
+            setVolumes = self._createSetOfVolumes()
+            setVolumes.setSamplingRate(sr)
+
+        for inputVolume in self._iterInputVolumes():
+            volume = Volume()
+            volume.setLocation(self._getMaskFile(inputVolume))
+            volume.setSamplingRate(sr)
+            if isSet:
+                volume.setObjId(inputVolume.getObjId())
+                setMasks.append(volume)
+            if self.outputPieces.get():
+                with openLabels(volume.getFileName()) as mrc:
+                    mask = mrc.data
+                    sections = slabSections(mask.shape, MEMORY_BUDGET)
+                    boxes = regionSlices(mask, 4, sections)
+                    paths, origins = {}, {}
+                    for idm, box in sorted(boxes.items()):
+                        paths[idm] = self._getExtraPath('%s_group_%d.mrc'
+                                                        % (pwutils.removeBaseExt(volume.getFileName()), idm))
+                        origins[idm] = inputProt._getPieceOrigin(inputVolume, [s.start for s in box])
+                    writePieces(mask, boxes, paths, sr, sections=sections, origins=origins)
+                for idm in sorted(boxes):
+                    piece = Volume()
+                    piece.setLocation(paths[idm])
+                    piece.setSamplingRate(sr)
+                    inputProt._setPieceOrigin(piece, origins[idm])
+                    setVolumes.append(piece)
+
+        outputSegmentation = setMasks if isSet else volume
+        self._defineOutputs(outputSegmentation=outputSegmentation)
+        self._defineSourceRelation(inputProt.inputVolume, outputSegmentation)
+        if self.outputPieces.get():
+            self._defineOutputs(outputGroups=setVolumes)
+            self._defineSourceRelation(inputProt.inputVolume, setVolumes)
+
+    # --------------------------- UTILS functions ----------------------------
+    def _iterInputVolumes(self):
+        return self.inputProtocol.get()._iterInputVolumes()
+
+    def _getMaskFile(self, volume):
+        return self._getExtraPath(os.path.basename(self.inputProtocol.get()._getMaskFile(volume)))
+
+    # --------------------------- DEFINE info functions ----------------------
+    def _validate(self):
+        errors = []
+        inputProt = self.inputProtocol.get()
+        if inputProt is not None:
+            if inputProt.applySymmetry.get():
+                # Its segmentation files only hold the asymmetric unit
+                errors.append('The input segmentation was computed with symmetry, which regrouping '
+                              'does not support. Run segment map again with the new grouping instead.')
+                return errors
+            for inputVolume in self._iterInputVolumes():
+                if not os.path.exists(inputProt._getSegFile(inputVolume)):
+                    errors.append('Segmentation file not found: %s' % inputProt._getSegFile(inputVolume))
+                    break
+        return errors
+
+    def _summary(self):
+        summary = []
+        if self.cutMode.get() == CUT_REGIONS:
+            summary.append("Hierarchy cut at %d regions\n" % self.numberOfRegions.get())
+        else:
+            summary.append("Hierarchy cut at level %s\n" % self.level.get())
+        if self.getOutputsSize() >= 1:
+            if isinstance(self.outputSegmentation, SetOfVolumes):
+                summary.append("Segmentation masks generated for %d volumes\n" % len(self.outputSegmentation))
+            else:
+                summary.append("Segmentation mask generated: %s\n" % self.outputSegmentation.getFileName())
+            if hasattr(self, 'outputGroups'):
+                summary.append("Groups separated into %d different masks\n" % len(self.outputGroups))
+        else:
+            summary.append("Regrouping not ready yet.")
+        return summary
@@ -0,0 +1,292 @@
+# **************************************************************************
+# *
+# * Authors:     David Herreros Calero (dherreros@cnb.csic.es)
+# *
+# * BCU, Centro Nacional de Biotecnologia, CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+import json
+import itertools
+import numpy as np
+
+from pwem.objects import Volume
+from pwem.protocols import EMProtocol
+from pwem.emlib.image import ImageHandler
+
+import pyworkflow.protocol.params as params
+import pyworkflow.utils as pwutils
+from pyworkflow.protocol.constants import STEPS_PARALLEL
+
+from segger import Plugin
+from segger.constants import *
+from segger.segmentation import segmentMap, mapStatistics
+from segger.cache import fileHash
+from segger.convert import writeLabels, compactLabels
+from .protocol_segment_map import writeChimeraScript, runChimeraScript
+
+
+class ProtSegmentSweep(EMProtocol):
+    """Protocol to explore the grouping parameters of the segmentation. Every
+    combination of the given values is segmented, in parallel when several
+    threads are used, and the number of regions obtained is reported. Only the
+    combinations closest to the desired number of regions are kept as outputs."""
+    _label = 'segment map sweep'
+
+    def __init__(self, **kwargs):
+        EMProtocol.__init__(self, **kwargs)
+        self.stepsExecutionMode = STEPS_PARALLEL
+
+    # --------------------------- DEFINE param functions ----------------------
+    def _defineParams(self, form):
+        form.addSection(label='Input data')
+        form.addParam('inputVolume', params.PointerParam, pointerClass='Volume', label='Input volume', important=True,
+                      help='Select a Volume to be segmented')
+        form.addSection(label='Mode')
+        form.addParam('backend', params.EnumParam, choices=BACKEND_NAMES, default=BACKEND_CHIMERA,
+                      label='Segmentation backend', display=params.EnumParam.DISPLAY_HLIST,
+                      help='Chimera: run Segger inside a headless Chimera session\n'
+                           'Native: run the watershed and grouping inside the protocol with NumPy/SciPy')
+        form.addParam('useCache', params.BooleanParam, default=True, expertLevel=params.LEVEL_ADVANCED,
+                      label='Reuse cached watershed regions?',
+                      help='The initial watershed regions only depend on the map and the threshold, so they are '
+                           'computed once per threshold and taken from the cache shared by all the runs for the '
+                           'other combinations')
+        form.addParam('grouping', params.EnumParam, choices=['Smoothing', 'Connectivity'], default=0,
+                      label='Grouping mode', display=params.EnumParam.DISPLAY_HLIST,
+                      help='smoothing tends to work better at lower resolutions (4A and lower)\n'
+                           'connectivity tends to work better at higher resolutions (4A and better)')
+        form.addParam('smoothSteps', params.StringParam, default='4', condition='grouping == 0',
+                      label='Number of smoothing steps',
+                      help='Values to try, as a list or ranges (e.g. "2 4 6" or "2-6")')
+        form.addParam('smoothStepSize', params.StringParam, default='3', condition='grouping == 0',
+                      label='Smoothing step size',
+                      help='Values to try, as a list or ranges (e.g. "1 3 5" or "1-5")')
+        form.addParam('connectSteps', params.StringParam, default='10', condition='grouping == 1',
+                      label='Number of connectivity steps',
+                      help='Values to try, as a list or ranges (e.g. "5 10 20" or "5-10")')
+        form.addSection('General parameters')
+        form.addParam('minRegionSize', params.IntParam, default=1, label='Minimum region size',
+                      help='Minimum region size in number of voxels (1 means no regions are removed)')
+        form.addParam('minContactVoxels', params.IntParam, default=0, label='Minimum contact voxels',
+                      help='0 means no regions are removed')
+        form.addParam('stopGroup', params.StringParam, default='1', label='Stop grouping',
+                      help='Values to try, as a list or ranges (e.g. "1 5 10")')
+        form.addParam('mapThreshold', params.StringParam, default='-1', label='Map threshold',
+                      help='Values to try (e.g. "0.01 0.02 0.03"). -1 means the automatic threshold below')
+        form.addParam('thresholdMode', params.EnumParam, choices=['Sigma', 'Percentile'], default=THRESHOLD_SIGMA,
+                      display=params.EnumParam.DISPLAY_HLIST, label='Automatic threshold',
+                      help='Threshold used for the -1 values of the map threshold, computed as in segment map '
+                           'from the statistics of the map: the mean plus a number of standard deviations, '
+                           'or a percentile of the map values')
+        form.addParam('thresholdSigma', params.FloatParam, default=3.0,
+                      condition='thresholdMode == %d' % THRESHOLD_SIGMA,
+                      label='Standard deviations above the mean')
+        form.addParam('thresholdPercentile', params.FloatParam, default=99.0,
+                      condition='thresholdMode == %d' % THRESHOLD_PERCENTILE,
+                      label='Percentile of the map values')
+        form.addSection(label='Output')
+        form.addParam('targetRegions', params.IntParam, default=10, label='Desired number of regions',
+                      help='The combinations giving the number of regions closest to this value are kept')
+        form.addParam('numberOfResults', params.IntParam, default=1, label='Number of results kept',
+                      help='Number of combinations registered as outputs')
+        form.addParallelSection(threads=4, mpi=0)
+
+    # --------------------------- INSERT steps functions ----------------------
+    def _insertAllSteps(self):
+        inputStep = self._insertFunctionStep('prepareInputStep', prerequisites=[])
+        segmentationSteps = []
+        # The first combination of every threshold fills the watershed cache for the others
+        firstSteps = {}
+        for idx, combination in enumerate(self._getCombinations()):
+            threshold = combination[3]
+            prerequisites = [firstSteps[threshold]] if self.useCache.get() and threshold in firstSteps else [inputStep]
+            step = self._insertFunctionStep('segmentationStep', idx, prerequisites=prerequisites)
+            firstSteps.setdefault(threshold, step)
+            segmentationSteps.append(step)
+        self._insertFunctionStep('createOutputStep', prerequisites=segmentationSteps)
+
+    # --------------------------- STEPS functions -----------------------------
+    def prepareInputStep(self):
+        """ Hash the input map once, to look up the cache from every combination,
+        and compute its automatic threshold when some combination uses it """
+        if self.useCache.get():
+            with open(self._getMapHashFile(), 'w') as fid:
+                fid.write(fileHash(self.inputVolume.get().getFileName()))
+        if any(combination[3] < 0 for combination in self._getCombinations()):
+            data = ImageHandler().read(self.inputVolume.get()).getData()
+            stats = mapStatistics(data, data.shape[0])
+            threshold = stats.threshold(self.thresholdMode.get(), self.thresholdSigma.get(),
+                                        self.thresholdPercentile.get())
+            with open(self._getThresholdFile(), 'w') as fid:
+                json.dump({'threshold': threshold, 'mean': stats.mean, 'std': stats.std}, fid)
+
+    def segmentationStep(self, idx):
+        """ Segment one combination. Steps are independent, so Scipion runs as
+        many of them at once as threads are given to the protocol """
+        pwutils.makePath(self._getCombinationPath(idx))
+        segParams = self._getSegmentationParams(idx)
+        inputVolume = self.inputVolume.get()
+        if self.backend.get() == BACKEND_NATIVE:
+            cache = Plugin.getCache() if self.useCache.get() else None
+            smod = segmentMap(ImageHandler().read(inputVolume).getData(), cache=cache,
+                              mapHash=self._getMapHash(), **segParams)
+            writeLabels(self._getMaskFile(idx), smod.groupedMask(), inputVolume.getSamplingRate())
+            smod.writeSegmentation(self._getSegFile(idx), name=pwutils.removeBaseExt(inputVolume.getFileName()),
+                                   mapPath=os.path.abspath(inputVolume.getFileName()))
+        else:
+            scriptFile = self._getTmpPath('scriptChimera_%03d.py' % idx)
+            writeChimeraScript(scriptFile, [(inputVolume.getFileName(), self._getMaskFile(idx),
+                                             self._getSegFile(idx), self._getChimeraCacheFile(idx))],
+                               **segParams)
+            runChimeraScript(scriptFile)
+            compactLabels(self._getMaskFile(idx))
+
+    def createOutputStep(self):
+        if self.useCache.get():
+            Plugin.getCache().evict()
+        ih = ImageHandler()
+        counts = []
+        for idx in range(len(self._getCombinations())):
+            mask = ih.read(self._getMaskFile(idx)).getData()
+            counts.append(len(np.unique(mask[mask > 0])))
+        self._writeSummaryTable(counts)
+
+        distance = np.abs(np.array(counts) - self.targetRegions.get())
+        for idx in np.argsort(distance, kind='stable')[:max(self.numberOfResults.get(), 1)]:
+            volume = Volume()
+            volume.setLocation(self._getMaskFile(idx))
+            volume.setSamplingRate(self.inputVolume.get().getSamplingRate())
+            volume.setObjComment(self._describeCombination(idx) + ', %d regions' % counts[idx])
+            self._defineOutputs(**{'outputSegmentation_%03d' % idx: volume})
+            self._defineSourceRelation(self.inputVolume, volume)
+
+    # --------------------------- UTILS functions ----------------------------
+    def _getCombinations(self):
+        """ List of (steps, step size, stop group, threshold) combinations. Steps
+        are smoothing or connectivity steps depending on the grouping mode and
+        step size is only meaningful for smoothing """
+        if self.grouping.get() == GROUPING_SMOOTHING:
+            steps = pwutils.getListFromRangeString(self.smoothSteps.get())
+            stepSizes = pwutils.getListFromRangeString(self.smoothStepSize.get())
+        else:
+            steps = pwutils.getListFromRangeString(self.connectSteps.get())
+            stepSizes = [0]
+        stops = pwutils.getListFromRangeString(self.stopGroup.get())
+        thresholds = pwutils.getFloatListFromValues(self.mapThreshold.get())
+        return list(itertools.product(steps, stepSizes, stops, thresholds))
+
+    def _getThresholdFile(self):
+        return self._getExtraPath('threshold.json')
+
+    def _getThreshold(self, threshold):
+        """ Value of a threshold of the combinations, the automatic one (written by
+        prepareInputStep) for negative ones """
+        if threshold >= 0:
+            return threshold
+        with open(self._getThresholdFile()) as fid:
+            return json.load(fid)['threshold']
+
+    def _getSegmentationParams(self, idx):
+        steps, stepSize, stop, threshold = self._getCombinations()[idx]
+        return {'threshold': self._getThreshold(threshold),
+                'groupingMode': self.grouping.get(),
+                'minRegionSize': self.minRegionSize.get(),
+                'minContactVoxels': self.minContactVoxels.get(),
+                'stopAtNumberOfRegions': stop,
+                'numSmoothingSteps': steps,
+                'smoothingStepSize': stepSize,
+                'numConnectivitySteps': steps}
+
+    def _describeCombination(self, idx):
+        steps, stepSize, stop, threshold = self._getCombinations()[idx]
+        if self.grouping.get() == GROUPING_SMOOTHING:
+            msg = 'smoothing steps %d, step size %d' % (steps, stepSize)
+        else:
+            msg = 'connectivity steps %d' % steps
+        return msg + ', stop grouping %d, threshold %g' % (stop, self._getThreshold(threshold))
+
+    def _getCombinationPath(self, idx, *paths):
+        return self._getExtraPath('combination_%03d' % idx, *paths)
+
+    def _getMaskFile(self, idx):
+        base = pwutils.removeBaseExt(self.inputVolume.get().getFileName())
+        return self._getCombinationPath(idx, 'segmask_' + base + '.mrc')
+
+    def _getSegFile(self, idx):
+        base = pwutils.removeBaseExt(self.inputVolume.get().getFileName())
+        return self._getCombinationPath(idx, 'seg_' + base + '.seg')
+
+    def _getMapHashFile(self):
+        return self._getTmpPath('map_hash.txt')
+
+    def _getMapHash(self):
+        """ Hash of the input map written by hashInputStep, None when the cache is not used """
+        if not self.useCache.get():
+            return None
+        with open(self._getMapHashFile()) as fid:
+            return fid.read().strip()
+
+    def _getChimeraCacheFile(self, idx):
+        """ Cache entry holding the initial watershed of a combination, '' when the cache is not used """
+        if not self.useCache.get():
+            return ''
+        cache = Plugin.getCache()
+        return cache.getFile(cache.getKey(self._getMapHash(), self._getThreshold(self._getCombinations()[idx][3])),
+                             '.seg')
+
+    def _getSummaryFile(self):
+        return self._getExtraPath('sweep_summary.txt')
+
+    def _writeSummaryTable(self, counts):
+        with open(self._getSummaryFile(), 'w') as f:
+            f.write('%-12s %-8s %-10s %-8s %-12s %s\n'
+                    % ('combination', 'steps', 'step_size', 'stop', 'threshold', 'regions'))
+            for idx, (steps, stepSize, stop, threshold) in enumerate(self._getCombinations()):
+                f.write('%-12d %-8d %-10d %-8d %-12g %d\n'
+                        % (idx, steps, stepSize, stop, self._getThreshold(threshold), counts[idx]))
+
+    # --------------------------- DEFINE info functions ----------------------
+    def _validate(self):
+        errors = []
+        try:
+            self._getCombinations()
+        except Exception as e:
+            errors.append('Could not parse the values to try: %s' % e)
+        return errors
+
+    def _summary(self):
+        summary = []
+        summary.append("Input Volume provided: %s\n"
+                       % self.inputVolume.get().getFileName())
+        if os.path.exists(self._getThresholdFile()):
+            with open(self._getThresholdFile()) as fid:
+                stats = json.load(fid)
+            summary.append("Automatic threshold: %g (mean %g, std %g)\n"
+                           % (stats['threshold'], stats['mean'], stats['std']))
+        if os.path.exists(self._getSummaryFile()):
+            summary.append("Regions obtained for every combination:\n")
+            with open(self._getSummaryFile()) as f:
+                summary.append(f.read())
+        else:
+            summary.append("Sweep not ready yet.")
+        return summary
@@ -0,0 +1,838 @@
+# **************************************************************************
+# *
+# * Authors:     David Herreros Calero (dherreros@cnb.csic.es)
+# *
+# * BCU, Centro Nacional de Biotecnologia, CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+from itertools import product
+
+import numpy as np
+from scipy import ndimage
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+from segger.constants import GROUPING_SMOOTHING, GROUPING_CONNECTIVITY, THRESHOLD_SIGMA, THRESHOLD_PERCENTILE
+from segger.profiling import StageTimer
+
+
+# Offsets of the 3x3x3 neighbourhood (z, y, x). The central voxel is CENTER
+OFFSETS = np.array(list(product((-1, 0, 1), repeat=3)), dtype=np.int64)
+CENTER = 13
+
+
+class MapStatistics(object):
+    """ Mean, variance, range and histogram of the values of a map, accumulated
+    in a single pass over chunks of it. The moments of every chunk are merged
+    with Chan's parallel update, which unlike summing squares does not lose
+    precision for maps far from zero mean. The histogram range starts at that
+    of the first chunk and doubles (merging pairs of bins) whenever a chunk
+    falls outside, so it never needs a previous pass for the range """
+
+    def __init__(self, bins=4096):
+        self.bins = bins + bins % 2
+        self.counts = np.zeros(self.bins, dtype=np.int64)
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+        self.lower = None
+        self.width = None
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64).ravel()
+        if not values.size:
+            return
+        n = values.size
+        mean = values.mean()
+        delta = mean - self.mean
+        total = self.count + n
+        self.m2 += np.square(values - mean).sum() + delta * delta * self.count * n / total
+        self.mean += delta * n / total
+        self.count = total
+        self.min = min(self.min, values.min())
+        self.max = max(self.max, values.max())
+        self._extendHistogram()
+        bins = ((values - self.lower) / self.width).astype(np.int64)
+        self.counts += np.bincount(np.clip(bins, 0, self.bins - 1), minlength=self.bins)
+
+    def _extendHistogram(self):
+        if self.lower is None:
+            self.lower = self.min
+            self.width = max(self.max - self.min, abs(self.min) * 1e-6, 1e-12) / self.bins
+            return
+        while self.max >= self.lower + self.width * self.bins:
+            self.counts = np.concatenate([self.counts.reshape(-1, 2).sum(axis=1),
+                                          np.zeros(self.bins // 2, dtype=np.int64)])
+            self.width *= 2
+        while self.min < self.lower:
+            self.counts = np.concatenate([np.zeros(self.bins // 2, dtype=np.int64),
+                                          self.counts.reshape(-1, 2).sum(axis=1)])
+            self.lower -= self.width * self.bins
+            self.width *= 2
+
+    @property
+    def std(self):
+        return float(np.sqrt(self.m2 / self.count)) if self.count else 0.0
+
+    def sigmaThreshold(self, sigma):
+        """ mean + sigma * std """
+        return float(self.mean + sigma * self.std)
+
+    def percentileThreshold(self, percentile):
+        """ Value below which the given percentage of the voxels lie, interpolated
+        within the histogram bins """
+        cumulative = np.cumsum(self.counts)
+        target = self.count * min(max(percentile, 0.0), 100.0) / 100.0
+        idx = min(int(np.searchsorted(cumulative, target)), self.bins - 1)
+        below = cumulative[idx - 1] if idx else 0
+        fraction = (target - below) / float(max(self.counts[idx], 1))
+        return float(min(max(self.lower + (idx + fraction) * self.width, self.min), self.max))
+
+    def threshold(self, mode, sigma=3.0, percentile=99.0):
+        """ Automatic threshold of the given mode: THRESHOLD_SIGMA (mean + sigma
+        * std) or THRESHOLD_PERCENTILE """
+        if mode == THRESHOLD_PERCENTILE:
+            return self.percentileThreshold(percentile)
+        return self.sigmaThreshold(sigma)
+
+
+def mapStatistics(data, sections=32, bins=4096):
+    """ MapStatistics of a map accumulated over slabs of sections, so that
+    memory-mapped maps are never fully loaded """
+    stats = MapStatistics(bins)
+    for z0 in range(0, data.shape[0], sections):
+        stats.update(data[z0:z0 + sections])
+    return stats
+
+
+def defaultThreshold(data, sigma=3.0, sections=32):
+    """ Threshold used by Segger when none is given: mean + 3 * std """
+    return mapStatistics(data, sections).sigmaThreshold(sigma)
+
+
+def thresholdPreview(data, stats=None, sigmas=(1, 2, 3, 4, 5), percentiles=(90, 95, 99, 99.5, 99.9),
+                     maxVoxels=96 ** 3):
+    """ Candidate automatic thresholds (standard deviations above the mean and
+    percentiles of the map values) with the approximate number of connected
+    regions above each. The thresholds come from stats, the MapStatistics of
+    the whole map the protocols compute (accumulated here if not given), so
+    they are the ones a run would use. Only the regions are counted on the map
+    subsampled to at most maxVoxels voxels, taking every n-th section, row and
+    column, so that only those sections of a memory-mapped map are read.
+    Returns a list of (threshold, mode, sigma or percentile, regions) sorted by
+    threshold and the subsampling step """
+    if stats is None:
+        stats = mapStatistics(data)
+    step = max(1, int(np.ceil((np.prod(data.shape) / float(maxVoxels)) ** (1.0 / 3))))
+    coarse = np.asarray(data[::step, ::step, ::step], dtype=np.float32)
+    candidates = [(stats.threshold(THRESHOLD_SIGMA, sigma=sigma), THRESHOLD_SIGMA, sigma)
+                  for sigma in sorted(set(sigmas))]
+    candidates += [(stats.threshold(THRESHOLD_PERCENTILE, percentile=percentile), THRESHOLD_PERCENTILE, percentile)
+                   for percentile in sorted(set(percentiles))]
+    return [(threshold, mode, value, int(ndimage.label(coarse > threshold)[1]))
+            for threshold, mode, value in sorted(candidates)], step
+
+
+def ascentPointers(values):
+    """ Flat index of the highest 26-neighbour of every voxel, or of the voxel
+    itself when no neighbour is higher. Background voxels must be -inf. """
+    shape = values.shape
+    padded = np.pad(values, 1, mode='constant', constant_values=-np.inf)
+    strides = np.array([shape[1] * shape[2], shape[2], 1], dtype=np.int64)
+    index = np.arange(values.size, dtype=np.int64).reshape(shape)
+    parent = index.copy()
+    best = values.copy()
+    for offset in OFFSETS:
+        if not offset.any():
+            continue
+        dz, dy, dx = offset + 1
+        neighbour = padded[dz:dz + shape[0], dy:dy + shape[1], dx:dx + shape[2]]
+        higher = neighbour > best
+        best[higher] = neighbour[higher]
+        parent[higher] = index[higher] + offset.dot(strides)
+    return parent.ravel()
+
+
+def mergePlateaus(parent, maxima):
+    """ Point every maximum to the representative (lowest index) voxel of its
+    plateau, the 26-connected set of maxima it belongs to (adjacent maxima
+    always share the same value). Returns the flat indices of the maxima and
+    of their representatives. """
+    plateaus, _ = ndimage.label(maxima, structure=np.ones((3, 3, 3)))
+    plateaus = plateaus.ravel()
+    maxIdx = np.flatnonzero(plateaus)
+    _, first = np.unique(plateaus[maxIdx], return_index=True)
+    representative = np.concatenate([[0], maxIdx[first]])[plateaus[maxIdx]]
+    parent[maxIdx] = representative
+    return maxIdx, representative
+
+
+def jumpPointers(parent, indices):
+    """ Pointer jumping over the given voxels until all of them point to a
+    fixed point. Returns the fixed point reached from every voxel. """
+    current = parent[indices]
+    while True:
+        jumped = parent[current]
+        if np.array_equal(jumped, current):
+            return current
+        parent[indices] = jumped
+        current = jumped
+
+
+def watershedRegions(data, threshold):
+    """ Immersive watershed of the voxels with density above threshold. Every
+    voxel is linked to its highest 26-neighbour until a local maximum is reached,
+    adjacent maxima of equal value are merged into a single region.
+    Returns the region label of every voxel (0 is background), numbered by
+    decreasing peak density, and the flat index of the peak of every region. """
+    data = np.asarray(data, dtype=np.float32)
+    shape = data.shape
+    foreground = data > threshold
+    parent = ascentPointers(np.where(foreground, data, -np.inf).astype(np.float32))
+    maxima = foreground.ravel() & (parent == np.arange(data.size))
+    mergePlateaus(parent, maxima.reshape(shape))
+    del maxima
+
+    fgIdx = np.flatnonzero(foreground)
+    peaks, inverse = np.unique(jumpPointers(parent, fgIdx), return_inverse=True)
+    order = np.lexsort((peaks, -data.ravel()[peaks]))
+    rank = np.empty(len(peaks), dtype=np.int32)
+    rank[order] = np.arange(1, len(peaks) + 1, dtype=np.int32)
+    labels = np.zeros(data.size, dtype=np.int32)
+    labels[fgIdx] = rank[inverse]
+    return labels.reshape(shape), peaks[order]
+
+
+def _tileBoxes(shape, tileSize, halo):
+    """ Tiles of the map as (core, extended, trusted) boxes of slices. Cores
+    partition the map, extended boxes add the halo and trusted boxes are the
+    extended ones without their outer layer, where every voxel sees all its
+    neighbours (the map borders are always trusted) """
+    ranges = [[(start, min(start + tileSize, n)) for start in range(0, n, tileSize)] for n in shape]
+    tiles = []
+    for bounds in product(*ranges):
+        core = tuple(slice(b0, b1) for b0, b1 in bounds)
+        ext = tuple(slice(max(b0 - halo, 0), min(b1 + halo, n)) for (b0, b1), n in zip(bounds, shape))
+        trusted = tuple(slice(e.start + (e.start > 0), e.stop - (e.stop < n)) for e, n in zip(ext, shape))
+        tiles.append((core, ext, trusted))
+    return tiles, [len(r) for r in ranges]
+
+
+def _localMask(box, ext):
+    mask = np.zeros(tuple(e.stop - e.start for e in ext), dtype=bool)
+    mask[tuple(slice(b.start - e.start, b.stop - e.start) for b, e in zip(box, ext))] = True
+    return mask
+
+
+def _readTile(source, ext):
+    """ Density of a tile of the map source: an MRC or .npy file (read
+    memory-mapped) or an array """
+    if isinstance(source, str):
+        if source.endswith('.npy'):
+            return np.array(np.load(source, mmap_mode='r')[ext], dtype=np.float32)
+        import mrcfile
+        with mrcfile.mmap(source, mode='r', permissive=True) as mrc:
+            return np.array(mrc.data[ext], dtype=np.float32)
+    return np.array(source[ext], dtype=np.float32)
+
+
+def _watershedTile(source, shape, core, ext, trusted, threshold, outFile):
+    """ Watershed of a single tile. Pointers are followed inside the core only,
+    so every core voxel ends at a peak or at the first voxel out of the core.
+    The index of that terminal voxel is saved for every core voxel in outFile.
+    Returns the global flat index and density of the terminals, and the pairs
+    (maximum, representative) of the plateaus seen out of the core with their
+    density. """
+    data = _readTile(source, ext)
+    localShape = data.shape
+    foreground = data > threshold
+    parent = ascentPointers(np.where(foreground, data, -np.inf).astype(np.float32))
+    index = np.arange(data.size, dtype=np.int64)
+    maxima = foreground.ravel() & (parent == index) & _localMask(trusted, ext).ravel()
+    maxIdx, representative = mergePlateaus(parent, maxima.reshape(localShape))
+
+    def toGlobal(flat):
+        coords = np.unravel_index(flat, localShape)
+        return np.ravel_multi_index(tuple(c + e.start for c, e in zip(coords, ext)), shape)
+
+    coreMask = _localMask(core, ext).ravel()
+    outside = ~coreMask[maxIdx]
+    plateauEdges = np.array([toGlobal(maxIdx[outside]), toGlobal(representative[outside])])
+    plateauValues = data.ravel()[maxIdx[outside]]
+
+    # Voxels out of the core are terminals
+    parent[~coreMask] = index[~coreMask]
+    coreFg = np.flatnonzero(coreMask & foreground.ravel())
+    terminals, inverse = np.unique(jumpPointers(parent, coreFg), return_inverse=True)
+    labels = np.zeros(data.size, dtype=np.int32)
+    labels[coreFg] = inverse + 1
+    coreLocal = tuple(slice(c.start - e.start, c.stop - e.start) for c, e in zip(core, ext))
+    np.save(outFile, labels.reshape(localShape)[coreLocal])
+    return toGlobal(terminals), data.ravel()[terminals], plateauEdges, plateauValues
+
+
+def tiledWatershedRegions(data, threshold, tileSize=128, halo=4, workers=1, source=None, workDir=None,
+                          out=None):
+    """ Same result as watershedRegions, computed over tiles with a halo of
+    overlap that are segmented independently, in parallel worker processes.
+    Region labels are then stitched across tiles with a union-find over the
+    voxels where a tile hands its paths over to its neighbours. Only one tile
+    per worker is held in memory: workers read their tiles from the MRC file
+    source when given (otherwise from a copy of the map in workDir when there
+    are several workers), and per-tile results are kept in workDir. The labels
+    are written to out (e.g. a memory-mapped array) when given. """
+    import shutil
+    import tempfile
+    from concurrent.futures import ProcessPoolExecutor
+
+    shape = data.shape
+    halo = max(halo, 2)
+    tiles, grid = _tileBoxes(shape, tileSize, halo)
+    ownWorkDir = workDir is None
+    if ownWorkDir:
+        workDir = tempfile.mkdtemp(prefix='segger_tiles_')
+    tileFiles = [os.path.join(workDir, 'tile_%06d.npy' % i) for i in range(len(tiles))]
+    try:
+        if source is None and workers > 1:
+            # Worker processes read their tiles from a copy of the map instead of receiving them all at once
+            source = os.path.join(workDir, 'map.npy')
+            np.save(source, np.asarray(data, dtype=np.float32))
+        elif source is None:
+            source = data
+        jobs = [(source, shape, core, ext, trusted, threshold, tileFile)
+                for (core, ext, trusted), tileFile in zip(tiles, tileFiles)]
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(_watershedTile, *zip(*jobs)))
+        else:
+            results = [_watershedTile(*job) for job in jobs]
+
+        # Nodes of the union-find are the terminal voxels and the plateau voxels
+        terminals = [r[0] for r in results]
+        edges = np.concatenate([r[2] for r in results], axis=1)
+        edgeValues = np.concatenate([r[3] for r in results])
+        nodes = np.concatenate(terminals + [edges[0], edges[1]])
+        values = np.concatenate([r[1] for r in results] + [edgeValues, edgeValues])
+        nodes, first, nodeInverse = np.unique(nodes, return_index=True, return_inverse=True)
+        values = values[first]
+
+        def owners(flat):
+            """ Tile whose core contains every voxel and its label there """
+            coords = np.unravel_index(flat, shape)
+            tileIdx = np.ravel_multi_index(tuple(c // tileSize for c in coords), grid)
+            labels = np.zeros(len(flat), dtype=np.int64)
+            for t in np.unique(tileIdx):
+                sel = tileIdx == t
+                tileLabels = np.load(tileFiles[t], mmap_mode='r')
+                core = tiles[t][0]
+                labels[sel] = tileLabels[tuple(c[sel] - b.start for c, b in zip(coords, core))]
+            return tileIdx, labels
+
+        offsets = np.cumsum([0] + [len(t) for t in terminals])
+
+        # Every node is the same region as the terminal it leads to in the tile
+        # that owns it, and maxima are the same region as their plateau representative
+        tileIdx, labels = owners(nodes)
+        first = np.concatenate([np.arange(len(nodes)), np.searchsorted(nodes, edges[0])])
+        second = np.concatenate([nodeInverse[offsets[tileIdx] + labels - 1], np.searchsorted(nodes, edges[1])])
+        graph = coo_matrix((np.ones(len(first)), (first, second)), shape=(len(nodes), len(nodes)))
+        numRegions, component = connected_components(graph, directed=True, connection='weak')
+
+        # Regions are numbered as watershedRegions does: by decreasing peak density
+        order = np.lexsort((nodes, -values, component))
+        isPeak = np.concatenate([[True], component[order][1:] != component[order][:-1]])
+        peakNodes = order[isPeak]
+        peakOrder = np.lexsort((nodes[peakNodes], -values[peakNodes]))
+        rank = np.empty(numRegions, dtype=np.int32)
+        rank[component[peakNodes[peakOrder]]] = np.arange(1, numRegions + 1, dtype=np.int32)
+
+        if out is None:
+            out = np.zeros(shape, dtype=np.int32)
+        for t, (core, _, _) in enumerate(tiles):
+            tileLabels = np.load(tileFiles[t])
+            nodeIdx = nodeInverse[offsets[t]:offsets[t + 1]]
+            lut = np.concatenate([[0], rank[component[nodeIdx]]]).astype(np.int32)
+            out[core] = lut[tileLabels]
+        return out, nodes[peakNodes[peakOrder]]
+    finally:
+        if ownWorkDir:
+            shutil.rmtree(workDir, ignore_errors=True)
+
+
+def binMap(data, factor):
+    """ Average of the map over blocks of factor^3 voxels. The last block along
+    every axis averages the voxels available. """
+    data = np.asarray(data, dtype=np.float32)
+    coarseShape = tuple(-(-n // factor) for n in data.shape)
+    total = np.zeros(coarseShape, dtype=np.float64)
+    counts = np.zeros(coarseShape, dtype=np.float64)
+    for start in product(range(factor), repeat=3):
+        block = data[start[0]::factor, start[1]::factor, start[2]::factor]
+        box = tuple(slice(0, n) for n in block.shape)
+        total[box] += block
+        counts[box] += 1
+    return (total / counts).astype(np.float32)
+
+
+def upsampleLabels(labels, factor, shape):
+    """ Nearest neighbour projection of a label map binned by factor """
+    for axis in range(3):
+        labels = np.repeat(labels, factor, axis=axis)
+    return np.ascontiguousarray(labels[:shape[0], :shape[1], :shape[2]])
+
+
+def refineLabels(data, coarseLabels, factor, threshold):
+    """ Full resolution labels from the labels of the map binned by factor. Voxels
+    within factor voxels of a change of label (including the foreground border)
+    and foreground voxels left without label are reassigned following the
+    steepest ascent at full resolution up to a voxel whose label is kept. Ascents
+    ending at a maximum inside the refined band take the coarse label there. """
+    data = np.asarray(data, dtype=np.float32)
+    labels = upsampleLabels(coarseLabels, factor, data.shape)
+    size = 2 * factor + 1
+    band = ndimage.maximum_filter(labels, size) != ndimage.minimum_filter(labels, size)
+    foreground = data > threshold
+    band |= foreground & (labels == 0)
+    labels[~foreground] = 0
+    band &= foreground
+
+    parent = ascentPointers(np.where(foreground, data, -np.inf).astype(np.float32))
+    kept = ~band.ravel()
+    parent[kept] = np.flatnonzero(kept)
+    del kept
+    bandIdx = np.flatnonzero(band)
+    flat = labels.ravel()
+    flat[bandIdx] = flat[jumpPointers(parent, bandIdx)]
+    return labels
+
+
+def ascend(values, start):
+    """ Follow the steepest ascent path over values from every flat index in
+    start until a local maximum is reached. Returns the flat indices reached. """
+    shape = values.shape
+    padded = np.pad(values, 1, mode='constant', constant_values=-np.inf)
+    flat = padded.ravel()
+    pshape = padded.shape
+    offsets = OFFSETS.dot(np.array([pshape[1] * pshape[2], pshape[2], 1]))
+    coords = np.array(np.unravel_index(np.asarray(start, dtype=np.int64), shape)) + 1
+    position = np.ravel_multi_index(coords, pshape)
+    active = np.arange(len(position))
+    while active.size:
+        neighbours = position[active, None] + offsets[None, :]
+        neighValues = flat[neighbours]
+        best = np.argmax(neighValues, axis=1)
+        rows = np.arange(len(active))
+        moved = neighValues[rows, best] > neighValues[:, CENTER]
+        position[active[moved]] = neighbours[rows[moved], best[moved]]
+        active = active[moved]
+    coords = np.array(np.unravel_index(position, pshape)) - 1
+    return np.ravel_multi_index(coords, shape)
+
+
+def regionContacts(labels, data=None):
+    """ Pairs of labels (a < b) sharing at least one voxel face, the number of
+    faces they share and, if data is given, the highest density found along
+    their boundary (the minimum of the two voxels at every face). """
+    first, second, density = [], [], []
+    for axis in range(3):
+        lower = [slice(None)] * 3
+        upper = [slice(None)] * 3
+        lower[axis] = slice(None, -1)
+        upper[axis] = slice(1, None)
+        a = labels[tuple(lower)]
+        b = labels[tuple(upper)]
+        touch = (a != b) & (a > 0) & (b > 0)
+        la, lb = a[touch].astype(np.int64), b[touch].astype(np.int64)
+        first.append(np.minimum(la, lb))
+        second.append(np.maximum(la, lb))
+        if data is not None:
+            density.append(np.minimum(data[tuple(lower)][touch], data[tuple(upper)][touch]))
+    first = np.concatenate(first)
+    second = np.concatenate(second)
+    if first.size == 0:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, empty, np.zeros(0, dtype=np.float32)
+
+    key = first * (int(second.max()) + 1) + second
+    uniqueKeys, position, inverse, counts = np.unique(key, return_index=True, return_inverse=True,
+                                                     return_counts=True)
+    maxDensity = None
+    if data is not None:
+        density = np.concatenate(density)
+        maxDensity = np.full(len(uniqueKeys), -np.inf, dtype=np.float32)
+        np.maximum.at(maxDensity, inverse, density)
+    return first[position], second[position], counts, maxDensity
+
+
+def labelAgreement(reference, labels):
+    """ Fraction of the voxels labelled in any of both maps whose label matches
+    the reference, after mapping every label to the reference label it overlaps
+    most with. Used to check the native backend against Chimera output. """
+    reference = np.asarray(reference).astype(np.int64).ravel()
+    labels = np.asarray(labels).astype(np.int64).ravel()
+    foreground = (reference > 0) | (labels > 0)
+    total = np.count_nonzero(foreground)
+    if total == 0:
+        return 1.0
+    reference = reference[foreground]
+    labels = labels[foreground]
+    size = int(reference.max()) + 1
+    overlap = coo_matrix((np.ones(total), (labels, reference)),
+                         shape=(int(labels.max()) + 1, size)).tocsr()
+    overlap = overlap[1:, 1:]
+    if overlap.nnz == 0:
+        return 0.0
+    return float(overlap.max(axis=1).sum()) / total
+
+
+class Segmentation(object):
+    """ In-process counterpart of Segger's regions.Segmentation. The initial
+    watershed regions are the leaves of a merge tree, every grouping step adds
+    new parent nodes on top of the current roots. Node 0 is reserved for the
+    background. """
+
+    def __init__(self, data):
+        self.data = np.asarray(data, dtype=np.float32)
+        self.threshold = None
+        self.regions = None
+        self.numLeaves = 0
+        self.parents = np.zeros(1, dtype=np.int64)
+        self.levels = np.zeros(1, dtype=np.float32)
+        self.refPoints = np.zeros(1, dtype=np.int64)
+        self.roots = np.zeros(0, dtype=np.int64)
+
+    def calculateWatershedRegions(self, threshold, tiling=None):
+        """ Initial watershed regions. tiling holds the keyword arguments of
+        tiledWatershedRegions to compute them by tiles """
+        if tiling:
+            regions, peaks = tiledWatershedRegions(self.data, threshold, **tiling)
+        else:
+            regions, peaks = watershedRegions(self.data, threshold)
+        self.setWatershedRegions(regions, peaks, threshold)
+
+    def setWatershedRegions(self, regions, peaks, threshold):
+        """ Start from already computed watershed regions (e.g. cached ones) """
+        self.threshold = threshold
+        self.regions = regions
+        self.numLeaves = len(peaks)
+        self.parents = np.zeros(self.numLeaves + 1, dtype=np.int64)
+        self.levels = np.zeros(self.numLeaves + 1, dtype=np.float32)
+        self.refPoints = np.concatenate([[0], peaks]).astype(np.int64)
+        self.roots = np.arange(1, self.numLeaves + 1, dtype=np.int64)
+
+    def removeSmallRegions(self, minRegionSize):
+        sizes = np.bincount(self.regions.ravel(), minlength=self.numLeaves + 1)
+        self._removeLeaves(sizes < minRegionSize)
+
+    def removeContactRegions(self, minContactVoxels):
+        a, b, counts, _ = regionContacts(self.regions)
+        contacts = np.bincount(np.concatenate([a, b]), weights=np.concatenate([counts, counts]),
+                               minlength=self.numLeaves + 1)
+        self._removeLeaves(contacts < minContactVoxels)
+
+    def smoothAndGroup(self, numSteps, stepSize, stopAtNumberOfRegions=1):
+        foreground = self.regions > 0
+        for step in range(1, numSteps + 1):
+            if len(self.roots) <= stopAtNumberOfRegions:
+                break
+            sdev = step * stepSize
+            smoothed = ndimage.gaussian_filter(self.data, sdev)
+            smoothed[~foreground] = -np.inf
+            maxima = ascend(smoothed, self.refPoints[self.roots])
+            self._merge(maxima, sdev, refs=maxima)
+
+    def groupConnectedN(self, numSteps, stopAtNumberOfRegions=1):
+        for step in range(1, numSteps + 1):
+            if len(self.roots) <= stopAtNumberOfRegions:
+                break
+            # Every group joins the neighbour it shares the densest boundary with
+            a, b, _, density = regionContacts(self.groupLabels(compact=True), self.data)
+            if a.size == 0:
+                break
+            source = np.concatenate([a, b])
+            target = np.concatenate([b, a])
+            density = np.concatenate([density, density])
+            order = np.lexsort((-density, source))
+            source, target = source[order], target[order]
+            first = np.concatenate([[True], source[1:] != source[:-1]])
+            n = len(self.roots) + 1
+            graph = coo_matrix((np.ones(np.count_nonzero(first)), (source[first], target[first])),
+                               shape=(n, n))
+            _, components = connected_components(graph, directed=True, connection='weak')
+            self._merge(components[1:], step)
+
+    def groupedRegions(self):
+        """ Current groups sorted by decreasing number of voxels """
+        sizes = np.bincount(self.groupLabels(compact=True).ravel(), minlength=len(self.roots) + 1)[1:]
+        return self.roots[np.argsort(-sizes, kind='stable')]
+
+    def groupLabels(self, compact=False):
+        """ Label of the group every voxel belongs to. Groups are numbered by
+        node id or, if compact, by their position in self.roots (1-based). """
+        top = self.rootLookup()
+        if compact:
+            position = np.zeros(len(self.parents), dtype=np.int64)
+            position[self.roots] = np.arange(1, len(self.roots) + 1)
+            top = position[top]
+        return top[:self.numLeaves + 1][self.regions]
+
+    def groupedMask(self):
+        """ Mask with one identifier per group (1 being the largest one), as
+        written by Segger's export_mask """
+        top = self.rootLookup()
+        ids = np.zeros(len(self.parents), dtype=np.int32)
+        ids[self.groupedRegions()] = np.arange(1, len(self.roots) + 1)
+        return ids[top[:self.numLeaves + 1]][self.regions]
+
+    def rootLookup(self):
+        """ Root node of every node of the merge tree """
+        top = np.arange(len(self.parents), dtype=np.int64)
+        top[self.parents > 0] = self.parents[self.parents > 0]
+        while True:
+            jumped = top[top]
+            if np.array_equal(jumped, top):
+                return top
+            top = jumped
+
+    def writeSegmentation(self, path, name='', mapPath=''):
+        """ Write the segmentation and its merge tree in Segger's .seg format """
+        import h5py
+        ids = np.flatnonzero(~self._removedNodes())
+        refs = np.array(np.unravel_index(self.refPoints[ids], self.data.shape))[::-1].T
+        colors = np.random.RandomState(0).uniform(0.2, 1.0, (len(ids), 4)).astype(np.float32)
+        colors[:, 3] = 1.0
+        with h5py.File(path, 'w') as f:
+            f.attrs['format'] = 'segger'
+            f.attrs['format_version'] = 2
+            f.attrs['name'] = name
+            f.attrs['map_path'] = mapPath
+            f.attrs['map_level'] = self.threshold
+            f.attrs['map_size'] = np.array(self.data.shape[::-1], dtype=np.int32)
+            f.create_dataset('mask', data=self.regions.astype(np.uint32), compression='gzip')
+            f.create_dataset('region_ids', data=ids.astype(np.uint32))
+            f.create_dataset('parent_ids', data=self.parents[ids].astype(np.uint32))
+            f.create_dataset('region_colors', data=colors)
+            f.create_dataset('ref_points', data=refs.astype(np.float32))
+            f.create_dataset('smoothing_levels', data=self.levels[ids])
+
+    def refineRegions(self, data, factor):
+        """ Move a segmentation of the map binned by factor to the full resolution
+        map. The merge tree is kept, only the leaf regions near a border are
+        recomputed at full resolution. """
+        data = np.asarray(data, dtype=np.float32)
+        coarseShape = self.data.shape
+        self.regions = refineLabels(data, self.regions, factor, self.threshold)
+        coords = np.unravel_index(self.refPoints, coarseShape)
+        coords = tuple(np.minimum(c * factor + factor // 2, n - 1) for c, n in zip(coords, data.shape))
+        self.refPoints = np.ravel_multi_index(coords, data.shape).astype(np.int64)
+        self.data = data
+
+    # --------------------------- private helpers ---------------------------
+    def _removeLeaves(self, removed):
+        removed[0] = False
+        keep = np.arange(self.numLeaves + 1, dtype=np.int32)
+        keep[removed] = 0
+        self.regions = keep[self.regions]
+        self.roots = self.roots[~removed[self.roots]]
+
+    def _removedNodes(self):
+        removed = np.zeros(len(self.parents), dtype=bool)
+        present = np.zeros(self.numLeaves + 1, dtype=bool)
+        present[np.unique(self.regions)] = True
+        removed[:self.numLeaves + 1] = ~present
+        removed[0] = True
+        return removed
+
+    def _merge(self, keys, level, refs=None):
+        """ Group the current roots sharing the same key into new nodes. The
+        reference point of a new node is the densest of its members refs. """
+        if refs is None:
+            refs = self.refPoints[self.roots]
+        _, inverse, counts = np.unique(keys, return_inverse=True, return_counts=True)
+        merged = counts > 1
+        numNew = int(np.count_nonzero(merged))
+        if numNew == 0:
+            return
+        newIds = np.zeros(len(counts), dtype=np.int64)
+        newIds[merged] = len(self.parents) + np.arange(numNew)
+        children = merged[inverse]
+
+        # Densest member ref of every group
+        order = np.lexsort((-self.data.ravel()[refs], inverse))
+        firstOfGroup = np.concatenate([[True], inverse[order][1:] != inverse[order][:-1]])
+        groupRefs = refs[order][firstOfGroup]
+
+        self.parents = np.concatenate([self.parents, np.zeros(numNew, dtype=np.int64)])
+        self.parents[self.roots[children]] = newIds[inverse[children]]
+        self.levels = np.concatenate([self.levels, np.full(numNew, level, dtype=np.float32)])
+        self.refPoints = np.concatenate([self.refPoints, groupRefs[merged]])
+        self.roots = np.concatenate([self.roots[~children], newIds[merged]])
+
+
+class MergeTree(object):
+    """ Merge hierarchy of a segmentation, as stored in Segger's .seg files. The
+    mask labels every voxel with its leaf region, every node has a parent (0 for
+    the roots) and the level (smoothing level or grouping step) at which it was
+    created. Cutting the tree gives a new grouping without segmenting again. """
+
+    def __init__(self, mask, ids, parents, levels):
+        self.mask = np.asarray(mask).astype(np.int64, copy=False)
+        ids = np.asarray(ids, dtype=np.int64)
+        size = int(max(ids.max() if ids.size else 0, self.mask.max())) + 1
+        self.parents = np.zeros(size, dtype=np.int64)
+        self.parents[ids] = parents
+        self.levels = np.zeros(size, dtype=np.float64)
+        self.levels[ids] = levels
+        self.nodes = np.zeros(size, dtype=bool)
+        self.nodes[ids] = True
+        self.nodes[np.unique(self.mask)] = True
+        self.nodes[0] = False
+        self._checkLevels()
+
+    @classmethod
+    def fromSegFile(cls, path):
+        import h5py
+        with h5py.File(path, 'r') as f:
+            ids = f['region_ids'][()]
+            levels = f['smoothing_levels'][()] if 'smoothing_levels' in f else np.zeros(len(ids))
+            return cls(f['mask'][()], ids, f['parent_ids'][()], levels)
+
+    @classmethod
+    def fromSegmentation(cls, smod):
+        ids = np.flatnonzero(~smod._removedNodes())
+        return cls(smod.regions, ids, smod.parents[ids], smod.levels[ids])
+
+    def getLevels(self):
+        """ Levels at which the tree can be cut, from the leaves to the roots """
+        return np.unique(self.levels[self.nodes])
+
+    def cutAtLevel(self, level):
+        """ Groups obtained when grouping up to the given level """
+        parentLevels = self.levels[self.parents]
+        return np.flatnonzero(self.nodes & (self.levels <= level) &
+                              ((self.parents == 0) | (parentLevels > level)))
+
+    def cutAtRegions(self, numberOfRegions):
+        """ Groups obtained when stopping the grouping at numberOfRegions, i.e. at
+        the first level giving that many regions or less """
+        for level in self.getLevels():
+            cut = self.cutAtLevel(level)
+            if len(cut) <= numberOfRegions:
+                return cut
+        return self.cutAtLevel(np.inf)
+
+    def groupedMask(self, cut):
+        """ Mask with one identifier per group of the cut (1 being the largest one) """
+        inCut = np.zeros(len(self.parents), dtype=bool)
+        inCut[cut] = True
+        ancestor = np.arange(len(self.parents))
+        pending = ~inCut[ancestor] & (self.parents[ancestor] > 0)
+        while pending.any():
+            ancestor[pending] = self.parents[ancestor[pending]]
+            pending = ~inCut[ancestor] & (self.parents[ancestor] > 0)
+        ancestor[~inCut[ancestor]] = 0
+        sizes = np.bincount(ancestor[self.mask].ravel(), minlength=len(ancestor))
+        sizes[0] = 0
+        ids = np.zeros(len(ancestor), dtype=np.int32)
+        ids[cut[np.argsort(-sizes[cut], kind='stable')]] = np.arange(1, len(cut) + 1)
+        return ids[ancestor][self.mask]
+
+    def _checkLevels(self):
+        """ Levels must grow from the leaves to the roots. Trees stored without
+        grouping levels are cut by the height of their nodes instead """
+        children = np.flatnonzero(self.nodes & (self.parents > 0))
+        if np.all(self.levels[self.parents[children]] > self.levels[children]):
+            return
+        height = np.zeros(len(self.parents))
+        while True:
+            updated = height.copy()
+            np.maximum.at(updated, self.parents[children], height[children] + 1)
+            if np.array_equal(updated, height):
+                break
+            height = updated
+        self.levels = height
+
+
+def segmentMap(data, threshold=None, groupingMode=GROUPING_SMOOTHING, minRegionSize=1,
+               minContactVoxels=0, stopAtNumberOfRegions=1, numSmoothingSteps=4,
+               smoothingStepSize=3, numConnectivitySteps=10, cache=None, mapHash=None, tiling=None,
+               binning=1, timer=None):
+    """ Same sequence of operations as the Chimera script run by ProtSegmentMap.
+    Without threshold (None) mean + 3 * std is used; any other value, negative
+    ones included, is used as given. When a WatershedCache and the hash of the
+    map are given, the initial watershed regions are taken from the cache if
+    present and stored otherwise. tiling holds the keyword arguments of tiledWatershedRegions to compute the
+    watershed by tiles. With binning > 1 the map binned by that factor is
+    segmented (sizes and smoothing scaled accordingly) and the regions are
+    refined at full resolution. Every stage is recorded in timer (a StageTimer)
+    if given. """
+    timer = timer or StageTimer()
+    if threshold is None:
+        with timer.stage('threshold'):
+            threshold = defaultThreshold(data)
+    if binning > 1:
+        with timer.stage('binning'):
+            coarse = binMap(data, binning)
+        # The coarse map is kept in memory and cached apart from the full resolution one
+        if tiling:
+            tiling = dict(tiling, source=None, out=None)
+        smod = segmentMap(coarse, threshold, groupingMode,
+                          minRegionSize=max(1, int(round(minRegionSize / float(binning ** 3)))),
+                          minContactVoxels=int(round(minContactVoxels / float(binning ** 2))),
+                          stopAtNumberOfRegions=stopAtNumberOfRegions,
+                          numSmoothingSteps=numSmoothingSteps,
+                          smoothingStepSize=smoothingStepSize / float(binning),
+                          numConnectivitySteps=numConnectivitySteps, cache=cache,
+                          mapHash='%s_bin%d' % (mapHash, binning) if mapHash else None, tiling=tiling,
+                          timer=timer)
+        with timer.stage('refinement'):
+            smod.refineRegions(data, binning)
+        return smod
+    smod = Segmentation(data)
+    cached = None
+    if cache is not None and mapHash is not None:
+        with timer.stage('watershed cache lookup'):
+            key = cache.getKey(mapHash, threshold)
+            cached = cache.loadRegions(key)
+    if cached is not None:
+        smod.setWatershedRegions(cached[0], cached[1], threshold)
+    else:
+        with timer.stage('watershed'):
+            smod.calculateWatershedRegions(threshold, tiling)
+        if cache is not None and mapHash is not None:
+            with timer.stage('watershed cache store'):
+                cache.storeRegions(key, smod.regions, smod.refPoints[1:])
+    if minRegionSize > 1:
+        with timer.stage('remove small regions'):
+            smod.removeSmallRegions(minRegionSize)
+    if minContactVoxels > 0:
+        with timer.stage('remove contact regions'):
+            smod.removeContactRegions(minContactVoxels)
+    with timer.stage('grouping'):
+        if groupingMode == GROUPING_SMOOTHING:
+            smod.smoothAndGroup(numSmoothingSteps, smoothingStepSize, stopAtNumberOfRegions)
+        elif groupingMode == GROUPING_CONNECTIVITY:
+            smod.groupConnectedN(numConnectivitySteps, stopAtNumberOfRegions)
+    return smod
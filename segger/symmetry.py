@@ -0,0 +1,135 @@
+# **************************************************************************
+# *
+# * Authors:     David Herreros Calero (dherreros@cnb.csic.es)
+# *
+# * BCU, Centro Nacional de Biotecnologia, CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+import numpy as np
+from scipy import ndimage
+
+
+# Generic direction (not on any symmetry axis) whose symmetry copies define the
+# asymmetric units as their Voronoi cells
+REFERENCE_DIRECTION = np.array([0.3129, 0.4967, 0.8095])
+
+
+def getRotations(symmetryGroup, symmetryOrder=1):
+    """ Rotation matrices (acting on x, y, z) of a Scipion symmetry group """
+    from pwem.convert.symmetry import getSymmetryMatrices
+    matrices = getSymmetryMatrices(sym=symmetryGroup, n=symmetryOrder)
+    return np.array([np.asarray(matrix)[:3, :3] for matrix in matrices], dtype=np.float64)
+
+
+def symmetryCenter(shape):
+    """ Voxel (z, y, x) the symmetry axes go through: the center of the box """
+    return np.array([n // 2 for n in shape], dtype=np.float64)
+
+
+def symmetryCells(shape, rotations, sections=None):
+    """ Symmetry copy of the asymmetric unit every voxel belongs to (0 is the
+    asymmetric unit). Copy k is the set of voxels whose direction from the center
+    is closest to the k-th copy of REFERENCE_DIRECTION. The box is processed in
+    slabs of the given number of Z sections (all of them if None), keeping the
+    best projection so far in float32 (about 8 bytes per voxel of the slab) """
+    directions = np.dot(rotations, REFERENCE_DIRECTION / np.linalg.norm(REFERENCE_DIRECTION))
+    directions = directions.astype(np.float32)
+    center = symmetryCenter(shape)
+    sections = shape[0] if sections is None else max(int(sections), 1)
+    cells = np.zeros(shape, dtype=np.int16)
+    # Broadcast coordinates, so that only the projections take a whole slab
+    x = (np.arange(shape[2]) - center[2]).astype(np.float32)[None, None, :]
+    y = (np.arange(shape[1]) - center[1]).astype(np.float32)[None, :, None]
+    for z0 in range(0, shape[0], sections):
+        z1 = min(z0 + sections, shape[0])
+        z = (np.arange(z0, z1) - center[0]).astype(np.float32)[:, None, None]
+        best = x * directions[0, 0] + y * directions[0, 1] + z * directions[0, 2]
+        slab = cells[z0:z1]
+        for k in range(1, len(directions)):
+            projection = x * directions[k, 0] + y * directions[k, 1] + z * directions[k, 2]
+            closer = projection > best
+            best[closer] = projection[closer]
+            slab[closer] = k
+    return cells
+
+
+def asymmetricUnitMask(cells, margin):
+    """ Voxels of the asymmetric unit and those within margin voxels of it """
+    if margin <= 0:
+        return cells == 0
+    return ndimage.distance_transform_edt(cells != 0) <= margin
+
+
+def keepAsymmetricRegions(labels, cells):
+    """ Keep the regions of a segmentation of the asymmetric unit (plus margin)
+    having more voxels in the asymmetric unit than in any of its copies,
+    numbered consecutively. The other ones are copies of kept regions.
+    Returns the new labels and their number """
+    labels = np.asarray(labels).astype(np.int64)
+    numLabels = int(labels.max()) + 1
+    numCells = int(cells.max()) + 1
+    counts = np.bincount((labels * numCells + cells).ravel(),
+                         minlength=numLabels * numCells).reshape(numLabels, numCells)
+    keep = (np.argmax(counts, axis=1) == 0) & (counts.sum(axis=1) > 0)
+    keep[0] = False
+    lookup = np.zeros(numLabels, dtype=np.int32)
+    lookup[keep] = np.arange(1, np.count_nonzero(keep) + 1)
+    return lookup[labels], int(np.count_nonzero(keep))
+
+
+def expandSymmetry(labels, numRegions, rotations, cells=None):
+    """ Label map of the whole box from the regions of the asymmetric unit. The
+    copy k of region i is labelled k * numRegions + i, so the same region keeps
+    consistent ids in every copy. Every copy is pulled with nearest neighbour
+    interpolation within its bounding box only. Where copies overlap, the voxel
+    goes to the copy owning it according to cells (see symmetryCells), or to
+    the first one if not given. """
+    shape = labels.shape
+    center = symmetryCenter(shape)
+    out = np.zeros(shape, dtype=np.int32)
+    occupied = np.argwhere(labels > 0)
+    if occupied.size == 0:
+        return out
+    lower, upper = occupied.min(axis=0), occupied.max(axis=0)
+    corners = np.array([[(lower, upper)[bit][axis] for axis, bit in enumerate(bits)]
+                        for bits in np.ndindex(2, 2, 2)], dtype=np.float64)
+    # Rotations act on (x, y, z), the arrays are indexed (z, y, x)
+    flip = np.eye(3)[::-1]
+    for k, rotation in enumerate(rotations):
+        rotationZyx = flip.dot(rotation).dot(flip)
+        rotated = (corners - center).dot(rotationZyx.T) + center
+        start = np.maximum(np.floor(rotated.min(axis=0)).astype(int) - 1, 0)
+        stop = np.minimum(np.ceil(rotated.max(axis=0)).astype(int) + 2, shape)
+        if np.any(stop <= start):
+            continue
+        box = tuple(slice(s, e) for s, e in zip(start, stop))
+        grid = np.indices(stop - start).reshape(3, -1).T + start
+        source = (grid - center).dot(rotationZyx) + center
+        copy = ndimage.map_coordinates(labels, source.T, order=0, mode='constant', cval=0)
+        copy = copy.reshape(stop - start)
+        target = out[box]
+        fill = (copy > 0) & (target == 0)
+        if cells is not None:
+            fill |= (copy > 0) & (cells[box] == k)
+        target[fill] = copy[fill] + k * numRegions
+    return out
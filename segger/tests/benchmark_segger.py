@@ -0,0 +1,138 @@
+# **************************************************************************
+# *
+# * Authors:     David Herreros Calero (dherreros@cnb.csic.es)
+# *
+# * BCU, Centro Nacional de Biotecnologia, CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+import os
+import json
+import time
+import platform
+import multiprocessing
+
+from pwem.protocols import ProtImportVolumes
+
+from pyworkflow.tests import BaseTest, setupTestProject
+
+from .. import __version__
+from ..constants import *
+from ..protocols.protocol_segment_map import ProtSegmentMap
+from .synthetic import writeSyntheticMap
+
+
+def _getList(var, default, cast=int):
+    return [cast(value) for value in os.environ.get(var, default).split(',') if value.strip()]
+
+
+# Benchmark configuration, overridden with environment variables
+SIZES = _getList('SEGGER_BENCHMARK_SIZES', '64,128')  # from 64 to 1024
+REGIONS = _getList('SEGGER_BENCHMARK_REGIONS', '20')
+BACKENDS = _getList('SEGGER_BENCHMARK_BACKENDS', 'Chimera,Native', str)
+ATOMS_PER_REGION = int(os.environ.get('SEGGER_BENCHMARK_ATOMS', 1))  # 1: Gaussian blobs, else pseudo-atoms
+NOISE = float(os.environ.get('SEGGER_BENCHMARK_NOISE', 0.01))
+REPORT = os.environ.get('SEGGER_BENCHMARK_REPORT', '')
+
+GROUPINGS = {GROUPING_SMOOTHING: 'Smoothing', GROUPING_CONNECTIVITY: 'Connectivity'}
+OUTPUTS = {OUTPUT_MASK: 'Mask', OUTPUT_PIECES: 'Pieces', OUTPUT_BOTH: 'Both'}
+
+
+class TestSeggerBenchmark(BaseTest):
+    '''Benchmark of segment map on synthetic maps generated locally (no dataset
+    download). Every box size, number of regions, backend, grouping mode and
+    type of output is timed and the results are written as JSON to
+    SEGGER_BENCHMARK_REPORT (or segger_benchmark.json in the test project).
+    Run it with: scipion3 tests segger.tests.benchmark_segger'''
+
+    @classmethod
+    def setUpClass(cls):
+        setupTestProject(cls)
+
+    def _importSyntheticVolume(self, size, numRegions):
+        path = os.path.abspath(self.proj.getTmpPath('synthetic_%d_%d.mrc' % (size, numRegions)))
+        start = time.time()
+        writeSyntheticMap(path, size, numRegions, atomsPerRegion=ATOMS_PER_REGION, noise=NOISE)
+        generation = time.time() - start
+        protImportVolumes = self.newProtocol(ProtImportVolumes,
+                                             objLabel='Synthetic %d^3 - %d regions' % (size, numRegions),
+                                             filesPath=path,
+                                             samplingRate=1.0)
+        self.launchProtocol(protImportVolumes)
+        return protImportVolumes.outputVolume, generation
+
+    def _runCase(self, volume, numRegions, backend, grouping, pieces):
+        prot = self.newProtocol(ProtSegmentMap,
+                                objLabel='Benchmark - %s - %s - Output %s'
+                                         % (backend, GROUPINGS[grouping], OUTPUTS[pieces]),
+                                inputVolume=volume,
+                                backend=BACKEND_CHIMERA if backend == 'Chimera' else BACKEND_NATIVE,
+                                grouping=grouping,
+                                pieces=pieces,
+                                stopGroup=numRegions,
+                                useCache=False,
+                                autoMode=False)
+        start = time.time()
+        self.launchProtocol(prot)
+        wall = time.time() - start
+        with open(prot._getTimingFile()) as fid:
+            timing = json.load(fid)
+        with open(prot._getExecutionPlanFile()) as fid:
+            plan = json.load(fid)
+        outputGroups = getattr(prot, 'outputGroups', None)
+        # The backend that actually ran, in case the execution mode changed it
+        return {'backend': BACKEND_NAMES[plan['settings']['backend']],
+                'mode': plan['mode'],
+                'grouping': GROUPINGS[grouping],
+                'pieces': OUTPUTS[pieces],
+                'wall': wall,
+                'regions': len(outputGroups) if outputGroups is not None else None,
+                'stages': timing['totals']}
+
+    def _writeReport(self, results):
+        report = {'pluginVersion': __version__,
+                  'host': platform.node(),
+                  'platform': platform.platform(),
+                  'cpus': multiprocessing.cpu_count(),
+                  'atomsPerRegion': ATOMS_PER_REGION,
+                  'noise': NOISE,
+                  'results': results}
+        path = REPORT or self.proj.getPath('segger_benchmark.json')
+        with open(path, 'w') as fid:
+            json.dump(report, fid, indent=2)
+        return path
+
+    def test_benchmark(self):
+        results = []
+        for size in SIZES:
+            for numRegions in REGIONS:
+                volume, generation = self._importSyntheticVolume(size, numRegions)
+                for backend in BACKENDS:
+                    for grouping in sorted(GROUPINGS):
+                        for pieces in sorted(OUTPUTS):
+                            result = self._runCase(volume, numRegions, backend, grouping, pieces)
+                            result.update(size=size, numRegions=numRegions, generation=generation)
+                            results.append(result)
+                            self.assertTrue(result['stages'])
+                            # Written after every case, so partial results survive an interruption
+                            path = self._writeReport(results)
+        print("Benchmark report written to %s" % path)
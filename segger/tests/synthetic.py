@@ -0,0 +1,78 @@
+# **************************************************************************
+# *
+# * Authors:     David Herreros Calero (dherreros@cnb.csic.es)
+# *
+# * BCU, Centro Nacional de Biotecnologia, CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+import mrcfile
+import numpy as np
+
+
+def _addGaussian(data, center, sigma, amplitude):
+    """ Add a Gaussian truncated at 3 sigma to data (possibly memory-mapped),
+    touching only the voxels of its box """
+    radius = int(np.ceil(3 * sigma))
+    corner = np.floor(center).astype(int)
+    start = np.maximum(corner - radius, 0)
+    stop = np.minimum(corner + radius + 1, data.shape)
+    if np.any(stop <= start):
+        return
+    profiles = [np.exp(-(np.arange(s, e) - c) ** 2 / (2.0 * sigma ** 2)) for s, e, c in zip(start, stop, center)]
+    blob = amplitude * profiles[0][:, None, None] * profiles[1][None, :, None] * profiles[2][None, None, :]
+    data[start[0]:stop[0], start[1]:stop[1], start[2]:stop[2]] += blob.astype(np.float32)
+
+
+def writeSyntheticMap(path, size, numRegions, atomsPerRegion=1, sigma=None, noise=0.0, voxelSize=1.0,
+                      seed=0, sections=32):
+    """ Write a synthetic density map of size^3 voxels with numRegions regions.
+    With atomsPerRegion = 1 every region is a Gaussian blob, otherwise it is a
+    pseudo-atomic model: a cloud of atomsPerRegion Gaussians of 1.5 voxels of
+    sigma scattered with the region sigma. The map is written memory-mapped,
+    one Gaussian box at a time, so even 1024^3 maps need little memory.
+    Returns the (z, y, x) centers of the regions. """
+    rs = np.random.RandomState(seed)
+    if sigma is None:
+        # Regions are about 4 sigma apart if uniformly spread
+        sigma = max(1.5, size / (4.0 * numRegions ** (1.0 / 3)))
+    margin = min(3 * sigma, size / 4.0)
+    centers = rs.uniform(margin, size - margin, (numRegions, 3))
+    amplitudes = rs.uniform(0.5, 1.0, numRegions)
+    with mrcfile.new_mmap(path, (size, size, size), mrc_mode=2, overwrite=True) as mrc:
+        data = mrc.data
+        for z0 in range(0, size, sections):
+            data[z0:z0 + sections] = 0
+        for center, amplitude in zip(centers, amplitudes):
+            if atomsPerRegion <= 1:
+                _addGaussian(data, center, sigma, amplitude)
+                continue
+            atoms = center + rs.normal(0, sigma, (atomsPerRegion, 3))
+            for atom in np.clip(atoms, 0, size - 1):
+                _addGaussian(data, atom, 1.5, amplitude)
+        if noise > 0:
+            for z0 in range(0, size, sections):
+                slab = data[z0:z0 + sections]
+                slab += rs.normal(0, noise, slab.shape).astype(np.float32)
+        mrc.voxel_size = voxelSize
+        mrc.update_header_stats()
+    return centers
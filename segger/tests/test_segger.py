@@ -24,12 +24,37 @@
 # *
 # **************************************************************************
 
-from pwem.protocols import ProtImportVolumes
+import os
+import sys
+import csv
+import json
+import time
+import subprocess
+
+import numpy as np
+import mrcfile
+
+from pwem.protocols import ProtImportVolumes, ProtImportPdb
+from pwem.emlib.image import ImageHandler
 
 from pyworkflow.tests import BaseTest, setupTestProject
 from pyworkflow.tests.tests import DataSet
 
-from ..protocols.protocol_segment_map import ProtSegmentMap
+from .. import Plugin
+from ..protocols.protocol_segment_map import ProtSegmentMap, writeChimeraScript, runChimeraScript
+from ..protocols.protocol_segment_sweep import ProtSegmentSweep
+from ..protocols.protocol_segment_regroup import ProtSegmentRegroup
+from ..protocols.protocol_segment_fit import ProtSegmentFit
+from ..segmentation import (labelAgreement, thresholdPreview, defaultThreshold, segmentMap, watershedRegions,
+                            tiledWatershedRegions)
+from ..cache import WatershedCache, fileHash
+from ..convert import writeLabels, writeMap, compactLabels, openLabels, regionSlices, writePieces
+from ..profiling import StageTimer
+from ..constants import EXECUTION_IN_MEMORY, EXECUTION_TILED, BACKEND_NATIVE
+from ..estimation import estimateResources, NATIVE_BASE
+from ..worker import ChimeraWorker, ChimeraWorkerPool, ChimeraWorkerError
+from ..meshes import readMeshes
+from .synthetic import writeSyntheticMap
 
 class TestSeggerBase(BaseTest):
     @classmethod
@@ -50,7 +75,18 @@ class TestSegmentMap(TestSeggerBase):
         setupTestProject(cls)
         TestSeggerBase.setData()
 
-    def _runSegmentation(self, mode='', output=''):
+    def _importVolume(self):
+        protImportVolumes = self.newProtocol(ProtImportVolumes,
+                                             filesPath=self.volume,
+                                             samplingRate=1.0)
+
+        self.launchProtocol(protImportVolumes)
+
+        self.assertIsNotNone(protImportVolumes.outputVolume,
+                             "There was a problem with volume output")
+        return protImportVolumes
+
+    def _runSegmentation(self, mode='', output='', backend='Chimera'):
 
         if mode == 'Connectivity':
             grouping = 1
@@ -64,20 +100,14 @@ class TestSegmentMap(TestSeggerBase):
         elif output == 'Both':
             pieces = 2
 
-        protImportVolumes = self.newProtocol(ProtImportVolumes,
-                                             filesPath=self.volume,
-                                             samplingRate=1.0)
-
-        self.launchProtocol(protImportVolumes)
-
-        self.assertIsNotNone(protImportVolumes.outputVolume,
-                             "There was a problem with volume output")
+        protImportVolumes = self._importVolume()
 
         protSegmentationMap = self.newProtocol(ProtSegmentMap,
-                                               objLabel='Segmentation - %s - Output %s' % (mode, output),
+                                               objLabel='Segmentation - %s - Output %s - %s' % (mode, output, backend),
                                                inputVolume=protImportVolumes.outputVolume,
                                                grouping=grouping,
-                                               pieces = pieces)
+                                               pieces = pieces,
+                                               backend=0 if backend == 'Chimera' else 1)
 
         self.launchProtocol(protSegmentationMap)
         return protSegmentationMap
@@ -115,4 +145,666 @@ class TestSegmentMap(TestSeggerBase):
         outputMask = getattr( protSegmentationMap, 'outputSegmentation', None)
         self.assertTrue(outputMask)
 
-        return protSegmentationMap
\ No newline at end of file
+        return protSegmentationMap
+
+    def test_SegmentMap_RegionStatistics(self):
+        protSegmentationMap = self._runSegmentation(mode='Smoothing', output='Both', backend='Native')
+
+        outputGroups = getattr(protSegmentationMap, 'outputGroups', None)
+        self.assertTrue(outputGroups)
+        self.assertTrue(getattr(protSegmentationMap, 'outputCentroids', None))
+
+        inputVolume = protSegmentationMap.inputVolume.get()
+        with open(protSegmentationMap._getRegionStatsFile(inputVolume)) as fid:
+            rows = list(csv.DictReader(fid))
+        self.assertEqual(len(rows), len(outputGroups))
+        voxels = dict((int(row['region']), int(row['voxels'])) for row in rows)
+        for piece in outputGroups:
+            self.assertEqual(piece._voxels.get(), voxels[piece._regionId.get()])
+            self.assertGreaterEqual(piece._maxDensity.get(), piece._meanDensity.get())
+
+    def test_SegmentMap_CroppedPieces(self):
+        protSegmentationMap = self._runSegmentation(mode='Smoothing', output='Both', backend='Native')
+        inputVolume = protSegmentationMap.inputVolume.get()
+        sr = inputVolume.getSamplingRate()
+        origin = np.array(inputVolume.getOrigin(force=True).getShifts())
+        margin = protSegmentationMap.cropMargin.get()
+        mask = ImageHandler().read(protSegmentationMap.outputSegmentation).getData()
+        with open(protSegmentationMap._getRegionStatsFile(inputVolume)) as fid:
+            rows = dict((int(row['region']), row) for row in csv.DictReader(fid))
+
+        for piece in protSegmentationMap.outputGroups:
+            row = rows[piece._regionId.get()]
+            lower = np.maximum([int(row['bbox_%s0' % axis]) - margin for axis in 'zyx'], 0)
+            upper = np.minimum([int(row['bbox_%s1' % axis]) + margin + 1 for axis in 'zyx'], mask.shape)
+            with mrcfile.open(piece.getFileName()) as mrc:
+                # Cropped to the bounding box plus the margin, placed at its position in the input map
+                self.assertEqual(mrc.data.shape, tuple(upper - lower))
+                pieceOrigin = np.array([mrc.header.origin.x, mrc.header.origin.y, mrc.header.origin.z])
+                np.testing.assert_allclose(pieceOrigin, origin + lower[::-1] * sr, atol=1e-3)
+                box = tuple(slice(l, u) for l, u in zip(lower, upper))
+                self.assertTrue(np.array_equal(mrc.data > 0, mask[box] == piece._regionId.get()))
+            np.testing.assert_allclose(piece.getOrigin().getShifts(), pieceOrigin, atol=1e-3)
+
+    def test_SegmentMap_MaskedDensity(self):
+        protImportVolumes = self._importVolume()
+        ih = ImageHandler()
+        for softEdge in [0.0, 3.0]:
+            protSegmentationMap = self.newProtocol(ProtSegmentMap,
+                                                   objLabel='Segmentation - Masked density - edge %0.1f' % softEdge,
+                                                   inputVolume=protImportVolumes.outputVolume,
+                                                   pieces=2, pieceContent=1, softEdge=softEdge, backend=1)
+            self.launchProtocol(protSegmentationMap)
+
+            density = ih.read(protSegmentationMap.inputVolume.get()).getData()
+            mask = ih.read(protSegmentationMap.outputSegmentation).getData()
+            self.assertEqual(len(protSegmentationMap.outputGroups), len(np.unique(mask)) - 1)
+            total = sum(float(ih.read(piece).getData().sum()) for piece in protSegmentationMap.outputGroups)
+            if softEdge == 0:
+                # Pieces do not overlap, so they add up to the density inside the mask
+                self.assertAlmostEqual(total, float(density[mask > 0].sum()), delta=1e-3 * abs(total))
+
+    def test_SegmentMap_SoftMasks(self):
+        protImportVolumes = self._importVolume()
+        protSegmentationMap = self.newProtocol(ProtSegmentMap,
+                                               objLabel='Segmentation - Soft masks',
+                                               inputVolume=protImportVolumes.outputVolume,
+                                               pieces=2, pieceContent=2, maskDilation=2.0, softEdge=4.0,
+                                               cropPieces=False, backend=1)
+        self.launchProtocol(protSegmentationMap)
+
+        ih = ImageHandler()
+        mask = ih.read(protSegmentationMap.outputSegmentation).getData()
+        total = np.zeros(mask.shape, dtype=np.float32)
+        for piece in protSegmentationMap.outputGroups:
+            softMask = ih.read(piece).getData()
+            self.assertTrue(np.all(softMask[mask == piece._regionId.get()] == 1))
+            self.assertGreater(np.count_nonzero(softMask), np.count_nonzero(mask == piece._regionId.get()))
+            total += softMask
+        # Every voxel belongs to a single region
+        self.assertLessEqual(total.max(), 1.0 + 1e-6)
+
+    def test_SegmentMap_Meshes(self):
+        protSegmentationMap = self._runSegmentation(mode='Smoothing', output='Mask', backend='Native')
+        inputVolume = protSegmentationMap.inputVolume.get()
+        meshesFile = protSegmentationMap._getMeshesFile(inputVolume)
+        self.assertTrue(os.path.exists(meshesFile))
+
+        mask = ImageHandler().read(protSegmentationMap.outputSegmentation).getData()
+        labels = set(np.unique(mask[mask > 0]).tolist())
+        meshes = readMeshes(meshesFile)
+        self.assertTrue(meshes)
+        for label, vertices, triangles in meshes:
+            self.assertIn(label, labels)
+            self.assertLess(triangles.max(), len(vertices))
+
+        # Cached meshes are reused until the mask changes
+        written = os.stat(meshesFile).st_mtime_ns
+        protSegmentationMap._writeMeshes(inputVolume)
+        self.assertEqual(os.stat(meshesFile).st_mtime_ns, written)
+        os.utime(protSegmentationMap._getMaskFile(inputVolume), ns=(written + 10 ** 9, written + 10 ** 9))
+        protSegmentationMap._writeMeshes(inputVolume)
+        self.assertNotEqual(os.stat(meshesFile).st_mtime_ns, written)
+
+    def test_SegmentMap_ExecutionMode(self):
+        protImportVolumes = self._importVolume()
+        for memoryLimit, mode in [(16.0, EXECUTION_IN_MEMORY), (0.2, EXECUTION_TILED)]:
+            protSegmentationMap = self.newProtocol(ProtSegmentMap,
+                                                   objLabel='Segmentation - Memory limit %0.1f GB' % memoryLimit,
+                                                   inputVolume=protImportVolumes.outputVolume,
+                                                   pieces=1, cropPieces=False, memoryLimit=memoryLimit,
+                                                   autoMode=True)
+            plan = protSegmentationMap._getExecutionPlan()
+            self.assertEqual(plan['mode'], mode)
+            self.assertEqual(plan['fits'], not protSegmentationMap._warnings())
+            self.launchProtocol(protSegmentationMap)
+            self.assertTrue(protSegmentationMap.outputGroups)
+
+            # The mode used is recorded for the summary
+            with open(protSegmentationMap._getExecutionPlanFile()) as fid:
+                self.assertEqual(json.load(fid)['mode'], mode)
+            if mode == EXECUTION_TILED:
+                self.assertTrue(protSegmentationMap._getSetting('tiled'))
+                self.assertTrue(any('tiled' in line and 'Native backend' in line
+                                    for line in protSegmentationMap.summary()))
+
+        # Without the automatic mode the configured backend is kept and the tiled mode only suggested
+        protSegmentationMap = self.newProtocol(ProtSegmentMap, inputVolume=protImportVolumes.outputVolume,
+                                               pieces=1, cropPieces=False, memoryLimit=0.2)
+        plan = protSegmentationMap._getExecutionPlan()
+        self.assertEqual(plan['mode'], EXECUTION_IN_MEMORY)
+        self.assertEqual(plan['settings']['backend'], protSegmentationMap.backend.get())
+        self.assertTrue(any('automatically' in warning for warning in protSegmentationMap._warnings()))
+
+    def test_SegmentMap_PieceWriters(self):
+        protImportVolumes = self._importVolume()
+        pieces = []
+        for writerThreads in [1, 4]:
+            protSegmentationMap = self.newProtocol(ProtSegmentMap,
+                                                   objLabel='Segmentation - %d piece writers' % writerThreads,
+                                                   inputVolume=protImportVolumes.outputVolume,
+                                                   pieces=1, backend=1, writerThreads=writerThreads)
+            self.launchProtocol(protSegmentationMap)
+            self.assertTrue(any('pieces/s' in line for line in protSegmentationMap.summary()))
+            pieces.append(dict((piece._regionId.get(), mrcfile.read(piece.getFileName()))
+                               for piece in protSegmentationMap.outputGroups))
+        self.assertEqual(sorted(pieces[0]), sorted(pieces[1]))
+        for idm in pieces[0]:
+            self.assertTrue(np.array_equal(pieces[0][idm], pieces[1][idm]))
+
+    def test_SegmentMap_Threshold(self):
+        protImportVolumes = self._importVolume()
+        density = ImageHandler().read(protImportVolumes.outputVolume).getData().astype(np.float64)
+        expected = {0: density.mean() + 3 * density.std(), 1: np.percentile(density, 99.0)}
+        for thresholdMode in [0, 1]:
+            protSegmentationMap = self.newProtocol(ProtSegmentMap,
+                                                   objLabel='Segmentation - Threshold mode %d' % thresholdMode,
+                                                   inputVolume=protImportVolumes.outputVolume,
+                                                   thresholdMode=thresholdMode, backend=1)
+            self.launchProtocol(protSegmentationMap)
+            threshold = protSegmentationMap._getThreshold(protSegmentationMap.inputVolume.get())
+            self.assertAlmostEqual(threshold, expected[thresholdMode],
+                                   delta=2e-3 * (density.max() - density.min()))
+
+            # The preview suggests the thresholds the run computes from the whole map
+            stats = protSegmentationMap._getMapStatistics(protSegmentationMap.inputVolume.get())
+            candidates, step = thresholdPreview(density, stats, sigmas=[3], percentiles=[99.0])
+            self.assertIn(threshold, [c[0] for c in candidates if c[1] == thresholdMode])
+
+        # The preview lists the candidates sorted by threshold
+        candidates, step = thresholdPreview(density)
+        self.assertEqual([c[0] for c in candidates], sorted(c[0] for c in candidates))
+        self.assertGreaterEqual(step, 1)
+
+    def test_SegmentMap_NegativeThreshold(self):
+        # A zero-mean map whose automatic threshold (a low percentile) is negative
+        mapFile = os.path.abspath(self.proj.getTmpPath('zero_mean.mrc'))
+        writeSyntheticMap(mapFile, 32, 4, noise=0.1)
+        density = mrcfile.read(mapFile).astype(np.float64)
+        writeMap(mapFile, density - density.mean(), 1.0)
+        protImportVolumes = self.newProtocol(ProtImportVolumes, filesPath=mapFile, samplingRate=1.0)
+        self.launchProtocol(protImportVolumes)
+        density = ImageHandler().read(protImportVolumes.outputVolume).getData()
+        for backend in ['Chimera', 'Native']:
+            protSegmentationMap = self.newProtocol(ProtSegmentMap,
+                                                   objLabel='Segmentation - Negative threshold - %s' % backend,
+                                                   inputVolume=protImportVolumes.outputVolume,
+                                                   thresholdMode=1, thresholdPercentile=40.0, pieces=0,
+                                                   backend=0 if backend == 'Chimera' else 1)
+            self.launchProtocol(protSegmentationMap)
+            threshold = protSegmentationMap._getThreshold(protSegmentationMap.inputVolume.get())
+            self.assertLess(threshold, 0)
+            # The computed threshold is used, not replaced by mean + 3 sigma
+            mask = ImageHandler().read(protSegmentationMap.outputSegmentation).getData()
+            self.assertAlmostEqual(np.count_nonzero(mask) / float(mask.size),
+                                   np.count_nonzero(density > threshold) / float(density.size), delta=0.01,
+                                   msg=backend)
+
+    def test_SegmentMap_Resume(self):
+        protSegmentationMap = self._runSegmentation(mode='Smoothing', output='Pieces', backend='Native')
+        inputVolume = protSegmentationMap.inputVolume.get()
+        self.assertTrue(protSegmentationMap._isSegmentationDone(inputVolume))
+
+        # Finished pieces are skipped, deleted ones are written again
+        pieces = [piece.getFileName() for piece in protSegmentationMap.outputGroups]
+        written = os.stat(pieces[0]).st_mtime_ns
+        with open(protSegmentationMap._getManifestFile(inputVolume)) as fid:
+            lines = fid.readlines()
+        with open(protSegmentationMap._getManifestFile(inputVolume), 'w') as fid:
+            fid.writelines(line for line in lines if json.loads(line).get('file') != pieces[-1])
+        os.remove(pieces[-1])
+        for chunk in range(protSegmentationMap._getPieceChunks()):
+            protSegmentationMap.writePiecesStep(chunk)
+        protSegmentationMap._finishPieces(inputVolume)
+        self.assertEqual(os.stat(pieces[0]).st_mtime_ns, written)
+        self.assertTrue(os.path.exists(pieces[-1]))
+        self.assertEqual(len(list(protSegmentationMap._loadPieces(inputVolume))), len(pieces))
+
+        # A new version of the input map makes the segmentation outdated
+        fileName = inputVolume.getFileName()
+        info = os.stat(fileName)
+        os.utime(fileName, ns=(info.st_atime_ns, info.st_mtime_ns + 10 ** 9))
+        try:
+            self.assertFalse(protSegmentationMap._isSegmentationDone(inputVolume))
+        finally:
+            os.utime(fileName, ns=(info.st_atime_ns, info.st_mtime_ns))
+
+    def test_SegmentMap_Timing(self):
+        for backend in ['Chimera', 'Native']:
+            protSegmentationMap = self._runSegmentation(mode='Smoothing', output='Pieces', backend=backend)
+            with open(protSegmentationMap._getTimingFile()) as fid:
+                timing = json.load(fid)
+            stages = [total['stage'] for total in timing['totals']]
+            for stage in ['threshold', 'map open', 'grouping', 'seg export', 'piece writing']:
+                self.assertIn(stage, stages, "Stage %s not timed (%s)" % (stage, backend))
+            # The watershed may come from the cache filled by previous tests
+            self.assertTrue('watershed' in stages or 'watershed cache lookup' in stages)
+
+    def test_SegmentMap_NativeParity(self):
+        ih = ImageHandler()
+        for mode in ['Connectivity', 'Smoothing']:
+            protChimera = self._runSegmentation(mode=mode, output='Mask')
+            protNative = self._runSegmentation(mode=mode, output='Mask', backend='Native')
+
+            maskChimera = ih.read(protChimera.outputSegmentation).getData()
+            maskNative = ih.read(protNative.outputSegmentation).getData()
+            self.assertEqual(maskChimera.shape, maskNative.shape)
+
+            foreground = labelAgreement(maskChimera > 0, maskNative > 0)
+            self.assertGreater(foreground, 0.99, "Native thresholding differs from Chimera (%s)" % mode)
+            agreement = labelAgreement(maskChimera, maskNative)
+            self.assertGreater(agreement, 0.9, "Native regions differ from Chimera (%s): %0.3f"
+                               % (mode, agreement))
+
+    def test_SegmentMap_CoarseToFine(self):
+        protImportVolumes = self._importVolume()
+        protCoarse = self.newProtocol(ProtSegmentMap,
+                                      objLabel='Segmentation - Coarse to fine',
+                                      inputVolume=protImportVolumes.outputVolume,
+                                      backend=1, binning=2, compareFullResolution=True)
+        self.launchProtocol(protCoarse)
+
+        self.assertTrue(getattr(protCoarse, 'outputSegmentation', None))
+        with open(protCoarse._getCoarseToFineFile()) as fid:
+            report = json.load(fid)
+        self.assertEqual(len(report), 1)
+        self.assertGreater(report[0]['regionAgreement'], 0.8)
+
+
+    def test_SegmentMap_SetOfVolumes(self):
+        # A set of volumes is processed in streaming, here with the input set already closed
+        for idx in range(2):
+            writeSyntheticMap(self.proj.getTmpPath('synthetic_%d.mrc' % idx), 64, 10, seed=idx)
+        protImportVolumes = self.newProtocol(ProtImportVolumes,
+                                             filesPath=os.path.abspath(self.proj.getTmpPath()),
+                                             filesPattern='synthetic_*.mrc',
+                                             samplingRate=1.0)
+        self.launchProtocol(protImportVolumes)
+        inputSet = protImportVolumes.outputVolumes
+
+        protSegmentationMap = self.newProtocol(ProtSegmentMap,
+                                               objLabel='Segmentation - Set of volumes',
+                                               inputVolume=inputSet,
+                                               pieces=2,
+                                               backend=1)
+        self.launchProtocol(protSegmentationMap)
+
+        self.assertEqual(len(protSegmentationMap.outputSegmentation), len(inputSet))
+        self.assertEqual(len(protSegmentationMap.outputCentroids), len(inputSet))
+        self.assertTrue(protSegmentationMap.outputGroups.isStreamClosed())
+        self.assertEqual(sorted(protSegmentationMap._getDoneIds()), sorted(inputSet.getIdSet()))
+
+    def test_SegmentMap_Symmetry(self):
+        # C4 map (odd box, so that the axis goes through the center voxel)
+        mapFile = self.proj.getTmpPath('synthetic_c4.mrc')
+        writeSyntheticMap(mapFile, 65, 6, seed=4)
+        with mrcfile.open(mapFile, mode='r+') as mrc:
+            data = mrc.data.copy()
+            mrc.data[:] = sum(np.rot90(data, k, axes=(1, 2)) for k in range(4))
+        protImportVolumes = self.newProtocol(ProtImportVolumes,
+                                             filesPath=os.path.abspath(mapFile),
+                                             samplingRate=1.0)
+        self.launchProtocol(protImportVolumes)
+
+        ih = ImageHandler()
+        for backend in [0, 1]:
+            protSegmentationMap = self.newProtocol(ProtSegmentMap,
+                                                   objLabel='Segmentation - C4 symmetry - backend %d' % backend,
+                                                   inputVolume=protImportVolumes.outputVolume,
+                                                   applySymmetry=True, symmetryGroup=0, symmetryOrder=4,
+                                                   pieces=2, backend=backend)
+            self.launchProtocol(protSegmentationMap)
+
+            inputVolume = protSegmentationMap.inputVolume.get()
+            numRegions = protSegmentationMap._getAsymmetricUnit(inputVolume)['regions']
+            self.assertGreater(numRegions, 0)
+            mask = ih.read(protSegmentationMap.outputSegmentation).getData()
+            sizes = np.bincount(mask.ravel().astype(np.int64), minlength=4 * numRegions + 1)
+            self.assertEqual(len(sizes), 4 * numRegions + 1)
+            # Every copy of a region has the same size
+            for region in range(1, numRegions + 1):
+                copies = sizes[region::numRegions]
+                self.assertLessEqual(copies.max() - copies.min(), 0.05 * copies.max())
+            for piece in protSegmentationMap.outputGroups:
+                self.assertEqual(piece._regionId.get(),
+                                 piece._symmetryCopy.get() * numRegions + piece._asymmetricRegion.get())
+
+    def test_SegmentMap_ConcurrentRuns(self):
+        protImportVolumes = self._importVolume()
+        stops = [1, 5, 10]
+        prots = []
+        for stop in stops:
+            prot = self.newProtocol(ProtSegmentMap,
+                                    objLabel='Segmentation - concurrent - stop %d' % stop,
+                                    inputVolume=protImportVolumes.outputVolume,
+                                    grouping=1, stopGroup=stop, pieces=2)
+            self.proj.launchProtocol(prot, wait=False)
+            prots.append(prot)
+
+        while any(prot.isActive() for prot in prots):
+            time.sleep(3)
+            for prot in prots:
+                self.proj._updateProtocol(prot)
+
+        ih = ImageHandler()
+        numGroups = []
+        for prot in prots:
+            self.assertTrue(prot.isFinished(), "%s did not finish" % prot.getObjLabel())
+            extraPath = os.path.abspath(prot._getExtraPath())
+            mask = ih.read(prot.outputSegmentation).getData()
+            self.assertEqual(int(mask.max()), len(prot.outputGroups),
+                             "Mask and pieces of %s do not match" % prot.getObjLabel())
+            for piece in prot.outputGroups:
+                self.assertTrue(os.path.abspath(piece.getFileName()).startswith(extraPath))
+            numGroups.append(len(prot.outputGroups))
+        # Stopping the grouping later can only leave more regions
+        self.assertEqual(numGroups, sorted(numGroups))
+
+
+    def test_ChimeraWorker(self):
+        # A persistent worker must give the same segmentation as a one-shot Chimera
+        masks = []
+        for name in ['oneshot', 'worker', 'worker_warm']:
+            mask = os.path.abspath(self.proj.getTmpPath('mask_%s.mrc' % name))
+            seg = os.path.abspath(self.proj.getTmpPath('seg_%s.seg' % name))
+            script = os.path.abspath(self.proj.getTmpPath('script_%s.py' % name))
+            writeChimeraScript(script, [(self.volume, mask, seg, '')], groupingMode=1)
+            if name == 'oneshot':
+                runChimeraScript(script)
+            else:
+                worker = ChimeraWorker(os.path.abspath(self.proj.getTmpPath('worker.sock')),
+                                       Plugin.getProgram(), Plugin.getEnviron(), idleTimeout=60)
+                worker.run(script)
+                self.assertIsNotNone(worker.ping())
+            masks.append(ImageHandler().read(mask).getData())
+        worker.shutdown()
+        for mask in masks[1:]:
+            self.assertTrue((mask == masks[0]).all())
+
+    def test_ChimeraWorkerFolder(self):
+        # The pool only uses a folder private to the user, never a link to one
+        folder = os.path.abspath(self.proj.getTmpPath('workers'))
+        ChimeraWorkerPool(folder, 1, Plugin.getProgram())._checkFolder()
+        self.assertEqual(os.stat(folder).st_mode & 0o777, 0o700)
+        link = os.path.abspath(self.proj.getTmpPath('workers_link'))
+        os.symlink(folder, link)
+        with self.assertRaises(ChimeraWorkerError):
+            ChimeraWorkerPool(link, 1, Plugin.getProgram())._checkFolder()
+        os.chmod(folder, 0o755)
+        with self.assertRaises(ChimeraWorkerError):
+            ChimeraWorkerPool(folder, 1, Plugin.getProgram())._checkFolder()
+
+    def test_SegmentSweep(self):
+        protImportVolumes = self._importVolume()
+        protSweep = self.newProtocol(ProtSegmentSweep,
+                                     objLabel='Segmentation sweep',
+                                     inputVolume=protImportVolumes.outputVolume,
+                                     backend=1, grouping=0,
+                                     smoothSteps='2 4', stopGroup='1 10',
+                                     targetRegions=5, numberOfResults=2,
+                                     numberOfThreads=4)
+        self.launchProtocol(protSweep)
+
+        self.assertEqual(len(protSweep._getCombinations()), 4)
+        self.assertTrue(os.path.exists(protSweep._getSummaryFile()))
+        outputs = [name for name, _ in protSweep.iterOutputAttributes()]
+        self.assertEqual(len(outputs), 2)
+
+        # The automatic threshold is computed as in segment map, and its watershed
+        # was cached for the other combinations
+        cache = Plugin.getCache()
+        data = ImageHandler().read(protImportVolumes.outputVolume).getData()
+        self.assertAlmostEqual(protSweep._getThreshold(-1), defaultThreshold(data), places=5)
+        key = cache.getKey(protSweep._getMapHash(), protSweep._getThreshold(-1))
+        self.assertIsNotNone(cache.lookup(key, '.npz'))
+
+        # Same threshold modes as segment map
+        protSweep = self.newProtocol(ProtSegmentSweep,
+                                     objLabel='Segmentation sweep - percentile threshold',
+                                     inputVolume=protImportVolumes.outputVolume,
+                                     backend=0, grouping=0, thresholdMode=1, thresholdPercentile=98.0)
+        self.launchProtocol(protSweep)
+        protSegment = self.newProtocol(ProtSegmentMap,
+                                       objLabel='Segmentation - percentile threshold',
+                                       inputVolume=protImportVolumes.outputVolume,
+                                       backend=0, grouping=0, pieces=0, thresholdMode=1, thresholdPercentile=98.0)
+        self.launchProtocol(protSegment)
+        self.assertAlmostEqual(protSweep._getThreshold(-1),
+                               protSegment._getThreshold(protSegment.inputVolume.get()), places=5)
+        mask = ImageHandler().read(protSegment.outputSegmentation).getData()
+        swept = ImageHandler().read(protSweep._getMaskFile(0)).getData()
+        self.assertTrue(((mask > 0) == (swept > 0)).all())
+
+
+    def test_SegmentRegroup(self):
+        protImportVolumes = self._importVolume()
+        protSegment = self.newProtocol(ProtSegmentMap,
+                                       objLabel='Segmentation - hierarchy',
+                                       inputVolume=protImportVolumes.outputVolume,
+                                       backend=1, grouping=0, stopGroup=5, pieces=0)
+        self.launchProtocol(protSegment)
+
+        protRegroup = self.newProtocol(ProtSegmentRegroup,
+                                       objLabel='Regroup - 5 regions',
+                                       inputProtocol=protSegment,
+                                       cutMode=0, numberOfRegions=5, outputPieces=True)
+        self.launchProtocol(protRegroup)
+
+        # Cutting the hierarchy at the stop value gives back the same mask
+        ih = ImageHandler()
+        mask = ih.read(protSegment.outputSegmentation).getData()
+        regrouped = ih.read(protRegroup.outputSegmentation).getData()
+        self.assertTrue((mask == regrouped).all())
+        self.assertEqual(len(protRegroup.outputGroups), int(regrouped.max()))
+
+
+class TestWatershedCache(TestSeggerBase):
+    '''Checks the cache of initial watershed regions shared by the runs'''
+
+    def _writeMap(self, name, seed):
+        mapFile = self.proj.getTmpPath(name)
+        writeSyntheticMap(mapFile, 32, 4, seed=seed)
+        return mapFile
+
+    def test_HitAndMiss(self):
+        cache = WatershedCache(self.proj.getTmpPath('cache_hits'), 1024 * 1024 * 1024)
+        mapFile = self._writeMap('cached.mrc', 0)
+        data = mrcfile.read(mapFile)
+        threshold = defaultThreshold(data)
+
+        timer = StageTimer()
+        first = segmentMap(data, threshold, cache=cache, mapHash=fileHash(mapFile), timer=timer)
+        self.assertIn('watershed', [entry['stage'] for entry in timer.stages])
+        timer = StageTimer()
+        second = segmentMap(data, threshold, cache=cache, mapHash=fileHash(mapFile), timer=timer)
+        self.assertNotIn('watershed', [entry['stage'] for entry in timer.stages])
+        self.assertTrue(np.array_equal(first.groupedMask(), second.groupedMask()))
+
+        # Another threshold or another map are different entries
+        self.assertIsNone(cache.loadRegions(cache.getKey(fileHash(mapFile), threshold * 1.1)))
+        otherFile = self._writeMap('other.mrc', 1)
+        self.assertIsNone(cache.loadRegions(cache.getKey(fileHash(otherFile), threshold)))
+
+    def test_Eviction(self):
+        regions = np.arange(32 ** 3, dtype=np.int32).reshape((32,) * 3)
+        peaks = np.zeros((10, 3))
+        cache = WatershedCache(self.proj.getTmpPath('cache_lru'), 1024 * 1024 * 1024)
+        cache.storeRegions('a', regions, peaks)
+        entrySize = os.path.getsize(cache.getFile('a', '.npz'))
+
+        # Room for two entries: the least recently used one goes when a third is stored
+        cache.maxSize = int(2.5 * entrySize)
+        cache.storeRegions('b', regions, peaks)
+        os.utime(cache.getFile('a', '.npz'), (1, 1))
+        os.utime(cache.getFile('b', '.npz'), (2, 2))
+        self.assertIsNotNone(cache.lookup('a', '.npz'))
+        cache.storeRegions('c', regions, peaks)
+        self.assertIsNotNone(cache.lookup('a', '.npz'))
+        self.assertIsNone(cache.lookup('b', '.npz'))
+        self.assertIsNotNone(cache.lookup('c', '.npz'))
+
+        # Entries being written by other runs are neither counted nor removed
+        inProgress = cache.getFile('d', '.seg.tmp%d' % os.getpid())
+        with open(inProgress, 'wb') as fid:
+            fid.write(b'\0' * (3 * entrySize))
+        os.utime(inProgress, (0, 0))
+        cache.evict()
+        self.assertTrue(os.path.exists(inProgress))
+        self.assertIsNotNone(cache.lookup('a', '.npz'))
+        self.assertIsNotNone(cache.lookup('c', '.npz'))
+
+
+class TestLabelMaps(TestSeggerBase):
+    '''Checks how masks and pieces are stored'''
+
+    def _randomMask(self, numRegions, shape=(40, 36, 30)):
+        rs = np.random.RandomState(0)
+        mask = np.zeros(shape, dtype=np.int32)
+        for label in range(1, numRegions + 1):
+            start = [rs.randint(0, n - 6) for n in shape]
+            size = [rs.randint(2, 12) for _ in shape]
+            mask[tuple(slice(s0, s0 + n) for s0, n in zip(start, size))] = label
+        return mask
+
+    def test_SlabPieces(self):
+        mask = self._randomMask(20)
+        maskFile = self.proj.getTmpPath('slab_mask.mrc')
+        writeLabels(maskFile, mask, 1.0)
+        boxes = regionSlices(mask, 2)
+        for fullBox in [False, True]:
+            with openLabels(maskFile) as mrc:
+                # Slabs of 3 sections, smaller than most regions
+                paths = dict((label, self.proj.getTmpPath('slab_%d_%d.mrc' % (fullBox, label))) for label in boxes)
+                writePieces(mrc.data, boxes, paths, 1.0, fullBox=fullBox, sections=3)
+            for label, box in boxes.items():
+                expected = (mask == label) if fullBox else (mask[box] == label)
+                self.assertTrue(np.array_equal(mrcfile.read(paths[label]), expected.astype(np.int8)))
+
+    def test_LabelDtype(self):
+        for numRegions, mode in [(127, 0), (128, 6)]:
+            mask = self._randomMask(numRegions, shape=(64, 64, 64))
+            mask[0, 0, :2] = [numRegions - 1, numRegions]
+            maskFile = self.proj.getTmpPath('labels_%d.mrc' % numRegions)
+            writeLabels(maskFile, mask)
+            with mrcfile.open(maskFile) as mrc:
+                self.assertEqual(int(mrc.header.mode), mode)
+                self.assertTrue(np.array_equal(mrc.data, mask))
+
+            # Float masks exported by Chimera are compacted to the same type
+            writeMap(maskFile, mask)
+            compactLabels(maskFile, sections=5)
+            with mrcfile.open(maskFile) as mrc:
+                self.assertEqual(int(mrc.header.mode), mode)
+                self.assertTrue(np.array_equal(mrc.data, mask))
+
+
+# Segmentation of a map as done by segment map with the native backend, in a new
+# process, printing the growth of its peak resident memory (MB) over that of the
+# process with the modules loaded
+PEAK_MEMORY_SCRIPT = """
+import sys
+import resource
+import numpy as np
+from segger.convert import openLabels
+from segger.segmentation import segmentMap, defaultThreshold
+
+mapFile, workDir, tileSize, binning = sys.argv[1], sys.argv[2], int(sys.argv[3]), int(sys.argv[4])
+base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+mrc = openLabels(mapFile)
+data = mrc.data
+tiling = None
+if tileSize:
+    tiling = {'tileSize': tileSize, 'halo': 4, 'workers': 1, 'workDir': workDir, 'source': mapFile,
+              'out': np.lib.format.open_memmap(workDir + '/regions.npy', mode='w+', dtype=np.int32,
+                                               shape=data.shape)}
+else:
+    data = np.array(data)
+smod = segmentMap(data, defaultThreshold(data), tiling=tiling, binning=binning)
+mask = smod.groupedMask()
+print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0 - base)
+"""
+
+
+class TestTiledWatershed(TestSeggerBase):
+    '''Checks that the tiled watershed gives the same regions as the whole map'''
+
+    def test_TiledEqualsWhole(self):
+        mapFile = self.proj.getTmpPath('tiled.mrc')
+        writeSyntheticMap(mapFile, 40, 30, atomsPerRegion=8, noise=0.1, seed=3)
+        data = mrcfile.read(mapFile).astype(np.float32)
+        # Plateaus crossing the borders of the tiles
+        data[10:22, 5:9, 5:9] = data.max()
+        data[30:34, 14:27, 20:22] = 0.9 * data.max()
+        threshold = defaultThreshold(data, sigma=1.0)
+        regions, peaks = watershedRegions(data, threshold)
+        self.assertGreater(len(peaks), 10)
+
+        for tileSize, halo in [(8, 2), (13, 3), (16, 4)]:
+            for workers in [1, 2]:
+                tiled, tiledPeaks = tiledWatershedRegions(data, threshold, tileSize=tileSize, halo=halo,
+                                                          workers=workers)
+                msg = 'tiles of %d, halo %d, %d workers' % (tileSize, halo, workers)
+                self.assertTrue(np.array_equal(tiled, regions), msg)
+                self.assertTrue(np.array_equal(tiledPeaks, peaks), msg)
+
+        # Tiles read by the workers from the MRC file
+        mrcFile = self.proj.getTmpPath('tiled_plateaus.mrc')
+        writeMap(mrcFile, data)
+        tiled, _ = tiledWatershedRegions(data, threshold, tileSize=13, halo=3, workers=2, source=mrcFile)
+        self.assertTrue(np.array_equal(tiled, regions))
+
+    def test_MemoryEstimate(self):
+        # The estimated peak memory, above that of the process without any map, covers
+        # the one measured in every mode
+        mapFile = os.path.abspath(self.proj.getTmpPath('estimated.mrc'))
+        writeSyntheticMap(mapFile, 128, 40, atomsPerRegion=50, noise=0.05)
+        scriptFile = self.proj.getTmpPath('peak_memory.py')
+        with open(scriptFile, 'w') as fid:
+            fid.write(PEAK_MEMORY_SCRIPT)
+        for tileSize, binning in [(0, 1), (0, 2), (32, 1), (32, 2)]:
+            workDir = os.path.abspath(self.proj.getTmpPath('estimated_%d_%d' % (tileSize, binning)))
+            os.makedirs(workDir)
+            growth = float(subprocess.check_output([sys.executable, scriptFile, mapFile, workDir,
+                                                    str(tileSize), str(binning)]).split()[-1])
+            estimate = estimateResources((128, 128, 128), backend=BACKEND_NATIVE, tiled=bool(tileSize),
+                                         tileSize=tileSize, binning=binning)
+            self.assertLessEqual(growth, estimate['segmentationMemory'] - NATIVE_BASE,
+                                 'tiles of %d, binning %d' % (tileSize, binning))
+
+
+class TestSegmentFit(TestSeggerBase):
+    """This class checks the fitting of atomic structures into the regions of a segmentation"""
+
+    @classmethod
+    def setUpClass(cls):
+        setupTestProject(cls)
+        TestSeggerBase.setData('model_building_tutorial')
+        cls.volume = cls.dataset.getFile('volumes/1ake_4-5A.mrc')
+        cls.structure = cls.dataset.getFile('PDBx_mmCIF/1ake_start.pdb')
+
+    def test_SegmentFit(self):
+        protImportVolumes = self.newProtocol(ProtImportVolumes, filesPath=self.volume, samplingRate=1.5)
+        self.launchProtocol(protImportVolumes)
+        protImportPdb = self.newProtocol(ProtImportPdb, inputPdbData=ProtImportPdb.IMPORT_FROM_FILES,
+                                         pdbFile=self.structure)
+        self.launchProtocol(protImportPdb)
+
+        # A single region holding the whole molecule
+        protSegmentationMap = self.newProtocol(ProtSegmentMap,
+                                               inputVolume=protImportVolumes.outputVolume,
+                                               stopGroup=1, pieces=1, backend=1)
+        self.launchProtocol(protSegmentationMap)
+
+        protFit = self.newProtocol(ProtSegmentFit,
+                                   inputGroups=protSegmentationMap.outputGroups,
+                                   inputVolume=protImportVolumes.outputVolume,
+                                   inputStructures=protImportPdb.outputPdb,
+                                   resolution=4.5, angularStep=30, sizeRatio=0, numberOfThreads=2)
+        self.launchProtocol(protFit)
+
+        outputFits = getattr(protFit, 'outputFits', None)
+        self.assertTrue(outputFits)
+        self.assertEqual(len(outputFits), 1)
+        fit = outputFits.getFirstItem()
+        self.assertTrue(os.path.exists(fit.getFileName()))
+        self.assertGreater(fit._fitScore.get(), 0.5)
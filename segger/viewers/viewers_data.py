@@ -27,43 +27,58 @@
 import os, glob
 
 import pyworkflow.viewer as pwviewer
+import pyworkflow.protocol.params as params
 
 import pwem.viewers.views as vi
 from pwem.viewers.viewer_chimera import ChimeraView
 
-from chimera import Plugin as chimera
-
 from ..protocols.protocol_segment_map import ProtSegmentMap
-from segger import Plugin
+from ..meshes import writeMeshScript
 
-class SeggerViewer(pwviewer.Viewer):
-    """ Wrapper to visualize different type of objects
-    with the Xmipp program xmipp_showj
+class SeggerViewer(pwviewer.ProtocolViewer):
+    """ Visualize the regions of a segmentation in Chimera, as the surface
+    meshes computed with the outputs (fast) or by opening the full
+    segmentation files in Segger
     """
+    _label = 'viewer segger'
     _environments = [pwviewer.DESKTOP_TKINTER]
     _targets = [ProtSegmentMap]
 
-    def __init__(self, **kwargs):
-        pwviewer.Viewer.__init__(self, **kwargs)
-        self._views = []
+    def _defineParams(self, form):
+        form.addSection(label='Visualization')
+        form.addParam('displayMeshes', params.LabelParam,
+                      label='Display region surfaces',
+                      help='Show the precomputed surface mesh of every region')
+        form.addParam('displaySegmentations', params.LabelParam,
+                      label='Open full segmentations',
+                      help='Open every .seg file in Chimera, to analyze the regions with Segger. '
+                           'Slow for large segmentations')
+
+    def _getVisualizeDict(self):
+        return {'displayMeshes': self._showMeshes,
+                'displaySegmentations': self._showSegmentations}
 
     def _getObjView(self, obj, fn, viewParams={}):
         return vi.ObjectView(
             self._project, obj.strId(), fn, viewParams=viewParams)
 
-    def _visualize(self, obj, **kwargs):
-        views = []
-        cls = type(obj)
-
-        if issubclass(cls, ProtSegmentMap):
-            filePath = self.chimeraViewFile()
-            views.append(ChimeraView(filePath))
+    def _showMeshes(self, paramName=None):
+        meshFiles = []
+        for inputVolume in self.protocol._iterInputVolumes():
+            if os.path.exists(self.protocol._getMaskFile(inputVolume)):
+                # Computed now for runs older than the meshes, or if the mask changed
+                self.protocol._writeMeshes(inputVolume)
+                meshFiles.append(self.protocol._getMeshesFile(inputVolume))
+        filePath = os.path.abspath(self.protocol._getExtraPath('viewChimeraMeshes.py'))
+        writeMeshScript(filePath, meshFiles)
+        return [ChimeraView(filePath)]
 
-        return views
+    def _showSegmentations(self, paramName=None):
+        return [ChimeraView(self.chimeraViewFile())]
 
     def chimeraViewFile(self):
         outPath = self.protocol._getExtraPath()
-        filePath = os.path.join(chimera.getHome(), 'share', 'Segger', 'viewChimera.py')
+        filePath = os.path.abspath(self.protocol._getExtraPath('viewChimera.py'))
         f = open(filePath, "w")
         f.write('from chimera import runCommand\n')
         for segmentation in glob.glob(os.path.join(outPath, '*.seg')):
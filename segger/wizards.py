@@ -0,0 +1,94 @@
+# **************************************************************************
+# *
+# * Authors:     David Herreros Calero (dherreros@cnb.csic.es)
+# *
+# * BCU, Centro Nacional de Biotecnologia, CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import pyworkflow.object as pwobj
+from pyworkflow.gui import dialog
+from pyworkflow.gui.tree import ListTreeProvider
+
+from pwem.wizards import EmWizard
+from pwem.objects import Volume
+
+from .constants import THRESHOLD_SIGMA
+from .protocols import ProtSegmentMap
+from .segmentation import thresholdPreview
+
+
+class ThresholdTreeProvider(ListTreeProvider):
+    """ Candidate thresholds with their criterion and approximate number of regions """
+
+    def __init__(self, objList=None):
+        ListTreeProvider.__init__(self, objList)
+        self.getColumns = lambda: [('Threshold', 120), ('Criterion', 150), ('Regions', 100)]
+
+    def getObjectInfo(self, obj):
+        return {'key': obj.getObjId(), 'text': '%g' % obj.get(),
+                'values': (obj._criterion.get(), obj._regions.get())}
+
+
+class SeggerThresholdWizard(EmWizard):
+    """ Preview the approximate number of connected regions above several
+    candidate automatic thresholds (standard deviations above the mean and
+    percentiles of the map values), computed from the statistics of the whole
+    map as the run does, and select the automatic threshold of the chosen one """
+    _targets = [(ProtSegmentMap, ['mapThreshold'])]
+
+    def show(self, form, *params):
+        protocol = form.protocol
+        inputVolume = protocol.inputVolume.get()
+        if inputVolume is None:
+            dialog.showError('Input error', 'Select the input volume to preview its thresholds', form.root)
+            return
+        if not isinstance(inputVolume, Volume):
+            inputVolume = inputVolume.getFirstItem()
+        stats = protocol._getMapStatistics(inputVolume)
+        with protocol._openDensity(inputVolume) as density:
+            candidates, step = thresholdPreview(density, stats,
+                                                sigmas=(1, 2, 3, 4, 5, protocol.thresholdSigma.get()),
+                                                percentiles=(90, 95, 99, 99.5, 99.9,
+                                                             protocol.thresholdPercentile.get()))
+
+        thresholds = []
+        for idx, (threshold, mode, parameter, regions) in enumerate(candidates):
+            value = pwobj.Float(threshold)
+            value.setObjId(idx + 1)
+            value._mode = pwobj.Integer(mode)
+            value._parameter = pwobj.Float(parameter)
+            value._criterion = pwobj.String('%g sigma' % parameter if mode == THRESHOLD_SIGMA
+                                            else 'percentile %g' % parameter)
+            value._regions = pwobj.Integer(regions)
+            thresholds.append(value)
+        dlg = dialog.ListDialog(form.root, "Map threshold", ThresholdTreeProvider(thresholds),
+                                "Thresholds of the whole map, regions above them counted on the map "
+                                "subsampled every %d voxels" % step, selectmode='browse')
+        if dlg.values:
+            # The run computes the selected threshold again from the map, as it is set as the automatic one
+            selected = dlg.values[0]
+            form.setVar('mapThreshold', '-1')
+            form.setVar('thresholdMode', selected._mode.get())
+            if selected._mode.get() == THRESHOLD_SIGMA:
+                form.setVar('thresholdSigma', '%g' % selected._parameter.get())
+            else:
+                form.setVar('thresholdPercentile', '%g' % selected._parameter.get())
@@ -0,0 +1,265 @@
+# **************************************************************************
+# *
+# * Authors:     David Herreros Calero (dherreros@cnb.csic.es)
+# *
+# * BCU, Centro Nacional de Biotecnologia, CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+import os
+import sys
+import json
+import stat
+import time
+import errno
+import fcntl
+import shlex
+import socket
+import subprocess
+
+
+# Script run by Chimera as a long-lived worker. It keeps Chimera and the Segger
+# modules loaded and runs the scripts received through a Unix socket, one request
+# (a JSON line) at a time:
+#   {"cmd": "ping"}                                  -> {"ok": true, "pid": ...}
+#   {"cmd": "run", "script": ..., "argv": [...], "cwd": ...}
+#                                                    -> {"ok": ..., "output": ..., "error": ...}
+#   {"cmd": "shutdown"}
+# The worker exits when idle for longer than its idle timeout.
+WORKER_SCRIPT = """
+import os
+import sys
+import json
+import socket
+import traceback
+from StringIO import StringIO
+
+import chimera
+import VolumeViewer
+import regions
+import Segger
+import segcmd
+import segfile
+
+socketPath, idleTimeout = sys.argv[1], float(sys.argv[2])
+
+
+def runScript(request):
+    stdout, stderr, argv, cwd = sys.stdout, sys.stderr, sys.argv, os.getcwd()
+    output = StringIO()
+    sys.stdout = sys.stderr = output
+    response = {'ok': True}
+    try:
+        if request.get('cwd'):
+            os.chdir(request['cwd'])
+        sys.argv = [request['script']] + request.get('argv', [])
+        execfile(request['script'], {'__name__': '__main__', '__file__': request['script']})
+    except BaseException:
+        response = {'ok': False, 'error': traceback.format_exc()}
+    finally:
+        sys.stdout, sys.stderr, sys.argv = stdout, stderr, argv
+        os.chdir(cwd)
+        # Every job starts from an empty session, as a new Chimera would
+        chimera.openModels.close(chimera.openModels.list())
+    response['output'] = output.getvalue()
+    return response
+
+
+if os.path.exists(socketPath):
+    os.remove(socketPath)
+server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+server.bind(socketPath)
+server.listen(1)
+server.settimeout(idleTimeout)
+try:
+    while True:
+        try:
+            connection, _ = server.accept()
+        except socket.timeout:
+            break
+        connection.settimeout(None)
+        fid = connection.makefile('rw')
+        request = json.loads(fid.readline())
+        if request['cmd'] == 'ping':
+            response = {'ok': True, 'pid': os.getpid()}
+        elif request['cmd'] == 'run':
+            response = runScript(request)
+        else:
+            response = {'ok': True}
+        fid.write(json.dumps(response) + '\\n')
+        fid.flush()
+        fid.close()
+        connection.close()
+        if request['cmd'] == 'shutdown':
+            break
+finally:
+    server.close()
+    if os.path.exists(socketPath):
+        os.remove(socketPath)
+"""
+
+
+class ChimeraWorkerError(Exception):
+    pass
+
+
+def parseScriptArgs(args):
+    """ Script path and arguments of a headless Chimera command line
+    (--nogui ... --script "script.py args"), None if it is not such a command """
+    tokens = shlex.split(args)
+    if '--nogui' not in tokens or '--script' not in tokens:
+        return None
+    index = tokens.index('--script')
+    if index + 1 >= len(tokens):
+        return None
+    script = shlex.split(tokens[index + 1])
+    return os.path.abspath(script[0]), script[1:] + tokens[index + 2:]
+
+
+class ChimeraWorker(object):
+    """ Client of a headless Chimera worker listening on socketPath. The worker
+    is started with program (the Chimera binary) and env when it does not answer
+    the health check, and restarted once if it dies while running a job. """
+
+    def __init__(self, socketPath, program, env=None, idleTimeout=1800, startTimeout=120):
+        self.socketPath = socketPath
+        self.program = program
+        self.env = env
+        self.idleTimeout = idleTimeout
+        self.startTimeout = startTimeout
+
+    def _request(self, request, timeout=None):
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.settimeout(timeout)
+        try:
+            client.connect(self.socketPath)
+            fid = client.makefile('rw')
+            fid.write(json.dumps(request) + '\n')
+            fid.flush()
+            line = fid.readline()
+        finally:
+            client.close()
+        if not line:
+            raise ChimeraWorkerError('Chimera worker closed the connection (%s)' % self.socketPath)
+        return json.loads(line)
+
+    def ping(self, timeout=5):
+        """ Health check: pid of the worker, None if it does not answer """
+        try:
+            return self._request({'cmd': 'ping'}, timeout)['pid']
+        except (socket.error, ValueError, KeyError, ChimeraWorkerError):
+            return None
+
+    def start(self):
+        scriptFile = os.path.splitext(self.socketPath)[0] + '_worker.py'
+        with open(scriptFile, 'w') as fid:
+            fid.write(WORKER_SCRIPT)
+        logFile = open(os.path.splitext(self.socketPath)[0] + '.log', 'a')
+        # A new session, so that the worker outlives the run that started it
+        subprocess.Popen([self.program, '--nogui', '--silent', '--nostatus', '--script',
+                          '%s %s %d' % (scriptFile, self.socketPath, self.idleTimeout)],
+                         env=self.env, stdout=logFile, stderr=subprocess.STDOUT, preexec_fn=os.setsid,
+                         close_fds=True)
+        logFile.close()
+        deadline = time.time() + self.startTimeout
+        while time.time() < deadline:
+            if self.ping() is not None:
+                return
+            time.sleep(0.5)
+        raise ChimeraWorkerError('Chimera worker did not start in %d seconds (%s)'
+                                 % (self.startTimeout, self.socketPath))
+
+    def ensure(self):
+        if self.ping() is None:
+            self.start()
+
+    def run(self, script, argv=(), cwd=None):
+        """ Run a Chimera script in the worker. Its output is printed and a failure
+        raises an exception, as when running Chimera for the script """
+        request = {'cmd': 'run', 'script': script, 'argv': list(argv), 'cwd': cwd or os.getcwd()}
+        self.ensure()
+        try:
+            response = self._request(request)
+        except (socket.error, ChimeraWorkerError):
+            # The worker died during the job: start a new one and run it again
+            self.start()
+            response = self._request(request)
+        sys.stdout.write(response.get('output', ''))
+        sys.stdout.flush()
+        if not response['ok']:
+            raise ChimeraWorkerError('Chimera script %s failed:\n%s' % (script, response['error']))
+
+    def shutdown(self):
+        if self.ping() is not None:
+            self._request({'cmd': 'shutdown'}, 5)
+
+
+class ChimeraWorkerPool(object):
+    """ Pool of size workers per node and user, under folder. A job takes the
+    first worker whose lock file it can hold, waiting for one to be free """
+
+    def __init__(self, folder, size, program, env=None, idleTimeout=1800):
+        self.folder = folder
+        self.size = max(int(size), 1)
+        self.program = program
+        self.env = env
+        self.idleTimeout = idleTimeout
+
+    def _checkFolder(self):
+        """ Create the folder private to this user and refuse to use it when it
+        is a link, belongs to another user or is open to others: the worker runs
+        any script sent through its socket """
+        try:
+            os.mkdir(self.folder, 0o700)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        info = os.lstat(self.folder)
+        if not stat.S_ISDIR(info.st_mode):
+            raise ChimeraWorkerError('Chimera worker folder %s is not a directory' % self.folder)
+        if info.st_uid != os.getuid():
+            raise ChimeraWorkerError('Chimera worker folder %s belongs to another user' % self.folder)
+        if info.st_mode & 0o077:
+            raise ChimeraWorkerError('Chimera worker folder %s is accessible by other users'
+                                     % self.folder)
+
+    def _acquire(self):
+        self._checkFolder()
+        while True:
+            for slot in range(self.size):
+                lock = open(os.path.join(self.folder, 'worker_%d.lock' % slot), 'w')
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    return slot, lock
+                except (IOError, OSError):
+                    lock.close()
+            time.sleep(1)
+
+    def run(self, script, argv=(), cwd=None):
+        slot, lock = self._acquire()
+        try:
+            worker = ChimeraWorker(os.path.join(self.folder, 'worker_%d.sock' % slot), self.program,
+                                   self.env, self.idleTimeout)
+            worker.run(script, argv, cwd)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+            lock.close()